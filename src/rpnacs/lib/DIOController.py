@@ -5,6 +5,10 @@ class DIOController:
         # rp is a redpitaya_scpi object defined in the file redpitaya_scpi.py file. It will handle all of the communication with the RedPitaya
         self.rp = rp
 
+        # Pin states and directions last set or read, keyed by ('state', identifier) and ('dir', identifier).
+        # States of pins not known to be outputs are always read from the device.
+        self.state = utils.register_cache(rp, utils.StateCache())
+
     ## Higher Level API
     def set_led(self, num, state):
         # num is from 0 to 8
@@ -16,14 +20,15 @@ class DIOController:
     def get_led(self, num):
         # returns state of LED which has num = 0 to 8
         identifier = 'LED' + str(int(num))
-        return self.get_state(identifier, state)
+        return self.get_state(identifier)
 
     def set_all_led(self, states):
         # states is a list of 0s and 1s for the LEDS 0 to 8, total of 9
         if len(states) != 9:
             return
-        for i in range(9):
-            self.set_led(i, states[i])
+        with self.rp.batch():
+            for i in range(9):
+                self.set_led(i, states[i])
         return
 
     def set_pin_direction(self, num, direction, pin_type = 'P'):
@@ -41,16 +46,29 @@ class DIOController:
 
     def set_all_pin_direction(self, direction, pin_type = 'P'):
         # Sets all pin directions to array of directions, If P type pins, avoids DIO0_P which is EXT_TRIG
-        if pin_type == 'P':
-            for i in range(7):
-                if len(direction) == 7:
-                    self.set_pin_direction(i + 1, direction[i], 'P')
-        elif pin_type == 'N':
-            for i in range(8):
-                if len(direction) == 8:
-                    self.set_pin_direction(i, direction[i], 'N')
+        with self.rp.batch():
+            if pin_type == 'P':
+                for i in range(7):
+                    if len(direction) == 7:
+                        self.set_pin_direction(i + 1, direction[i], 'P')
+            elif pin_type == 'N':
+                for i in range(8):
+                    if len(direction) == 8:
+                        self.set_pin_direction(i, direction[i], 'N')
         return
 
+    def get_pin(self, num, pin_type = 'P'):
+        # get state and direction of a pin with a single round trip
+        # Returns a dict of (err_flag, val) for state and direction
+        identifier = 'DIO' + str(int(num)) + '_' + pin_type
+        state, direction = utils.query_many(self.rp, [('DIG:PIN? ' + identifier, int),
+                                                      ('DIG:PIN:DIR? ' + identifier, str)])
+        if not direction[0]:
+            self.state.set(('dir', identifier), direction[1])
+        if not state[0] and self._is_output(identifier):
+            self.state.set(('state', identifier), state[1])
+        return {'state': state, 'direction': direction}
+
     def set_pin_state(self, num, state, pin_type = 'P'):
         # set pin state,num from 0 to 7. state is 0 or 1
         identifier = 'DIO' + str(int(num)) + '_' + pin_type
@@ -65,40 +83,117 @@ class DIOController:
     def set_all_pin_states(self, states, pin_type = 'P'):
         # Sets all pin states to array of states.
         # States should be array of length 8 for N and length 7 for P
-        if pin_type == 'P':
-            if len(states) == 7:
-                for i in range(7):
-                    self.set_pin_state(i + 1, states[i], 'P')
-        elif pin_type == 'N':
-            if len(states) == 8:
-                for i in range(8):
-                    self.set_pin_state(i, states[i], 'N')
+        with self.rp.batch():
+            if pin_type == 'P':
+                if len(states) == 7:
+                    for i in range(7):
+                        self.set_pin_state(i + 1, states[i], 'P')
+            elif pin_type == 'N':
+                if len(states) == 8:
+                    for i in range(8):
+                        self.set_pin_state(i, states[i], 'N')
+        return
+
+    ## Bitmask API
+    # Bit i of a mask is LEDi or DIOi_<pin_type>, bit 0 is the least significant.
+    def set_leds(self, mask):
+        # Set LEDs 0 to 8 to the bits of mask. Only LEDs that changed are sent, all in a single write.
+        self._set_mask(self._mask_identifiers('LED'), mask)
+        return
+
+    def get_leds(self):
+        # Returns err_flag, states of LEDs 0 to 8 as a mask
+        return self._get_mask(self._mask_identifiers('LED'))
+
+    def set_pins(self, mask, pin_type = 'P'):
+        # Set the states of pins 0 to 7 of pin_type to the bits of mask.
+        # Only pins that changed are sent, all in a single write. Bit 0 is ignored for P pins, DIO0_P is EXT_TRIG.
+        self._set_mask(self._mask_identifiers(pin_type, True), mask)
+        return
+
+    def get_pins(self, pin_type = 'P'):
+        # Returns err_flag, states of pins 0 to 7 of pin_type as a mask.
+        # All pins are read with a single round trip, pins known to be outputs are served from the cache.
+        return self._get_mask(self._mask_identifiers(pin_type))
+
+    def set_directions(self, mask, pin_type = 'P'):
+        # Set pins 0 to 7 of pin_type to OUT where mask has a 1 and to IN where it has a 0, in a single write.
+        # Bit 0 is ignored for P pins.
+        with self.rp.batch():
+            for i, identifier in self._mask_identifiers(pin_type, True):
+                self.set_direction(identifier, 'OUT' if (mask >> i) & 1 else 'IN')
         return
 
+    def _mask_identifiers(self, pin_type, settable = False):
+        # (bit, identifier) of the pins of a mask
+        if pin_type == 'LED':
+            return [(i, 'LED' + str(i)) for i in range(9)]
+        first = 1 if settable and pin_type == 'P' else 0
+        return [(i, 'DIO' + str(i) + '_' + pin_type) for i in range(first, 8)]
+
+    def _set_mask(self, identifiers, mask):
+        with self.rp.batch():
+            for i, identifier in identifiers:
+                self.set_state(identifier, (int(mask) >> i) & 1)
+
+    def _get_mask(self, identifiers):
+        queries = self._mask_queries(identifiers)
+        vals = utils.query_many(self.rp, [('DIG:PIN? ' + identifier, int) for i, identifier in queries])
+        return self._mask_result(identifiers, queries, vals)
+
+    def _mask_queries(self, identifiers):
+        # (bit, identifier) of the pins that have to be read, states of known outputs are cached
+        for i, identifier in identifiers:
+            if not self._is_output(identifier):
+                self.state.invalidate(('state', identifier))
+        return [(i, identifier) for i, identifier in identifiers if self.state.get(('state', identifier)) is None]
+
+    def _mask_result(self, identifiers, queries, vals):
+        # Cache the states read for queries and build the mask, pins that failed to read count as 0
+        err = 0
+        for (i, identifier), (err_flag, val) in zip(queries, vals):
+            err |= err_flag
+            if not err_flag and self._is_output(identifier):
+                self.state.set(('state', identifier), val)
+        read = {identifier: 0 if err_flag else val for (i, identifier), (err_flag, val) in zip(queries, vals)}
+        mask = 0
+        for i, identifier in identifiers:
+            val = read[identifier] if identifier in read else self.state.get(('state', identifier))
+            if val:
+                mask |= 1 << i
+        return err, mask
+
     ## Lower level API
     def reset(self):
         # Set digital pin to default values, digital ios set to input and are on low. LEDs to OFF
         self.rp.tx_txt('DIG:RST')
+        self.state.clear()
         return
 
     def set_direction(self, identifier, direction):
         # Set direction of this pin
-        self.rp.tx_txt('DIG:PIN:DIR ' + direction + ',' + identifier)
+        if self.state.changed(('dir', identifier), direction):
+            # the output value of a pin that was an input is unknown
+            self.state.invalidate(('state', identifier))
+            self.rp.tx_txt('DIG:PIN:DIR ' + direction + ',' + identifier)
         return
 
     def get_direction(self, identifier):
         # Get direction of this pin
-        self.rp.tx_txt('DIG:PIN:DIR? ' + identifier)
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, val
+        return utils.query_cached(self.rp, self.state, ('dir', identifier), 'DIG:PIN:DIR? ' + identifier)
 
     def set_state(self, identifier, state):
         # Set state of this pin
-        self.rp.tx_txt('DIG:PIN ' + identifier + ',' + str(int(state)))
+        if self.state.changed(('state', identifier), int(state)):
+            self.rp.tx_txt('DIG:PIN ' + identifier + ',' + str(int(state)))
         return
 
     def get_state(self, identifier):
         # Get state of this pin
-        self.rp.tx_txt('DIG:PIN? ' + identifier)
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, int(val)
+        # Inputs change on their own, so only LEDs and pins known to be outputs are served from the cache
+        if not self._is_output(identifier):
+            self.state.invalidate(('state', identifier))
+        return utils.query_cached(self.rp, self.state, ('state', identifier), 'DIG:PIN? ' + identifier, int)
+
+    def _is_output(self, identifier):
+        return identifier.startswith('LED') or self.state.get(('dir', identifier)) == 'OUT'
@@ -1,5 +1,9 @@
+import collections
+import hashlib
 import time
 from . import utils
+from . import waveforms
+from .instrumentation import annotated
 import numpy as np
 
 class FuncGenerator:
@@ -7,27 +11,46 @@ class FuncGenerator:
         # rp is a redpitaya_scpi object defined in the file redpitaya_scpi.py file. It will handle all of the communication with the RedPitaya
         self.rp = rp
 
+        # Settings last set or read, per channel. Getters are served from here and setters skip values the device already has.
+        self.state = utils.register_cache(rp, utils.StateCache())
+
+        # Significant digits of the AWG samples uploaded by import_awg_data
+        self.awg_precision = 6
+        # Recently uploaded AWG payloads by (content hash, precision), so switching between a few waveforms
+        # doesn't format them again. At most awg_payload_cache_size are kept.
+        self.awg_payload_cache_size = 16
+        self._awg_payloads = collections.OrderedDict()
+        self._awg_formats = {}
+        # Samples last uploaded to each channel, the reference of verify_awg_data
+        self.awg_uploaded = {}
+        # Default tolerance of verify_awg_data, about two DAC steps of the +-1 full scale
+        self.awg_verify_tol = 2**-12
+
     ## Higher level API
+    @annotated('set_output')
     def set_output(self, chn, waveform, freq, amp, offset=0, phase=0):
         # Set output channel chn to the waveform specified by waveform at the frequency and amplitude
         # Not error checking for now...
-        self.set_waveform(chn, waveform)
-        self.set_freq(chn, freq)
-        self.set_amp(chn, amp)
-        self.set_offset(chn, offset)
-        self.set_phase(chn, phase)
+        # All settings are sent in a single write
+        with self.rp.batch():
+            self.set_waveform(chn, waveform)
+            self.set_freq(chn, freq)
+            self.set_amp(chn, amp)
+            self.set_offset(chn, offset)
+            self.set_phase(chn, phase)
         return
 
     def enable_output(self, chn):
         # enable outputs
         # if chn = 0, then enable all outputs at once.
         # if chn = 1,2 then just enable those channels
-        if chn == 0:
-            self.set_all_states('ON')
-            self.trigger_all_now()
-        else:
-            self.set_state(chn, 'ON')
-            self.trigger_chn_now(chn)
+        with self.rp.batch():
+            if chn == 0:
+                self.set_all_states('ON')
+                self.trigger_all_now()
+            else:
+                self.set_state(chn, 'ON')
+                self.trigger_chn_now(chn)
         return
 
     def disable_output(self, chn):
@@ -40,83 +63,112 @@ class FuncGenerator:
             self.set_state(chn, 'OFF')
         return
 
+    @annotated('get_settings')
+    def get_settings(self, chn):
+        # Get all settings of channel chn with a single round trip, settings in the state cache are not queried.
+        # Returns a dict of (err_flag, val) for waveform, freq, amp, offset, phase and state
+        queries = self._settings_queries(chn)
+        vals = utils.query_many(self.rp, [(cmd, conv) for key, cmd, conv in queries])
+        return self._settings_result(chn, queries, vals)
+
+    def _settings_queries(self, chn):
+        # (key, cmd, conv) of the settings of get_settings which are not cached
+        chn = str(int(chn))
+        queries = [('waveform', 'SOUR' + chn + ':FUNC?', str),
+                   ('freq', 'SOUR' + chn + ':FREQ:FIX?', int),
+                   ('amp', 'SOUR' + chn + ':VOLT?', float),
+                   ('offset', 'SOUR' + chn + ':VOLT:OFFS?', float),
+                   ('phase', 'SOUR' + chn + ':PHAS?', float),
+                   ('state', 'OUTPUT' + chn + ':STATE?', str)]
+        return [query for query in queries if self.state.get((query[0], int(chn))) is None]
+
+    def _settings_result(self, chn, queries, vals):
+        # Cache the values read for queries and build the get_settings dict
+        chn = int(chn)
+        for (key, cmd, conv), (err_flag, val) in zip(queries, vals):
+            if not err_flag:
+                self.state.set((key, chn), val)
+        read = {key: res for (key, cmd, conv), res in zip(queries, vals)}
+        keys = ['waveform', 'freq', 'amp', 'offset', 'phase', 'state']
+        return {key: read[key] if key in read else (0, self.state.get((key, chn))) for key in keys}
+
     ## Lower level API
     def set_all_states(self, val):
         # set all states to either ON or OFF
+        self.state.set(('state', 1), self._state_val(val))
+        self.state.set(('state', 2), self._state_val(val))
         self.rp.tx_txt('OUTPUT:STATE ' + val)
         return
 
     def set_state(self, source, val):
         # set channel 1 or 2 to ON or OFF
-        self.rp.tx_txt('OUTPUT' + str(int(source)) + ':STATE ' + val)
+        if self.state.changed(('state', int(source)), self._state_val(val)):
+            self.rp.tx_txt('OUTPUT' + str(int(source)) + ':STATE ' + val)
         return
 
+    def _state_val(self, val):
+        # the state is set with ON/OFF but read back as 1/0
+        return '1' if val.upper() == 'ON' else '0'
+
     def get_state(self, source):
         # get state of channel 1 or 2
-        self.rp.tx_txt('OUTPUT' + str(int(source)) + ':STATE?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, val
+        return utils.query_cached(self.rp, self.state, ('state', int(source)), 'OUTPUT' + str(int(source)) + ':STATE?')
 
     def set_freq(self, source, val):
         # Set frequency of channel 1 or 2 to a value in Hz.
         # Max value is 62.5e6 Hz
         # For AWG, this is frequency of 1 buffer (16384 samples)
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':FREQ:FIX ' + str(int(val)))
+        if self.state.changed(('freq', int(source)), int(val)):
+            self.rp.tx_txt('SOUR' + str(int(source)) + ':FREQ:FIX ' + str(int(val)))
         return
 
     def get_freq(self, source):
         # Get frequency of channel 1 or 2
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':FREQ:FIX?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, int(val)
+        return utils.query_cached(self.rp, self.state, ('freq', int(source)), 'SOUR' + str(int(source)) + ':FREQ:FIX?', int)
 
     def set_waveform(self, source, val):
         # Set waveform of chn specified by source.
         # Options are SINE, SQUARE, TRIANGLE, SAWU, SAWD, PWM, ARBITRARY, DC, DC_NEG
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':FUNC ' + val)
+        if self.state.changed(('waveform', int(source)), val.upper()):
+            self.rp.tx_txt('SOUR' + str(int(source)) + ':FUNC ' + val)
         return
 
     def get_waveform(self, source):
         # Get waveform of chn specified by source.
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':FUNC?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, val
+        return utils.query_cached(self.rp, self.state, ('waveform', int(source)), 'SOUR' + str(int(source)) + ':FUNC?')
 
     def set_amp(self, source, val):
         # Set amplitude of source chn
         # This is amplitude, so pk to pk is twice amplitude and output typically goes from - to + 1V
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':VOLT ' + str(val))
+        if self.state.changed(('amp', int(source)), float(val)):
+            self.rp.tx_txt('SOUR' + str(int(source)) + ':VOLT ' + str(val))
         return
 
     def get_amp(self, source):
         # Get amplitude of source chn
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':VOLT?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, float(val)
+        return utils.query_cached(self.rp, self.state, ('amp', int(source)), 'SOUR' + str(int(source)) + ':VOLT?', float)
 
     def set_offset(self, source, val):
         # Sets offset of source chn
         # Output Typically goes from - to +1 V
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':VOLT:OFFS ' + str(val))
+        if self.state.changed(('offset', int(source)), float(val)):
+            self.rp.tx_txt('SOUR' + str(int(source)) + ':VOLT:OFFS ' + str(val))
         return
 
     def get_offset(self, source):
         # Gets offset of source chn
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':VOLT:OFFS?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, float(val)
+        return utils.query_cached(self.rp, self.state, ('offset', int(source)), 'SOUR' + str(int(source)) + ':VOLT:OFFS?', float)
 
     def set_phase(self, source, val):
         # Sets the phase of a channel to the value val
         # in degrees from -360 to 360
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':PHAS ' + str(val))
+        if self.state.changed(('phase', int(source)), float(val)):
+            self.rp.tx_txt('SOUR' + str(int(source)) + ':PHAS ' + str(val))
         return
 
     def get_phase(self, source):
-        # Gets the phase of a channel
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':PHAS?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, val
+        # Gets the phase of a channel in degrees
+        return utils.query_cached(self.rp, self.state, ('phase', int(source)), 'SOUR' + str(int(source)) + ':PHAS?', float)
 
     def set_duty_cycle(self, source, val):
         # Set duty cycle of a PWM waveform.
@@ -126,22 +178,79 @@ class FuncGenerator:
 
     def get_duty_cycle(self, source):
         # Get duty cycle of the PWM waveform.
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':DCYC?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
+        err_flag, val = utils.rm_err(self.rp.txrx_txt('SOUR' + str(int(source)) + ':DCYC?'))
         return err_flag, float(val)
 
-    def import_awg_data(self, source, data):
+    @annotated('import_awg_data')
+    def import_awg_data(self, source, data, precision=None):
         # import data for the awg, should be 16384 samples
-        # data should be an array
-        data_str = ','.join(str(x) for x in data)
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':TRAC:DATA:DATA ' + data_str)
+        # data should be an array, samples are sent with precision significant digits, self.awg_precision by default.
+        # Nothing is sent if the channel already holds the same samples, as identified by their content hash.
+        data = np.ascontiguousarray(data, dtype=np.float64)
+        precision = self.awg_precision if precision is None else int(precision)
+        key = (hashlib.blake2b(data.tobytes(), digest_size=16).digest(), precision)
+        if self.state.changed(('awg', int(source)), key):
+            self.rp.tx_txt('SOUR' + str(int(source)) + ':TRAC:DATA:DATA ' + self._awg_payload(key, data))
+            # read-only arrays (from the waveforms module for instance) can't change under us
+            self.awg_uploaded[int(source)] = data if not data.flags.writeable else data.copy()
         return
 
+    def load_waveform(self, source, name, **params):
+        # Upload waveform name of the waveforms module with params to the awg of source, e.g.
+        # load_waveform(1, 'chirp', f0=1, f1=100). Set the waveform to ARBITRARY to output it.
+        self.import_awg_data(source, waveforms.generate(name, **params))
+        return
+
+    def _awg_payload(self, key, data):
+        # data formatted for upload, from the cache of recent payloads if possible
+        payload = self._awg_payloads.get(key)
+        if payload is not None:
+            self._awg_payloads.move_to_end(key)
+            return payload
+        # a single % formatting of all samples is several times faster than formatting them one by one
+        fmt_key = (len(data), key[1])
+        fmt = self._awg_formats.get(fmt_key)
+        if fmt is None:
+            fmt = self._awg_formats[fmt_key] = ','.join(['%.' + str(key[1]) + 'g'] * len(data))
+        payload = fmt % tuple(data.tolist())
+        self._awg_payloads[key] = payload
+        while len(self._awg_payloads) > self.awg_payload_cache_size:
+            self._awg_payloads.popitem(last=False)
+        return payload
+
     def get_awg_data(self, source):
-        # get stored data
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':TRAC:DATA:DATA?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, val
+        # get stored data as a numpy array, empty on error
+        err_flag, val = utils.rm_err(self.rp.txrx_txt('SOUR' + str(int(source)) + ':TRAC:DATA:DATA?'))
+        return err_flag, self._parse_awg_data(err_flag, val)
+
+    def _parse_awg_data(self, err_flag, val):
+        if err_flag:
+            return np.empty(0)
+        return utils.parse_data(val)
+
+    def verify_awg_data(self, source, tol=None):
+        # Read back the awg data of source and compare it with the last data uploaded by import_awg_data.
+        # Samples differing by more than tol (self.awg_verify_tol by default) are mismatches.
+        # Returns err_flag, whether the data matches, and the indices of the mismatched samples.
+        # err_flag is 1 if the readback failed or nothing was uploaded to source yet.
+        # On a mismatch the upload cache of source is dropped, so the next import_awg_data sends the data again.
+        err_flag, data = self.get_awg_data(source)
+        return self._verify_awg(source, err_flag, data, tol)
+
+    def _verify_awg(self, source, err_flag, data, tol):
+        expected = self.awg_uploaded.get(int(source))
+        if err_flag or expected is None:
+            return 1, False, np.empty(0, dtype=int)
+        tol = self.awg_verify_tol if tol is None else tol
+        n = min(len(data), len(expected))
+        bad = np.flatnonzero(np.abs(data[:n] - expected[:n]) > tol)
+        if len(data) != len(expected):
+            # samples missing from or added to the readback don't match either
+            bad = np.concatenate((bad, np.arange(n, max(len(data), len(expected)))))
+        ok = len(bad) == 0
+        if not ok:
+            self.state.invalidate(('awg', int(source)))
+        return 0, ok, bad
 
     def set_gen_mode(self, source, val):
         # set mode of this channel to either BURST or CONTINUOUS
@@ -151,8 +260,7 @@ class FuncGenerator:
 
     def get_gen_mode(self, source):
         # Get generation mode for this channel
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':BURS:STAT?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
+        err_flag, val = utils.rm_err(self.rp.txrx_txt('SOUR' + str(int(source)) + ':BURS:STAT?'))
         return err_flag, val
 
     def set_burst_cycle_num(self, source, val):
@@ -163,8 +271,7 @@ class FuncGenerator:
 
     def get_burst_cycle_num(self, source):
         # Get the number of cycles in each burst (N)
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':BURS:NCYC?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
+        err_flag, val = utils.rm_err(self.rp.txrx_txt('SOUR' + str(int(source)) + ':BURS:NCYC?'))
         return err_flag, int(val)
 
     def set_burst_repeats(self, source, val):
@@ -176,8 +283,7 @@ class FuncGenerator:
 
     def get_burst_repeats(self, source):
         # Get the number of repeated bursts (R)
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':BURS:NOR?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
+        err_flag, val = utils.rm_err(self.rp.txrx_txt('SOUR' + str(int(source)) + ':BURS:NOR?'))
         return err_flag, int(val)
 
     def set_burst_int(self, source, val):
@@ -188,8 +294,7 @@ class FuncGenerator:
 
     def get_burst_int(self, source):
         # Get the burst interval from start of one burst to another in us
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':BURS:INT:PER?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
+        err_flag, val = utils.rm_err(self.rp.txrx_txt('SOUR' + str(int(source)) + ':BURS:INT:PER?'))
         return err_flag, int(val)
 
     def set_trig_source(self, source, val):
@@ -202,8 +307,7 @@ class FuncGenerator:
 
     def get_trig_source(self, source):
         # Get trigger source for this channel
-        self.rp.tx_txt('SOUR' + str(int(source)) + ':TRIG:SOUR?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
+        err_flag, val = utils.rm_err(self.rp.txrx_txt('SOUR' + str(int(source)) + ':TRIG:SOUR?'))
         return err_flag, val
 
     def trigger_all_now(self):
@@ -219,6 +323,8 @@ class FuncGenerator:
     def reset(self):
         # Reset generator to default settings
         self.rp.tx_txt('GEN:RST')
+        self.state.clear()
+        self.awg_uploaded.clear()
         return
 
     def align_phases(self):
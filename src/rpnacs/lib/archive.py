@@ -0,0 +1,215 @@
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+# On disk layout of an archive directory:
+#   archive.json       header: record shape and dtype, chunk size and number of records written
+#   data_NNNNN.npy     chunk of chunk_size records of shape (channels, nsamples)
+#   index_NNNNN.npy    metadata of the records in the matching data chunk, see index_dtype
+# Chunks are preallocated .npy files, so they can be memory mapped with np.load(mmap_mode='r').
+
+index_dtype = np.dtype([('timestamp', 'f8'), ('dec', 'i4'), ('buf_size', 'i4'),
+                        ('trig_level', 'f4'), ('trig_delay', 'i4'), ('trig_source', 'S24')])
+
+header_name = 'archive.json'
+
+def _data_name(chunk):
+    return 'data_{:05d}.npy'.format(chunk)
+
+def _index_name(chunk):
+    return 'index_{:05d}.npy'.format(chunk)
+
+def _read_header(path):
+    with open(os.path.join(path, header_name)) as f:
+        return json.load(f)
+
+class TraceArchiveWriter:
+    def __init__(self, path, nsamples, channels=2, dtype=np.float32, chunk_size=1024, queue_size=256):
+        # Append only archive of traces in the directory path, created if needed.
+        # An existing archive is appended to, it must have the same nsamples, channels and dtype.
+        # Records are written to the memory mapped chunks by a background thread, so append() only copies the trace
+        # into a queue. It blocks only if queue_size records are waiting to be written.
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, header_name)):
+            self.header = _read_header(path)
+            if (self.header['nsamples'] != nsamples or self.header['channels'] != channels or
+                    np.dtype(self.header['dtype']) != np.dtype(dtype)):
+                raise ValueError('archive {} has records of a different shape or dtype'.format(path))
+        else:
+            self.header = {'nsamples': int(nsamples), 'channels': int(channels), 'dtype': np.dtype(dtype).str,
+                           'chunk_size': int(chunk_size), 'count': 0}
+            self._write_header()
+        self.dtype = np.dtype(self.header['dtype'])
+        self.count = self.header['count'] # records written by the thread
+
+        self._chunk = None
+        self._data = None
+        self._index = None
+        self._error = None
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def append(self, traces, timestamp=None, dec=0, buf_size=0, trig_level=0, trig_delay=0, trig_source=''):
+        # Queue a (channels, nsamples) trace with its metadata for writing. The trace is copied.
+        self._check()
+        traces = np.array(traces, dtype=self.dtype)
+        meta = (time.time() if timestamp is None else timestamp, dec, buf_size, trig_level, trig_delay, trig_source)
+        self._queue.put((traces, meta))
+
+    def record(self, scope, ch1, ch2, timestamp=None):
+        # Queue a trace acquired by scope, metadata are taken from the scope settings cache
+        state = scope.state
+        self.append((ch1, ch2), timestamp, dec=state.get('dec') or 0, buf_size=state.get('buf_size') or 0,
+                    trig_level=state.get('trig_lev') or 0, trig_delay=state.get('trig_delay') or 0,
+                    trig_source=scope.trig_cache.split(' ')[-1])
+
+    def flush(self):
+        # Wait until all queued records are written and update the header
+        self._queue.join()
+        self._check()
+        self._sync()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._sync()
+        self._data = self._index = None
+        self._check()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._error is None:
+                    self._write(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, traces, meta):
+        chunk_size = self.header['chunk_size']
+        chunk, row = divmod(self.count, chunk_size)
+        if chunk != self._chunk:
+            self._open_chunk(chunk)
+        self._data[row] = traces
+        self._index[row] = meta
+        self.count += 1
+
+    def _open_chunk(self, chunk):
+        # Memory map chunk, creating the files if they don't exist yet
+        self._sync()
+        data_path = os.path.join(self.path, _data_name(chunk))
+        index_path = os.path.join(self.path, _index_name(chunk))
+        if os.path.exists(data_path):
+            self._data = np.load(data_path, mmap_mode='r+')
+            self._index = np.load(index_path, mmap_mode='r+')
+        else:
+            shape = (self.header['chunk_size'], self.header['channels'], self.header['nsamples'])
+            self._data = np.lib.format.open_memmap(data_path, mode='w+', dtype=self.dtype, shape=shape)
+            self._index = np.lib.format.open_memmap(index_path, mode='w+', dtype=index_dtype, shape=(shape[0],))
+        self._chunk = chunk
+
+    def _sync(self):
+        if self._data is not None:
+            self._data.flush()
+            self._index.flush()
+        self.header['count'] = self.count
+        self._write_header()
+
+    def _write_header(self):
+        tmp = os.path.join(self.path, header_name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.header, f)
+        os.replace(tmp, os.path.join(self.path, header_name))
+
+class TraceArchive:
+    def __init__(self, path):
+        # Read access to an archive written by TraceArchiveWriter.
+        # Chunks are memory mapped when first accessed, so opening a multi GB archive reads nothing but the header.
+        # Indexing with an int or a slice returns records of shape (channels, nsamples).
+        # A slice within one chunk is a view of the memory map, a slice across chunks or with a step is copied.
+        self.path = path
+        self._chunks = {}
+        self.reload()
+
+    def reload(self):
+        # Re-read the header, to see records appended since the archive was opened
+        self.header = _read_header(self.path)
+        self.count = self.header['count']
+        self.chunk_size = self.header['chunk_size']
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        return self._get(idx, 0)
+
+    def meta(self, idx):
+        # Metadata of records idx, see index_dtype
+        return self._get(idx, 1)
+
+    @property
+    def timestamps(self):
+        return self.meta(slice(None))['timestamp']
+
+    def _empty(self, which, n):
+        # Uninitialized array of n records or metadata, shaped as the chunks are
+        if which == 0:
+            return np.empty((n, self.header['channels'], self.header['nsamples']), dtype=self.header['dtype'])
+        return np.empty(n, dtype=index_dtype)
+
+    def _chunk(self, chunk):
+        if chunk not in self._chunks:
+            self._chunks[chunk] = (np.load(os.path.join(self.path, _data_name(chunk)), mmap_mode='r'),
+                                   np.load(os.path.join(self.path, _index_name(chunk)), mmap_mode='r'))
+        return self._chunks[chunk]
+
+    def _get(self, idx, which):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(self.count)
+            n = len(range(start, stop, step))
+            if n == 0:
+                return self._empty(which, 0)
+            if step != 1:
+                # Only the records selected are read, chunk by chunk
+                rows = np.arange(start, stop, step)
+                chunks = rows // self.chunk_size
+                out = self._empty(which, n)
+                for chunk in np.unique(chunks):
+                    sel = chunks == chunk
+                    out[sel] = self._chunk(int(chunk))[which][rows[sel] % self.chunk_size]
+                return out
+            pieces = []
+            while start < stop:
+                chunk, row = divmod(start, self.chunk_size)
+                n = min(stop - start, self.chunk_size - row)
+                pieces.append(self._chunk(chunk)[which][row:row + n])
+                start += n
+            return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+        idx = int(idx)
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError('record {} out of range for archive of {} records'.format(idx, self.count))
+        chunk, row = divmod(idx, self.chunk_size)
+        return self._chunk(chunk)[which][row]
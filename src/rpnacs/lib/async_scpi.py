@@ -0,0 +1,437 @@
+"""asyncio access to Red Pitaya.
+
+AsyncScpi is the asyncio counterpart of redpitaya_scpi.scpi. AsyncScope, AsyncFuncGenerator and
+AsyncDIOController wrap it with the same API as Scope, FuncGenerator and DIOController, except
+that every method that waits for a reply is a coroutine. Setters are inherited unchanged, since
+sending only queues bytes on the transport.
+
+    rp = await AsyncScpi.connect('192.168.0.200')
+    sc = AsyncScope(rp)
+    sc.set_trigger(1, 'PE', 0.3)
+    ts, ch1, ch2 = await sc.acquire_trace()
+"""
+
+import asyncio
+import time
+import weakref
+
+import numpy as np
+
+from . import utils
+from .redpitaya_scpi import BatchQueue
+from .scope import Scope
+from .FuncGenerator import FuncGenerator
+from .DIOController import DIOController
+
+class AsyncScpi(BatchQueue):
+    """SCPI connection to a Red Pitaya on top of asyncio streams.
+    batch() is the one of BatchQueue, without a lock since all tasks run in one thread.
+    """
+    delimiter = '\r\n'
+    _delimiter = b'\r\n'
+
+    # Largest reply line, a full ASCII trace or AWG readback is ~150 kB
+    line_limit = 2**22
+
+    def __init__(self, reader, writer, host=None, port=None):
+        """Use AsyncScpi.connect to open a connection."""
+        self.host    = host
+        self.port    = port
+        self._reader = reader
+        self._writer = writer
+
+        # Held for a whole query/reply exchange so concurrent tasks get their own replies
+        self.lock = asyncio.Lock()
+
+        # Messages queued inside a batch() block, sent by flush()
+        super().__init__()
+
+        # StateCaches of the instruments using this connection, cleared by rst()
+        self.caches = weakref.WeakSet()
+
+    @classmethod
+    async def connect(cls, host, port=5000, timeout=None):
+        """Open IP connection."""
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, limit=cls.line_limit), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            print('SCPI >> connect({!s:s}:{:d}) failed: {!s:s}'.format(host, port, e))
+            raise e
+        return cls(reader, writer, host, port)
+
+    async def close(self):
+        """Close IP connection."""
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+        self._writer = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.close()
+
+    def tx_txt(self, msg):
+        """Queue text string and delimiter on the transport, or in the batch queue inside batch()."""
+        if self._tx_depth:
+            self._tx_pending.append(msg)
+            return
+        self._writer.write((msg + self.delimiter).encode('utf-8'))
+
+    def flush(self):
+        """Write all messages queued by batch() at once."""
+        if self._tx_pending:
+            self._writer.write(self._tx_take())
+
+    async def drain(self):
+        """Wait until the transport write buffer has been handed to the socket."""
+        self.flush()
+        await self._writer.drain()
+
+    async def rx_txt(self):
+        """Receive text string and return it after removing the delimiter."""
+        await self.drain()
+        line = await self._reader.readuntil(self._delimiter)
+        return line[:-len(self._delimiter)].decode('utf-8')
+
+    async def rx_arb(self):
+        """Receive binary data from scpi server.
+        Returns the data block as bytes, or False if the reply is not a binary block.
+        """
+        await self.drain()
+        head = await self._reader.readexactly(2)
+        numOfNumBytes = head[1] - ord('0')
+        if head[0] != ord('#') or not (0 < numOfNumBytes <= 9):
+            # not a binary block (ERR! reply for instance), drop the rest of the line
+            if head[1] == ord('\r'):
+                # one character reply, only the '\n' is left
+                await self._reader.readexactly(len(self._delimiter) - 1)
+            elif not head.endswith(self._delimiter):
+                await self._reader.readuntil(self._delimiter)
+            return False
+        numOfBytes = int(await self._reader.readexactly(numOfNumBytes))
+        data = await self._reader.readexactly(numOfBytes)
+        await self._reader.readexactly(len(self._delimiter))
+        return data
+
+    async def txrx_txt(self, msg):
+        """Send/receive text string."""
+        async with self.lock:
+            self.tx_txt(msg)
+            return await self.rx_txt()
+
+    async def txrx_many(self, msgs):
+        """Send several queries with one write, then receive the replies in order."""
+        async with self.lock:
+            with self.batch():
+                for msg in msgs:
+                    self.tx_txt(msg)
+            return [await self.rx_txt() for msg in msgs]
+
+    async def idn_q(self):
+        """Identification Query"""
+        return await self.txrx_txt('*IDN?')
+
+    def rst(self):
+        """Reset Command. Clears the settings cached by the instruments on this connection."""
+        for cache in self.caches:
+            cache.clear()
+        self.tx_txt('*RST')
+
+async def _query(rp, cmd, conv=str):
+    # single query, returns (err_flag, val) like the blocking getters
+    return utils.parse_reply(await rp.txrx_txt(cmd), conv)
+
+async def _query_cached(rp, state, key, cmd, conv=str):
+    # same as utils.query_cached
+    val = state.get(key)
+    if val is not None:
+        return 0, val
+    err_flag, val = await _query(rp, cmd, conv)
+    if not err_flag:
+        state.set(key, val)
+    return err_flag, val
+
+async def _query_many(rp, queries):
+    # pipelined queries, same as utils.query_many
+    replies = await rp.txrx_many([cmd for cmd, conv in queries])
+    return [utils.parse_reply(reply, conv) for reply, (cmd, conv) in zip(replies, queries)]
+
+class AsyncScope(Scope):
+    # Scope on an AsyncScpi connection. Methods waiting for a reply are coroutines.
+
+    ## Higher Level API
+    async def set_time_res(self, res):
+        min_sampling_rate = 1/self.sampling_rate
+        if res <= min_sampling_rate:
+            dec = 1
+        else:
+            dec = 2**(np.floor(np.log2(res * self.sampling_rate)))
+            dec = min(dec, 2**16) # largest decimation of the device
+        self.set_dec(dec)
+        err_flag, res = await self.get_dec()
+        return res / self.sampling_rate
+
+    async def set_time_total(self, total):
+        err_flag, buf_size = await self.get_buf_size()
+        max_dec = 2**16
+        max_time = buf_size / self.sampling_rate * max_dec
+        if total > max_time:
+            dec = 2**16
+        else:
+            dec = 2**(np.ceil(np.log2(total * self.sampling_rate / buf_size)))
+        self.set_dec(dec)
+        err_flag, res = await self.get_dec()
+        return buf_size / self.sampling_rate * res
+
+    async def get_time_points(self):
+        axis = await self.get_time_axis()
+        return axis.array
+
+    async def get_time_axis(self):
+        err_flag, buf_size = await self.get_buf_size()
+        err_flag, dec = await self.get_dec()
+        err_flag, trig_delay = await self.get_trig_delay()
+        return self.time_axis(buf_size, dec, trig_delay)
+
+    async def acquire_trace(self, timeout=60, holdoff = 0.005, max_holdoff = 0.05, out=None):
+        # Same as Scope.acquire_trace, but other tasks keep running while waiting for the trigger
+        axis = await self.get_time_axis()
+        with self.rp.batch():
+            self.start_acq()
+            self.rp.tx_txt(self.trig_cache)
+        triggered = await self.wait_trigger(axis.duration, timeout, holdoff, max_holdoff)
+        async with self.rp.lock:
+            with self.rp.batch():
+                if triggered:
+                    self.stop_acq()
+                self.rp.tx_txt('ACQ:SOUR1:DATA?')
+                self.rp.tx_txt('ACQ:SOUR2:DATA?')
+            err_flag, ch1 = await self.rx_data()
+            err_flag, ch2 = await self.rx_data()
+        if out is not None:
+            out[0] = ch1
+            out[1] = ch2
+            ch1, ch2 = out[0], out[1]
+        return axis.array, ch1, ch2
+
+    async def stream(self, n=None, timeout=60, holdoff = 0.005, max_holdoff = 0.05):
+        # Same as Scope.stream, as an async generator: async for timestamp, ts, ch1, ch2 in sc.stream(): ...
+        axis = await self.get_time_axis()
+        fill_time = axis.duration
+        ts = axis.array
+        self.stream_stats = {'frames': 0, 'dropped': 0, 'elapsed': 0.0, 'fps': 0.0}
+        start = time.perf_counter()
+        with self.rp.batch():
+            self.start_acq()
+            self.rp.tx_txt(self.trig_cache)
+        t_arm = time.perf_counter()
+        try:
+            while n is None or self.stream_stats['frames'] < n:
+                # the device has been recording since t_arm, only the rest of the fill time is left to wait
+                remaining = max(0, fill_time - (time.perf_counter() - t_arm))
+                if not await self.wait_trigger(remaining, timeout, holdoff, max_holdoff):
+                    self.stream_stats['dropped'] += 1
+                    self.rp.tx_txt(self.trig_cache)
+                    t_arm = time.perf_counter()
+                    continue
+                timestamp = time.time()
+                async with self.rp.lock:
+                    with self.rp.batch():
+                        self.stop_acq()
+                        self.rp.tx_txt('ACQ:SOUR1:DATA?')
+                        self.rp.tx_txt('ACQ:SOUR2:DATA?')
+                    raw1 = await self.rx_data_raw()
+                    raw2 = await self.rx_data_raw()
+                # re-arm, then decode while the device is recording
+                with self.rp.batch():
+                    self.start_acq()
+                    self.rp.tx_txt(self.trig_cache)
+                t_arm = time.perf_counter()
+                err_flag, ch1 = self.decode_data(*raw1)
+                err_flag, ch2 = self.decode_data(*raw2)
+                elapsed = time.perf_counter() - start
+                self.stream_stats['frames'] += 1
+                self.stream_stats['elapsed'] = elapsed
+                self.stream_stats['fps'] = self.stream_stats['frames'] / elapsed
+                yield timestamp, ts, ch1, ch2
+        finally:
+            self.stop_acq()
+
+    async def wait_trigger(self, fill_time=0, timeout=60, holdoff=0.005, max_holdoff=0.05):
+        # Same as Scope.wait_trigger
+        start = time.perf_counter()
+        await asyncio.sleep(min(fill_time, timeout))
+        polls = 0
+        triggered = False
+        while True:
+            err_flag, stat = await self.get_trig_status()
+            polls += 1
+            elapsed = time.perf_counter() - start
+            if stat == 'TD':
+                triggered = True
+                break
+            if elapsed >= timeout:
+                break
+            await asyncio.sleep(min(holdoff, timeout - elapsed))
+            holdoff = min(max(2 * holdoff, 1e-3), max_holdoff)
+        self.wait_stats = self._wait_stats(triggered, polls, time.perf_counter() - start, fill_time)
+        return triggered
+
+    ## Lower Level API
+    async def get_dec(self):
+        return await _query_cached(self.rp, self.state, 'dec', 'ACQ:DEC?', int)
+
+    async def get_avg(self):
+        return await _query_cached(self.rp, self.state, 'avg', 'ACQ:AVG?')
+
+    async def get_trig_status(self):
+        return await _query(self.rp, 'ACQ:TRIG:STAT?')
+
+    async def get_trig_delay(self):
+        return await _query_cached(self.rp, self.state, 'trig_delay', 'ACQ:TRIG:DLY?', int)
+
+    async def get_trig_delay_ns(self):
+        return await _query_cached(self.rp, self.state, 'trig_delay_ns', 'ACQ:TRIG:DLY:NS?', int)
+
+    async def get_trig_hyst(self):
+        return await _query_cached(self.rp, self.state, 'trig_hyst', 'ACQ:TRIG:HYST?', float)
+
+    async def get_trig_lev(self):
+        return await _query_cached(self.rp, self.state, 'trig_lev', 'ACQ:TRIG:LEV?', float)
+
+    async def get_data_units(self):
+        return await _query(self.rp, 'ACQ:DATA:UNITS?')
+
+    async def read_samples_start_end(self, source, start, end):
+        err_flag, data = await self.read_data('ACQ:SOUR' + str(int(source)) + ':DATA:STA:END? ' + str(int(start)) + ',' + str(int(end)))
+        return data
+
+    async def read_samples_from(self, source, start, nsamples):
+        return await self.read_data('ACQ:SOUR' + str(int(source)) + ':DATA:STA:N? ' + str(int(start)) + ',' + str(int(nsamples)))
+
+    async def read_all_samples(self, source):
+        return await self.read_data('ACQ:SOUR' + str(int(source)) + ':DATA?')
+
+    async def read_samples_from_trig(self, source, nsamples):
+        return await self.read_data('ACQ:SOUR' + str(int(source)) + ':DATA:OLD:N? ' + str(int(nsamples)))
+
+    async def read_samples_before_trig(self, source, nsamples):
+        return await self.read_data('ACQ:SOUR' + str(int(source)) + ':DATA:LAT:N? ' + str(int(nsamples)))
+
+    async def read_data(self, cmd):
+        async with self.rp.lock:
+            self.rp.tx_txt(cmd)
+            return await self.rx_data()
+
+    async def rx_data(self):
+        # Caller holds rp.lock
+        return self.decode_data(*await self.rx_data_raw())
+
+    async def rx_data_raw(self):
+        # Caller holds rp.lock
+        if self.data_format == 'BIN':
+            buf = await self.rp.rx_arb()
+            return int(buf is False), buf
+        return utils.rm_err(await self.rp.rx_txt())
+
+    async def get_buf_size(self):
+        return await _query_cached(self.rp, self.state, 'buf_size', 'ACQ:BUF:SIZE?', int)
+
+    async def get_source_gain(self, source):
+        return await _query_cached(self.rp, self.state, ('gain', int(source)), 'ACQ:SOUR' + str(int(source)) + ':GAIN?')
+
+class AsyncFuncGenerator(FuncGenerator):
+    # FuncGenerator on an AsyncScpi connection. Methods waiting for a reply are coroutines.
+
+    async def get_settings(self, chn):
+        queries = self._settings_queries(chn)
+        vals = await _query_many(self.rp, [(cmd, conv) for key, cmd, conv in queries])
+        return self._settings_result(chn, queries, vals)
+
+    async def get_state(self, source):
+        return await _query_cached(self.rp, self.state, ('state', int(source)), 'OUTPUT' + str(int(source)) + ':STATE?')
+
+    async def get_freq(self, source):
+        return await _query_cached(self.rp, self.state, ('freq', int(source)), 'SOUR' + str(int(source)) + ':FREQ:FIX?', int)
+
+    async def get_waveform(self, source):
+        return await _query_cached(self.rp, self.state, ('waveform', int(source)), 'SOUR' + str(int(source)) + ':FUNC?')
+
+    async def get_amp(self, source):
+        return await _query_cached(self.rp, self.state, ('amp', int(source)), 'SOUR' + str(int(source)) + ':VOLT?', float)
+
+    async def get_offset(self, source):
+        return await _query_cached(self.rp, self.state, ('offset', int(source)), 'SOUR' + str(int(source)) + ':VOLT:OFFS?', float)
+
+    async def get_phase(self, source):
+        return await _query_cached(self.rp, self.state, ('phase', int(source)), 'SOUR' + str(int(source)) + ':PHAS?', float)
+
+    async def get_duty_cycle(self, source):
+        return await _query(self.rp, 'SOUR' + str(int(source)) + ':DCYC?', float)
+
+    async def get_awg_data(self, source):
+        err_flag, val = await _query(self.rp, 'SOUR' + str(int(source)) + ':TRAC:DATA:DATA?')
+        return err_flag, self._parse_awg_data(err_flag, val)
+
+    async def verify_awg_data(self, source, tol=None):
+        err_flag, data = await self.get_awg_data(source)
+        return self._verify_awg(source, err_flag, data, tol)
+
+    async def get_gen_mode(self, source):
+        return await _query(self.rp, 'SOUR' + str(int(source)) + ':BURS:STAT?')
+
+    async def get_burst_cycle_num(self, source):
+        return await _query(self.rp, 'SOUR' + str(int(source)) + ':BURS:NCYC?', int)
+
+    async def get_burst_repeats(self, source):
+        return await _query(self.rp, 'SOUR' + str(int(source)) + ':BURS:NOR?', int)
+
+    async def get_burst_int(self, source):
+        return await _query(self.rp, 'SOUR' + str(int(source)) + ':BURS:INT:PER?', int)
+
+    async def get_trig_source(self, source):
+        return await _query(self.rp, 'SOUR' + str(int(source)) + ':TRIG:SOUR?')
+
+class AsyncDIOController(DIOController):
+    # DIOController on an AsyncScpi connection. Methods waiting for a reply are coroutines.
+
+    async def get_led(self, num):
+        return await self.get_state('LED' + str(int(num)))
+
+    async def get_pin_direction(self, num, pin_type = 'P'):
+        return await self.get_direction('DIO' + str(int(num)) + '_' + pin_type)
+
+    async def get_pin_state(self, num, pin_type = 'P'):
+        return await self.get_state('DIO' + str(int(num)) + '_' + pin_type)
+
+    async def get_pin(self, num, pin_type = 'P'):
+        identifier = 'DIO' + str(int(num)) + '_' + pin_type
+        state, direction = await _query_many(self.rp, [('DIG:PIN? ' + identifier, int),
+                                                       ('DIG:PIN:DIR? ' + identifier, str)])
+        if not direction[0]:
+            self.state.set(('dir', identifier), direction[1])
+        if not state[0] and self._is_output(identifier):
+            self.state.set(('state', identifier), state[1])
+        return {'state': state, 'direction': direction}
+
+    async def get_leds(self):
+        return await self._get_mask(self._mask_identifiers('LED'))
+
+    async def get_pins(self, pin_type = 'P'):
+        return await self._get_mask(self._mask_identifiers(pin_type))
+
+    async def _get_mask(self, identifiers):
+        queries = self._mask_queries(identifiers)
+        vals = await _query_many(self.rp, [('DIG:PIN? ' + identifier, int) for i, identifier in queries])
+        return self._mask_result(identifiers, queries, vals)
+
+    async def get_direction(self, identifier):
+        return await _query_cached(self.rp, self.state, ('dir', identifier), 'DIG:PIN:DIR? ' + identifier)
+
+    async def get_state(self, identifier):
+        if not self._is_output(identifier):
+            self.state.invalidate(('state', identifier))
+        return await _query_cached(self.rp, self.state, ('state', identifier), 'DIG:PIN? ' + identifier, int)
@@ -0,0 +1,211 @@
+import argparse
+import json
+import platform
+import socket
+import sys
+import threading
+import time
+import numpy as np
+from . import redpitaya_scpi as scpi
+from .simulator import SimServer
+from .scope import Scope
+from .FuncGenerator import FuncGenerator
+from .DIOController import DIOController
+
+# Benchmarks of the client hot paths, run against the simulator so no hardware is needed:
+#
+#   python -m rpnacs.lib.benchmark --json --output bench_output.txt
+#
+# Every result is a dict of timings in seconds per operation (median and min over the repeats) and derived rates.
+# Compare the JSON output of two runs to find regressions.
+
+class ReplayServer:
+    def __init__(self, reply):
+        # Minimal server answering every line received with the same recorded reply, to time the client
+        # receive path without any server side work.
+        self.reply = reply + b'\r\n'
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.host, self.port = self.sock.getsockname()[:2]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.sock.close()
+
+    def _serve(self):
+        try:
+            conn, addr = self.sock.accept()
+        except OSError:
+            return
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buf = b''
+        with conn:
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    return
+                buf += chunk
+                nlines = buf.count(b'\r\n')
+                buf = buf[buf.rfind(b'\r\n') + 2:] if nlines else buf
+                for i in range(nlines):
+                    conn.sendall(self.reply)
+
+def timeit(fn, number, repeat=5):
+    # Time number calls of fn, repeat times. Returns median and min seconds per call.
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        for j in range(number):
+            fn()
+        times.append((time.perf_counter() - t0) / number)
+    return {'median': float(np.median(times)), 'min': float(min(times)), 'number': number, 'repeat': repeat}
+
+def _rate(res, key, per_call):
+    # Add key: per_call / median time, e.g. bytes/s or traces/s
+    res[key] = per_call / res['median']
+    return res
+
+def bench_roundtrip(rp, number):
+    # Per command overhead: a query answered without device side work, one at a time and pipelined by 10
+    single = timeit(rp.idn_q, number)
+    many = timeit(lambda: rp.txrx_many(['*IDN?'] * 10), max(number // 10, 1))
+    many['median'] /= 10
+    many['min'] /= 10
+    return {'single': single, 'pipelined': many}
+
+def bench_rx(sizes, number):
+    # rx_txt and rx_arb throughput against recorded replies of each payload size
+    res = {'rx_txt': {}, 'rx_arb': {}}
+    for size in sizes:
+        with ReplayServer(b'1' * size) as srv:
+            rp = scpi.scpi(srv.host, port=srv.port)
+            res['rx_txt'][str(size)] = _rate(timeit(lambda: rp.txrx_txt('X?'), number), 'bytes_per_s', size)
+            rp.close()
+        header = str(size).encode()
+        with ReplayServer(b'#' + str(len(header)).encode() + header + b'\x00' * size) as srv:
+            rp = scpi.scpi(srv.host, port=srv.port)
+            def arb():
+                rp.tx_txt('X?')
+                rp.rx_arb()
+            res['rx_arb'][str(size)] = _rate(timeit(arb, number), 'bytes_per_s', size)
+            rp.close()
+    return res
+
+def bench_parse(nsamples, number):
+    # Decoding of one trace of nsamples by Scope.decode_data, for each data format
+    scope = Scope(None)
+    volts = np.random.default_rng(0).uniform(-1, 1, nsamples)
+    res = {}
+    for fmt, units, dtype in [('ASCII', 'VOLTS', np.float64), ('ASCII', 'VOLTS', np.float32),
+                              ('BIN', 'VOLTS', None), ('BIN', 'RAW', None)]:
+        scope.data_format = fmt
+        scope.data_units = units
+        if fmt == 'ASCII':
+            scope.ascii_dtype = dtype
+            raw = '{' + ','.join(map('{:.6f}'.format, volts.tolist())) + '}'
+            name = 'ASCII_' + np.dtype(dtype).name
+        else:
+            raw = bytearray((volts * 8192).astype('>i2') if units == 'RAW' else volts.astype('>f4'))
+            name = 'BIN_' + units
+        res[name] = _rate(timeit(lambda: scope.decode_data(0, raw), number), 'samples_per_s', nsamples)
+    return res
+
+def bench_acquire(rp, number):
+    # acquire_trace with an immediate trigger, full buffer at decimation 1, for each data format
+    scope = Scope(rp)
+    scope.reset_acq()
+    scope.set_dec(1)
+    res = {}
+    for fmt, units in [('ASCII', 'VOLTS'), ('BIN', 'VOLTS'), ('BIN', 'RAW')]:
+        scope.set_data_format(fmt)
+        scope.set_data_units(units)
+        res[fmt + '_' + units] = _rate(timeit(scope.acquire_trace, number), 'traces_per_s', 1)
+    scope.reset_acq()
+    return res
+
+def bench_awg(rp, number, nsamples=16384):
+    # import_awg_data of a full buffer, until the device has taken it:
+    # new data, data uploaded recently to another channel, and data the channel already holds
+    fgen = FuncGenerator(rp)
+    data = np.sin(np.linspace(0, 2 * np.pi, nsamples, endpoint=False))
+    def upload():
+        fgen.state.clear() # upload every time, even if the data didn't change
+        fgen._awg_payloads.clear()
+        fgen.import_awg_data(1, data)
+        rp.idn_q()
+    def switch():
+        fgen.state.clear()
+        fgen.import_awg_data(1, data)
+        rp.idn_q()
+    def unchanged():
+        fgen.import_awg_data(1, data)
+        rp.idn_q()
+    return {'upload': _rate(timeit(upload, number), 'samples_per_s', nsamples),
+            'cached_payload': _rate(timeit(switch, number), 'samples_per_s', nsamples),
+            'unchanged': _rate(timeit(unchanged, number), 'samples_per_s', nsamples)}
+
+def bench_dio(rp, number):
+    # set_all_pin_states on all N pins, alternating between two patterns so every pin changes
+    dio = DIOController(rp)
+    dio.reset()
+    dio.set_all_pin_direction(['OUT'] * 8, 'N')
+    patterns = [[0, 1] * 4, [1, 0] * 4]
+    count = [0]
+    def set_all():
+        count[0] += 1
+        dio.set_all_pin_states(patterns[count[0] % 2], 'N')
+        rp.idn_q()
+    res = timeit(set_all, number)
+    dio.reset()
+    return res
+
+def run(quick=False, latency=0.0):
+    # Run all benchmarks, returns a dict of results and information about the run
+    n = 20 if quick else 200
+    results = {}
+    results['parse'] = bench_parse(16384, max(n // 10, 2))
+    results['rx'] = bench_rx([16, 1024, 65536, 1 << 20], n)
+    with SimServer(latency=latency) as sim:
+        rp = scpi.scpi(sim.host, port=sim.port)
+        results['roundtrip'] = bench_roundtrip(rp, n * 5)
+        results['acquire_trace'] = bench_acquire(rp, max(n // 10, 2))
+        results['import_awg_data'] = bench_awg(rp, max(n // 10, 2))
+        results['dio_bulk_set'] = bench_dio(rp, n)
+        rp.close()
+    info = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'quick': quick, 'latency': latency}
+    return {'info': info, 'results': results}
+
+def _print_results(results, indent=''):
+    for key, val in results.items():
+        if 'median' in val:
+            rates = ['{} {:.4g}'.format(k, v) for k, v in val.items() if k.endswith('_per_s')]
+            print('{}{}: {:.2f} us'.format(indent, key, val['median'] * 1e6), *rates)
+        else:
+            print(indent + key + ':')
+            _print_results(val, indent + '  ')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the rpnacs client against the simulator')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    parser.add_argument('--quick', action='store_true', help='fewer repeats')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated round trip latency in seconds')
+    args = parser.parse_args()
+    res = run(args.quick, args.latency)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(res, f, indent=1)
+    if args.json:
+        json.dump(res, sys.stdout, indent=1)
+        print()
+    else:
+        _print_results(res['results'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import threading
+import time
+from . import utils
+from .instrumentation import Histogram
+
+class DIOWatcher:
+    def __init__(self, dio, pins, rate=200, debounce=2, callback=None, queue=None, lock=None):
+        # Background thread watching input pins of the DIOController dio for edges.
+        # pins: identifiers like 'DIO3_N' or 'LED0', or (num, pin_type) tuples. They should be set to IN.
+        # rate: samples per second. All pins are read with a single pipelined exchange per sample.
+        # debounce: number of consecutive samples a new level has to be seen for to count as an edge.
+        # callback(event) is called from the watcher thread for each edge, and the event is put on queue if given.
+        # An event is a dict of pin, state (the new level), edge ('rising' or 'falling'),
+        # time (time.time() of the sample accepting the edge) and latency (seconds from the first sample
+        # seeing the new level to the callbacks being called, the debounce and processing delay).
+        # lock is held during each exchange, the connection lock of dio.rp by default, so the connection can be
+        # used by other threads meanwhile. Pass the lock other users hold for their whole exchanges, if any.
+        self.dio = dio
+        self.pins = [pin if isinstance(pin, str) else 'DIO' + str(int(pin[0])) + '_' + pin[1] for pin in pins]
+        self.period = 1.0 / rate
+        self.debounce = max(int(debounce), 1)
+        self.callbacks = [] if callback is None else [callback]
+        self.queue = queue
+        self.lock = dio.rp.lock if lock is None else lock
+
+        self.states = {} # debounced level of each pin
+        self._candidates = {} # pin: (level, consecutive samples, perf_counter of the first)
+        # Statistics: samples taken, edges seen, samples late by more than a period,
+        # time of each exchange and edge latencies
+        self.samples = 0
+        self.edges = 0
+        self.overruns = 0
+        self.sample_time = Histogram()
+        self.latency = Histogram()
+        self.error = None # last exception of the thread or of a callback
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='DIOWatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def stats(self):
+        # Statistics as a dict
+        return {'samples': self.samples, 'edges': self.edges, 'overruns': self.overruns,
+                'sample_time': self.sample_time.snapshot(), 'latency': self.latency.snapshot()}
+
+    def sample(self):
+        # Read all pins once, returns a dict of pin: level, pins that failed to read are left out
+        t0 = time.perf_counter()
+        with self.lock:
+            vals = utils.query_many(self.dio.rp, [('DIG:PIN? ' + pin, int) for pin in self.pins])
+        self.sample_time.observe(time.perf_counter() - t0)
+        self.samples += 1
+        return {pin: val for pin, (err_flag, val) in zip(self.pins, vals) if not err_flag}
+
+    def _run(self):
+        next_tick = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                levels = self.sample()
+            except Exception as e:
+                # connection lost, nothing left to watch
+                self.error = e
+                return
+            self._update(levels, time.perf_counter(), time.time())
+            next_tick += self.period
+            delay = next_tick - time.perf_counter()
+            if delay < -self.period:
+                # too slow for the rate, don't try to catch up with a burst of samples
+                self.overruns += 1
+                next_tick = time.perf_counter()
+            elif delay > 0:
+                self._stop.wait(delay)
+
+    def _update(self, levels, t, timestamp):
+        # Debounce the levels of a sample taken at t
+        for pin, level in levels.items():
+            if pin not in self.states:
+                # first sample sets the initial level, no edge
+                self.states[pin] = level
+                continue
+            if level == self.states[pin]:
+                self._candidates.pop(pin, None)
+                continue
+            cand_level, count, first = self._candidates.get(pin, (level, 0, t))
+            if cand_level != level:
+                count, first = 0, t
+            count += 1
+            if count < self.debounce:
+                self._candidates[pin] = (level, count, first)
+                continue
+            self._candidates.pop(pin, None)
+            self.states[pin] = level
+            self._fire({'pin': pin, 'state': level, 'edge': 'rising' if level else 'falling',
+                        'time': timestamp}, first)
+
+    def _fire(self, event, first):
+        self.edges += 1
+        event['latency'] = time.perf_counter() - first
+        self.latency.observe(event['latency'])
+        for callback in self.callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                self.error = e
+        if self.queue is not None:
+            self.queue.put(event)
@@ -0,0 +1,85 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+from . import redpitaya_scpi as scpi
+from .scope import Scope
+from .FuncGenerator import FuncGenerator
+from .DIOController import DIOController
+
+class FleetDevice:
+    def __init__(self, name, rp):
+        # One Red Pitaya of a Fleet, with its own connection and instrument objects
+        self.name = name
+        self.rp = rp
+        self.scope = Scope(rp)
+        self.fgen = FuncGenerator(rp)
+        self.dio = DIOController(rp)
+
+class Fleet:
+    def __init__(self, hosts, timeout=None, port=5000):
+        # hosts is a list of IP addresses, or a dict of name: IP address.
+        # An address can also be a (host, port) tuple, for devices not on the default port.
+        # Each device gets its own connection, and calls on different devices run in parallel in a thread pool.
+        # Socket calls release the GIL, so acquisitions on N devices take about as long as on one.
+        if not isinstance(hosts, dict):
+            hosts = {host: host for host in hosts}
+        # If a device can't be reached, the other connections and the pool are closed before re-raising.
+        self.pool = ThreadPoolExecutor(max_workers=max(1, len(hosts)))
+        futures = {name: self.pool.submit(self._connect, host, timeout, port) for name, host in hosts.items()}
+        wait(futures.values())
+        errors = [future.exception() for future in futures.values() if future.exception() is not None]
+        if errors:
+            for future in futures.values():
+                if future.exception() is None:
+                    future.result().close()
+            self.pool.shutdown()
+            raise errors[0]
+        self.devices = {name: FleetDevice(name, future.result()) for name, future in futures.items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __getitem__(self, name):
+        return self.devices[name]
+
+    def __len__(self):
+        return len(self.devices)
+
+    def close(self):
+        for dev in self.devices.values():
+            dev.rp.close()
+        self.pool.shutdown()
+
+    def _connect(self, host, timeout, port):
+        if isinstance(host, tuple):
+            host, port = host
+        return scpi.scpi(host, timeout=timeout, port=port)
+
+    def _map(self, fn, items):
+        # Run fn(item) for each value of the dict items in parallel, returns a dict with the same keys.
+        # Exceptions are raised once every call has finished.
+        futures = {name: self.pool.submit(fn, item) for name, item in items.items()}
+        wait(futures.values())
+        return {name: future.result() for name, future in futures.items()}
+
+    def configure_all(self, fn, *args, **kwargs):
+        # Call fn(device, *args, **kwargs) on every device in parallel, device being a FleetDevice.
+        # Returns a dict of name: return value of fn
+        return self._map(lambda dev: fn(dev, *args, **kwargs), self.devices)
+
+    def acquire_all(self, timeout=60, holdoff=0.005):
+        # Acquire one trace on every device in parallel.
+        # Returns a dict of name: dict with
+        #   ts: time points, data: channels stacked into a (2, nsamples) array,
+        #   start: time.time() at which the acquisition started, elapsed: duration of the acquisition in seconds
+        return self._map(lambda dev: self._acquire(dev, timeout, holdoff), self.devices)
+
+    def _acquire(self, dev, timeout, holdoff):
+        start = time.time()
+        t0 = time.perf_counter()
+        ts, ch1, ch2 = dev.scope.acquire_trace(timeout, holdoff)
+        elapsed = time.perf_counter() - t0
+        return {'ts': ts, 'data': np.stack((ch1, ch2)), 'start': start, 'elapsed': elapsed}
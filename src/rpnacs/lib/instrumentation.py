@@ -0,0 +1,246 @@
+import bisect
+import collections
+import contextlib
+import functools
+import json
+import re
+import threading
+import time
+
+# Latency buckets in seconds, 1-2-5 steps from 1 us to 50 s
+latency_buckets = [m * 10.0**e for e in range(-6, 2) for m in (1, 2, 5)]
+
+def command_type(msg):
+    # Command type of an SCPI message for grouping statistics: the header without arguments,
+    # channel and pin numbers replaced by n, so ACQ:SOUR1:DATA? and ACQ:SOUR2:DATA? are counted together
+    return re.sub(r'\d+', 'n', msg.split(' ', 1)[0].lstrip(':').upper())
+
+class Histogram:
+    def __init__(self, bounds=latency_buckets):
+        # Counts of values <= each bound, the last count is for values above all bounds
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, val):
+        self.counts[bisect.bisect_left(self.bounds, val)] += 1
+        self.sum += val
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q quantile, inf if it is in the overflow bucket
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= target:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+                'buckets': dict(zip([str(b) for b in self.bounds] + ['+Inf'], self.counts))}
+
+class CommandStats:
+    def __init__(self):
+        self.sent = 0
+        self.bytes_sent = 0
+        self.replies = 0
+        self.bytes_received = 0
+        self.errors = 0
+        self.first_byte = Histogram() # query sent -> first byte of the reply received
+        self.transfer = Histogram() # first byte -> reply complete
+
+    def snapshot(self):
+        return {'sent': self.sent, 'bytes_sent': self.bytes_sent, 'replies': self.replies,
+                'bytes_received': self.bytes_received, 'errors': self.errors,
+                'first_byte': self.first_byte.snapshot(), 'transfer': self.transfer.snapshot()}
+
+class ScpiStats:
+    def __init__(self, host='', delimiter='\r\n'):
+        # Statistics of one scpi connection, enabled with scpi.enable_stats().
+        # Replies are matched to queries in the order they were sent, as the server answers them.
+        self.host = host
+        self.delimiter = delimiter
+        self.commands = collections.defaultdict(CommandStats)
+        self.operations = collections.defaultdict(Histogram)
+        self._queries = collections.deque() # (command type, send time) of queries not answered yet
+        self._lock = threading.Lock()
+
+    def sent(self, msgs, t):
+        # msgs were sent in a single write at time t. Each counts its own bytes and a delimiter.
+        with self._lock:
+            for msg in msgs:
+                key = command_type(msg)
+                stats = self.commands[key]
+                stats.sent += 1
+                stats.bytes_sent += len(msg.encode('utf-8')) + len(self.delimiter)
+                if '?' in key:
+                    self._queries.append((key, t))
+
+    def received(self, nbytes, error, t_first, t_done):
+        # A reply of nbytes was received, its first byte arrived at t_first and it was complete at t_done
+        with self._lock:
+            key, t_sent = self._queries.popleft() if self._queries else ('?', t_first)
+            stats = self.commands[key]
+            stats.replies += 1
+            stats.bytes_received += nbytes
+            stats.errors += error
+            # bytes received before the query was sent belong to it only if the reply was already buffered
+            t_first = max(t_first, t_sent)
+            stats.first_byte.observe(t_first - t_sent)
+            stats.transfer.observe(t_done - t_first)
+
+    def operation(self, name, dt):
+        # A higher level operation, e.g. an acquisition made of several commands, took dt seconds
+        with self._lock:
+            self.operations[name].observe(dt)
+
+    @contextlib.contextmanager
+    def annotate(self, name):
+        # Time the with block as operation name
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.operation(name, time.perf_counter() - t0)
+
+    def reset(self):
+        with self._lock:
+            self.commands.clear()
+            self.operations.clear()
+            self._queries.clear()
+
+    def snapshot(self):
+        # All statistics as a dict of plain values
+        with self._lock:
+            commands = {key: stats.snapshot() for key, stats in self.commands.items()}
+            operations = {name: hist.snapshot() for name, hist in self.operations.items()}
+        totals = {key: sum(stats[key] for stats in commands.values())
+                  for key in ['sent', 'bytes_sent', 'replies', 'bytes_received', 'errors']}
+        return {'host': self.host, 'totals': totals, 'commands': commands, 'operations': operations}
+
+    def prometheus(self, prefix='rpnacs'):
+        # Statistics in the Prometheus text exposition format
+        snap = self.snapshot()
+        host = _label_value(snap['host'])
+        lines = []
+        counters = [('sent', 'scpi_commands_total', 'Commands sent'),
+                    ('bytes_sent', 'scpi_sent_bytes_total', 'Bytes sent'),
+                    ('replies', 'scpi_replies_total', 'Replies received'),
+                    ('bytes_received', 'scpi_received_bytes_total', 'Bytes received'),
+                    ('errors', 'scpi_errors_total', 'ERR! replies received')]
+        for key, name, doc in counters:
+            lines.append('# HELP {}_{} {}'.format(prefix, name, doc))
+            lines.append('# TYPE {}_{} counter'.format(prefix, name))
+            for cmd, stats in snap['commands'].items():
+                lines.append('{}_{}{{host="{}",command="{}"}} {}'.format(prefix, name, host, _label_value(cmd),
+                                                                       stats[key]))
+        hists = [('first_byte', 'scpi_first_byte_seconds', 'Time from sending a query to the first byte of its reply'),
+                 ('transfer', 'scpi_transfer_seconds', 'Time from the first to the last byte of a reply')]
+        for key, name, doc in hists:
+            lines.append('# HELP {}_{} {}'.format(prefix, name, doc))
+            lines.append('# TYPE {}_{} histogram'.format(prefix, name))
+            for cmd, stats in snap['commands'].items():
+                if stats[key]['count']:
+                    labels = 'host="{}",command="{}"'.format(host, _label_value(cmd))
+                    lines.extend(_prometheus_histogram(prefix + '_' + name, labels, stats[key]))
+        name = prefix + '_operation_seconds'
+        lines.append('# HELP {} Duration of annotated operations'.format(name))
+        lines.append('# TYPE {} histogram'.format(name))
+        for op, hist in snap['operations'].items():
+            labels = 'host="{}",operation="{}"'.format(host, _label_value(op))
+            lines.extend(_prometheus_histogram(name, labels, hist))
+        return '\n'.join(lines) + '\n'
+
+class ScpiTracer:
+    def __init__(self, maxlen=100000, host=''):
+        # Transcript of one scpi connection, enabled with scpi.enable_trace().
+        # Keeps the last maxlen events, each with perf_counter timestamps, the thread and the number of bytes.
+        # Export with chrome_trace() or save() and open in chrome://tracing or ui.perfetto.dev
+        # to see which thread held the connection when.
+        self.host = host
+        self.events = collections.deque(maxlen=maxlen)
+        self.threads = {} # thread id: name
+        self.start = time.perf_counter()
+        self._queries = collections.deque(maxlen=maxlen) # headers of queries not answered yet
+
+    def _thread(self):
+        thread = threading.current_thread()
+        if thread.ident not in self.threads:
+            self.threads[thread.ident] = thread.name
+        return thread.ident
+
+    def tx(self, msgs, nbytes, t0, t1):
+        # msgs were sent in a single write of nbytes, from t0 to t1
+        for msg in msgs:
+            header = msg.split(' ', 1)[0]
+            if '?' in header:
+                self._queries.append(header)
+        name = msgs[0] if len(msgs) == 1 else '{} (+{})'.format(msgs[0], len(msgs) - 1)
+        self.events.append(('tx', name, t0, t1, self._thread(), nbytes, msgs))
+
+    def rx(self, kind, nbytes, error, t0, t1):
+        # A reply of nbytes was received by the kind receive function, called at t0 and returning at t1
+        query = self._queries.popleft() if self._queries else '?'
+        self.events.append((kind, query, t0, t1, self._thread(), nbytes, error))
+
+    def span(self, name, t0, t1):
+        # A higher level operation lasted from t0 to t1
+        self.events.append(('op', name, t0, t1, self._thread(), 0, None))
+
+    def clear(self):
+        self.events.clear()
+        self._queries.clear()
+
+    def chrome_trace(self):
+        # Events in the Chrome trace event format, as a dict ready for json.dump
+        trace = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'scpi ' + str(self.host)}}]
+        for tid, name in list(self.threads.items()):
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}})
+        for kind, name, t0, t1, tid, nbytes, detail in list(self.events):
+            event = {'name': name, 'cat': kind, 'ph': 'X', 'pid': 1, 'tid': tid,
+                     'ts': (t0 - self.start) * 1e6, 'dur': (t1 - t0) * 1e6}
+            if kind == 'tx':
+                event['name'] = 'tx ' + name
+                event['args'] = {'bytes': nbytes, 'msgs': [msg[:200] for msg in detail]}
+            elif kind != 'op':
+                event['name'] = kind + ' ' + name
+                event['args'] = {'bytes': nbytes, 'error': bool(detail)}
+            trace.append(event)
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def save(self, path):
+        # Write the Chrome trace JSON to path
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+def _label_value(val):
+    return str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _prometheus_histogram(name, labels, hist):
+    lines = []
+    total = 0
+    for le, count in hist['buckets'].items():
+        total += count
+        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, le, total))
+    lines.append('{}_sum{{{}}} {}'.format(name, labels, hist['sum']))
+    lines.append('{}_count{{{}}} {}'.format(name, labels, hist['count']))
+    return lines
+
+def annotated(name):
+    # Decorator for instrument methods, times each call as operation name with self.rp.annotate
+    # if the statistics or the transcript of self.rp are enabled
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            if getattr(self.rp, '_stats', None) is None and getattr(self.rp, '_tracer', None) is None:
+                return fn(self, *args, **kwargs)
+            with self.rp.annotate(name):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
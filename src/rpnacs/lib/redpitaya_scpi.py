@@ -1,24 +1,102 @@
 """SCPI access to Red Pitaya."""
 
+import contextlib
 import socket
+import threading
+import time
+import weakref
+from .instrumentation import ScpiStats, ScpiTracer
 
 __author__ = "Luka Golinar, Iztok Jeras"
 __copyright__ = "Copyright 2015, Red Pitaya"
 
-class scpi (object):
+class BatchQueue(object):
+    """Queue of the messages sent inside batch() blocks, shared by scpi and async_scpi.AsyncScpi.
+    tx_txt appends to _tx_pending while _tx_depth is non zero, flush() sends _tx_take() with one write.
+    """
+
+    def __init__(self):
+        self._tx_depth   = 0
+        self._tx_join    = False
+        self._tx_pending = []
+
+    def _tx_take(self):
+        """Empty the batch queue and return its messages encoded for a single write."""
+        msgs = self._tx_pending
+        self._tx_pending = []
+        if self._tx_join:
+            # Compound SCPI lines. Headers after ';' are made absolute with a leading ':'.
+            # A query ends its line, so every line still gets exactly one reply.
+            lines = []
+            line = []
+            for msg in msgs:
+                if line and not msg.startswith((':', '*')):
+                    msg = ':' + msg
+                line.append(msg)
+                if '?' in msg.split(' ', 1)[0]:
+                    lines.append(';'.join(line))
+                    line = []
+            if line:
+                lines.append(';'.join(line))
+            msgs = lines
+        return (self.delimiter.join(msgs) + self.delimiter).encode('utf-8')
+
+    @contextlib.contextmanager
+    def batch(self, join=False):
+        """Queue the messages sent inside the with block, flush() sends them when the outermost block ends."""
+        if self._tx_depth == 0:
+            self._tx_join = join
+        self._tx_depth += 1
+        try:
+            yield self
+        finally:
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                self.flush()
+
+class scpi (BatchQueue):
     """SCPI class used to access Red Pitaya over an IP network."""
     delimiter = '\r\n'
+    _delimiter = b'\r\n'
 
-    def __init__(self, host, timeout=None, port=5000):
+    def __init__(self, host, timeout=None, port=5000, bufsize=65536):
         """Initialize object and open IP connection.
         Host IP should be a string in parentheses, like '192.168.1.100'.
+        bufsize is the initial size of the receive buffer, it grows if a reply does not fit.
         """
         self.host    = host
         self.port    = port
         self.timeout = timeout
 
+        # Receive buffer, reused for every reply.
+        # Bytes between _rx_start and _rx_end have been received but not consumed yet.
+        self._rx_buf   = bytearray(bufsize)
+        self._rx_start = 0
+        self._rx_end   = 0
+
+        # Held for each query/reply exchange and batch() block, so several threads can share the connection.
+        # Hold it around longer sequences of commands and replies that must not be interleaved.
+        self.lock = threading.RLock()
+
+        # Messages queued inside a batch() block, sent by flush()
+        super().__init__()
+
+        # StateCaches of the instruments using this connection, cleared by rst() since *RST resets every setting
+        self.caches = weakref.WeakSet()
+
+        # Statistics, None unless enable_stats() was called.
+        # _rx_first is when the first of the unconsumed bytes in the receive buffer arrived, _rx_last the last.
+        self._stats    = None
+        self._rx_first = 0.0
+        self._rx_last  = 0.0
+        # Tracer, None unless enable_trace() was called. _rx_t0 is when the current receive call started.
+        self._tracer   = None
+        self._rx_t0    = 0.0
+
         try:
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Commands are small and often followed by a query, don't let Nagle hold them back
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
             if timeout is not None:
                 self._socket.settimeout(timeout)
@@ -38,47 +116,223 @@ class scpi (object):
         """Close IP connection."""
         self.__del__()
 
+    def _recv(self, chunksize = 4096):
+        """Receive at least one more byte into the receive buffer.
+        Makes room for chunksize bytes first, by moving unconsumed bytes to the front or growing the buffer.
+        """
+        if self._tx_pending:
+            # a reply is expected, so queued queries must go out first
+            self.flush()
+        if self._rx_start == self._rx_end:
+            self._rx_start = self._rx_end = 0
+        elif len(self._rx_buf) - self._rx_end < chunksize:
+            pending = self._rx_end - self._rx_start
+            self._rx_buf[:pending] = self._rx_buf[self._rx_start:self._rx_end]
+            self._rx_start = 0
+            self._rx_end   = pending
+        if len(self._rx_buf) - self._rx_end < chunksize:
+            self._rx_buf.extend(bytes(max(chunksize, len(self._rx_buf))))
+        with memoryview(self._rx_buf) as view:
+            n = self._socket.recv_into(view[self._rx_end:])
+        if n == 0:
+            raise ConnectionError('SCPI >> connection closed by {!s:s}:{:d}'.format(self.host, self.port))
+        if self._stats is not None:
+            self._rx_last = time.perf_counter()
+            if self._rx_start == self._rx_end:
+                self._rx_first = self._rx_last
+        self._rx_end += n
+        return n
+
+    def _rx_line(self, chunksize = 4096):
+        """Wait for a complete line in the receive buffer, return the position of its delimiter.
+        Only newly received bytes are scanned for the delimiter.
+        """
+        scanned = 0
+        while 1:
+            # look for the last byte of the delimiter, single byte search is a plain memchr
+            pos = self._rx_buf.find(b'\n', self._rx_start + scanned, self._rx_end)
+            if pos >= 0:
+                if pos > self._rx_start and self._rx_buf[pos - 1] == ord('\r'):
+                    return pos - 1
+                scanned = pos + 1 - self._rx_start
+                continue
+            scanned = self._rx_end - self._rx_start
+            self._recv(chunksize)
+
+    def _rx_fill(self, nbytes, chunksize = 4096):
+        """Wait until at least nbytes unconsumed bytes are in the receive buffer."""
+        while self._rx_end - self._rx_start < nbytes:
+            self._recv(max(chunksize, nbytes))
+
     def rx_txt(self, chunksize = 4096):
         """Receive text string and return it after removing the delimiter."""
-        msg = ''
-        while 1:
-            chunk = self._socket.recv(chunksize).decode('utf-8') # Receive chunk size of 2^n preferably
-            msg += chunk
-            if (len(msg) and msg[-2:] == self.delimiter):
-                break
-        return msg[:-2]
+        if self._tracer is not None:
+            self._rx_t0 = time.perf_counter()
+        pos = self._rx_line(chunksize)
+        with memoryview(self._rx_buf) as view:
+            msg = str(view[self._rx_start:pos], 'utf-8')
+        if self._stats is not None or self._tracer is not None:
+            self._rx_done('rx_txt', pos + len(self._delimiter) - self._rx_start, msg.startswith('ERR!'))
+        self._rx_start = pos + len(self._delimiter)
+        return msg
 
     def rx_arb(self):
-        numOfBytes = 0
-        """ Recieve binary data from scpi server"""
-        str=b''
-        while (len(str) != 1):
-            str = (self._socket.recv(1))
-        if not (str == b'#'):
-            return False
-        str=b''
-        while (len(str) != 1):
-            str = (self._socket.recv(1))
-        numOfNumBytes = int(str)
-        if not (numOfNumBytes > 0):
-            return False
-        str=b''
-        while (len(str) != numOfNumBytes):
-            str += (self._socket.recv(1))
-        numOfBytes = int(str)
-        str=b''
-        while (len(str) != numOfBytes):
-            str += (self._socket.recv(4096))
-        return str
+        """ Recieve binary data from scpi server
+        Returns a bytearray with the data block, or False if the reply is not a binary block.
+        """
+        if self._tracer is not None:
+            self._rx_t0 = time.perf_counter()
+        self._rx_fill(2)
+        if self._rx_buf[self._rx_start] != ord('#'):
+            # not a binary block (ERR! reply for instance), drop the rest of the line
+            return self._rx_drop()
+        numOfNumBytes = self._rx_buf[self._rx_start + 1] - ord('0')
+        if not (0 < numOfNumBytes <= 9):
+            return self._rx_drop()
+        self._rx_fill(2 + numOfNumBytes)
+        numOfBytes = int(self._rx_buf[self._rx_start + 2:self._rx_start + 2 + numOfNumBytes])
+        self._rx_start += 2 + numOfNumBytes
+
+        # Copy whatever is already buffered, then receive the rest directly into the result.
+        data = bytearray(numOfBytes)
+        have = min(numOfBytes, self._rx_end - self._rx_start)
+        data[:have] = self._rx_buf[self._rx_start:self._rx_start + have]
+        self._rx_start += have
+        with memoryview(data) as view:
+            while have < numOfBytes:
+                n = self._socket.recv_into(view[have:])
+                if n == 0:
+                    raise ConnectionError('SCPI >> connection closed by {!s:s}:{:d}'.format(self.host, self.port))
+                have += n
+        # binary block is terminated by the delimiter as well
+        self._rx_fill(len(self._delimiter))
+        self._rx_start += len(self._delimiter)
+        if self._stats is not None or self._tracer is not None:
+            self._rx_done('rx_arb', 2 + numOfNumBytes + numOfBytes + len(self._delimiter), False)
+        return data
+
+    def _rx_drop(self):
+        """Drop the rest of a reply line that is not a binary block, return False."""
+        pos = self._rx_line() + len(self._delimiter)
+        if self._stats is not None or self._tracer is not None:
+            self._rx_done('rx_arb', pos - self._rx_start, True)
+        self._rx_start = pos
+        return False
+
+    def _rx_done(self, kind, nbytes, error):
+        """Record a complete reply of nbytes received by the kind receive function in the statistics and trace."""
+        t = time.perf_counter()
+        if self._stats is not None:
+            self._stats.received(nbytes, error, self._rx_first, t)
+            # bytes left in the buffer arrived by the last receive at the latest
+            self._rx_first = self._rx_last
+        if self._tracer is not None:
+            self._tracer.rx(kind, nbytes, error, self._rx_t0, t)
+
+    def _tx_done(self, msgs, nbytes, t0):
+        """Record msgs sent in a single write of nbytes started at t0 in the statistics and trace."""
+        t = time.perf_counter()
+        if self._stats is not None:
+            self._stats.sent(msgs, t)
+        if self._tracer is not None:
+            self._tracer.tx(msgs, nbytes, t0, t)
 
     def tx_txt(self, msg):
-        """Send text string ending and append delimiter."""
-        return self._socket.sendall((msg + self.delimiter).encode('utf-8')) # was send(().encode('utf-8'))
+        """Send text string ending and append delimiter.
+        Inside a batch() block the message is queued instead and sent when the block ends.
+        The connection lock is held, so a message from another thread never ends up in a batch of this one.
+        """
+        with self.lock:
+            if self._tx_depth:
+                self._tx_pending.append(msg)
+                return
+            data = (msg + self.delimiter).encode('utf-8')
+            t0 = time.perf_counter() if self._tracer is not None else 0.0
+            ret = self._socket.sendall(data) # was send(().encode('utf-8'))
+            if self._stats is not None or self._tracer is not None:
+                self._tx_done([msg], len(data), t0)
+            return ret
+
+    def flush(self):
+        """Send all queued messages with a single write."""
+        with self.lock:
+            if self._tx_pending:
+                msgs = self._tx_pending
+                data = self._tx_take()
+                t0 = time.perf_counter() if self._tracer is not None else 0.0
+                self._socket.sendall(data)
+                if self._stats is not None or self._tracer is not None:
+                    self._tx_done(msgs, len(data), t0)
+
+    @contextlib.contextmanager
+    def batch(self, join=False):
+        """Queue the messages sent inside the with block and send them with one write when it ends.
+        With join=True the messages are also joined into compound SCPI lines separated by ';',
+        for servers that support it. Blocks can be nested, the outermost one flushes.
+        Receiving a reply inside the block flushes the queue first.
+        The connection lock is held for the whole block.
+        """
+        with self.lock:
+            with super().batch(join):
+                yield self
 
     def txrx_txt(self, msg):
         """Send/receive text string."""
-        self.tx_txt(msg)
-        return self.rx_txt()
+        with self.lock:
+            self.tx_txt(msg)
+            return self.rx_txt()
+
+    def txrx_many(self, msgs):
+        """Send several queries with one write, then receive the replies in order.
+        Costs a single network round trip instead of one per query.
+        """
+        with self.lock:
+            with self.batch():
+                for msg in msgs:
+                    self.tx_txt(msg)
+            return [self.rx_txt() for msg in msgs]
+
+    def enable_stats(self, stats=None):
+        """Start recording per command statistics, see instrumentation.ScpiStats.
+        Returns the ScpiStats object, a new one unless stats is given.
+        """
+        self._stats = ScpiStats(self.host, self.delimiter) if stats is None else stats
+        return self._stats
+
+    def disable_stats(self):
+        """Stop recording statistics."""
+        self._stats = None
+
+    def enable_trace(self, maxlen=100000, tracer=None):
+        """Start recording a transcript of the commands sent and replies received, see instrumentation.ScpiTracer.
+        The last maxlen events are kept. Returns the ScpiTracer object, a new one unless tracer is given.
+        """
+        self._tracer = ScpiTracer(maxlen, self.host) if tracer is None else tracer
+        return self._tracer
+
+    def disable_trace(self):
+        """Stop recording the transcript."""
+        self._tracer = None
+
+    def annotate(self, name):
+        """Context manager timing the commands in the with block as operation name,
+        when statistics or the transcript are enabled.
+        """
+        if self._stats is None and self._tracer is None:
+            return contextlib.nullcontext()
+        return self._annotate(name)
+
+    @contextlib.contextmanager
+    def _annotate(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            t = time.perf_counter()
+            if self._stats is not None:
+                self._stats.operation(name, t - t0)
+            if self._tracer is not None:
+                self._tracer.span(name, t0, t)
 
 # IEEE Mandated Commands
 
@@ -111,7 +365,9 @@ class scpi (object):
         return self.txrx_txt('*OPC?')
 
     def rst(self):
-        """Reset Command"""
+        """Reset Command. Clears the settings cached by the instruments on this connection."""
+        for cache in self.caches:
+            cache.clear()
         return self.tx_txt('*RST')
 
     def sre(self):
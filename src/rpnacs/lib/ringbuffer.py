@@ -0,0 +1,103 @@
+import time
+import numpy as np
+
+class TraceRingBuffer:
+    def __init__(self, capacity, nsamples, channels=2, dtype=np.float64):
+        # Fixed size history of the last capacity traces, each of shape (channels, nsamples).
+        # All memory is allocated here, appending a trace overwrites the oldest one once the buffer is full.
+        # A running sum and sum of squares over the traces in the buffer make mean() and var() cost O(nsamples).
+        self.capacity = capacity
+        self.data = np.zeros((capacity, channels, nsamples), dtype=dtype)
+        self.timestamps = np.zeros(capacity)
+        self.head = 0 # slot the next trace goes into
+        self.count = 0
+        self._pending = False
+        self._sum = np.zeros((channels, nsamples))
+        self._sumsq = np.zeros((channels, nsamples))
+        self._commits = 0
+
+    def __len__(self):
+        return self.count
+
+    def next_slot(self):
+        # View of the slot the next trace goes into, to be filled in place and then commit()ed.
+        # If the buffer is full, the oldest trace leaves the buffer now.
+        if not self._pending:
+            if self.count == self.capacity:
+                old = self.data[self.head]
+                self._sum -= old
+                self._sumsq -= np.square(old, dtype=np.float64)
+                self.count -= 1
+            self._pending = True
+        return self.data[self.head]
+
+    def commit(self, timestamp=None):
+        # Add the trace written into next_slot() to the buffer
+        new = self.data[self.head]
+        self._sum += new
+        self._sumsq += np.square(new, dtype=np.float64)
+        self.timestamps[self.head] = time.time() if timestamp is None else timestamp
+        self.head = (self.head + 1) % self.capacity
+        self.count += 1
+        self._pending = False
+        # Recompute the running sums once per turn of the buffer so rounding errors don't pile up in long runs
+        self._commits += 1
+        if self._commits >= self.capacity:
+            self._commits = 0
+            self._recompute_sums()
+
+    def _recompute_sums(self):
+        # Sums over the traces in the buffer, accumulated slot by slot so no temporary the size of the history is made
+        self._sum[...] = 0
+        self._sumsq[...] = 0
+        for i in range(self.head - self.count, self.head):
+            trace = self.data[i % self.capacity]
+            self._sum += trace
+            self._sumsq += np.square(trace, dtype=np.float64)
+
+    def append(self, traces, timestamp=None):
+        # Copy traces, e.g. (ch1, ch2), into the buffer
+        self.next_slot()[...] = traces
+        self.commit(timestamp)
+
+    def acquire(self, scope, timeout=60, holdoff=0.005):
+        # Acquire a trace with scope straight into the buffer. Returns the time points.
+        ts, ch1, ch2 = scope.acquire_trace(timeout, holdoff, out=self.next_slot())
+        self.commit()
+        return ts
+
+    def last(self, k=1):
+        # The last k traces, oldest first, as a (k, channels, nsamples) array.
+        # This is a view of the buffer if the traces are contiguous in memory, a copy if they wrap around.
+        return self._window(self.data, k)
+
+    def last_timestamps(self, k=1):
+        # Timestamps of the last k traces, oldest first
+        return self._window(self.timestamps, k)
+
+    def _window(self, arr, k):
+        k = min(k, self.count)
+        start = (self.head - k) % self.capacity
+        if start + k <= self.capacity:
+            return arr[start:start + k]
+        return np.concatenate((arr[start:], arr[:self.head]))
+
+    def mean(self):
+        # Mean trace over the buffer
+        return self._sum / max(self.count, 1)
+
+    def var(self):
+        # Variance of each sample over the buffer
+        mean = self.mean()
+        return np.maximum(self._sumsq / max(self.count, 1) - mean**2, 0)
+
+    def std(self):
+        return np.sqrt(self.var())
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+        self._pending = False
+        self._sum[...] = 0
+        self._sumsq[...] = 0
+        self._commits = 0
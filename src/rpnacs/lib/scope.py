@@ -1,5 +1,7 @@
 import time
 from . import utils
+from .instrumentation import annotated
+from .timeaxis import TimeAxis
 import numpy as np
 
 class Scope:
@@ -13,15 +15,35 @@ class Scope:
         # trigger cache
         self.trig_cache = 'ACQ:TRIG NOW'
 
+        # data format and units cache, used to decode what the read functions get back.
+        # These are the defaults of the red pitaya after ACQ:RST
+        self.data_format = 'ASCII'
+        self.data_units = 'VOLTS'
+        # dtype of the arrays returned in ASCII format. Set to np.float32 to halve the memory of each trace.
+        self.ascii_dtype = np.float64
+
+        # Settings last set or read. Getters are served from here and setters skip values the device already has.
+        # The trigger source is not cached since the red pitaya disables it after each trigger.
+        self.state = utils.register_cache(rp, utils.StateCache())
+        # Time axis of the last (buffer size, decimation, trigger delay), see time_axis
+        self._time_axis = None
+        self._time_axis_key = None
+
+        # Statistics of the last trigger wait, see wait_trigger
+        self.wait_stats = {}
+        # Statistics of the running or last stream
+        self.stream_stats = {}
+
     ## Higher Level API
     def set_trigger(self, source, edge, level, delay=0):
         # set trigger source and edge type
         # returns None if inputs are incorrect
         if edge != 'PE' and edge != 'NE':
             return None
-        self.set_trig_lev(level)
-        self.set_trig_delay(delay)
-        ret = self.set_trig_source(source, edge)
+        with self.rp.batch():
+            self.set_trig_lev(level)
+            self.set_trig_delay(delay)
+            ret = self.set_trig_source(source, edge)
         self.trig_cache = ret
         return
 
@@ -37,6 +59,7 @@ class Scope:
             dec = res * self.sampling_rate
             # Now, we shift it to a power of 2.
             dec = 2**(np.floor(np.log2(dec))) # use floor to ensure resolution is better than the user specified one.
+            dec = min(dec, 2**16) # largest decimation of the device
         self.set_dec(dec)
         err_flag, res = self.get_dec()
         return res / self.sampling_rate
@@ -57,34 +80,130 @@ class Scope:
         return buf_size / self.sampling_rate * res
 
     def get_time_points(self):
+        # Sample times relative to the trigger of the current settings, see get_time_axis
+        return self.get_time_axis().array
+
+    def get_time_axis(self):
+        # TimeAxis of the current settings, t = 0 is the trigger.
+        # The settings come from the state cache, so once known this costs no round trip.
         err_flag, buf_size = self.get_buf_size()
         err_flag, dec = self.get_dec()
-        t_tot = (buf_size - 1) / self.sampling_rate * dec
-        ts = np.linspace(0, t_tot, buf_size)
-        return ts
-
-    def acquire_trace(self, timeout=60, holdoff = 0.005):
+        err_flag, trig_delay = self.get_trig_delay()
+        return self.time_axis(buf_size, dec, trig_delay)
+
+    def time_axis(self, buf_size, dec, trig_delay=0):
+        # TimeAxis for these settings, reused as long as they don't change
+        key = (buf_size, dec, trig_delay)
+        if key != self._time_axis_key:
+            self._time_axis = TimeAxis.from_acquisition(buf_size, dec, trig_delay, self.sampling_rate)
+            self._time_axis_key = key
+        return self._time_axis
+
+    @annotated('acquire_trace')
+    def acquire_trace(self, timeout=60, holdoff = 0.005, max_holdoff = 0.05, out=None):
         # Acquires a trace and waits based on the decimation and the length of the acquired data
         # Returns the times as well based on the set decimation
-        self.start_acq()
-        self.rp.tx_txt(self.trig_cache)
+        # See wait_trigger for holdoff and max_holdoff
+        # If out is given, e.g. a TraceRingBuffer slot, the channels are written into out[0] and out[1] and views of those are returned
+        # The times are relative to the trigger and the same read-only array is returned while the settings don't change
+        axis = self.get_time_axis()
+        with self.rp.batch():
+            self.start_acq()
+            self.rp.tx_txt(self.trig_cache)
         # wait for trigger with specified timeout
-        start_time = time.time()
-        cur_time = time.time()
-        while cur_time - start_time < timeout:
+        triggered = self.wait_trigger(axis.duration, timeout, holdoff, max_holdoff)
+        # stop and pipeline the data queries, so both channels cost a single round trip
+        with self.rp.lock:
+            with self.rp.batch():
+                if triggered:
+                    self.stop_acq()
+                self.rp.tx_txt('ACQ:SOUR1:DATA?')
+                self.rp.tx_txt('ACQ:SOUR2:DATA?')
+            err_flag, ch1 = self.rx_data()
+            err_flag, ch2 = self.rx_data()
+        if out is not None:
+            out[0] = ch1
+            out[1] = ch2
+            ch1, ch2 = out[0], out[1]
+
+        return axis.array, ch1, ch2
+
+    def stream(self, n=None, timeout=60, holdoff = 0.005, max_holdoff = 0.05):
+        # Generator acquiring traces back to back. Yields (timestamp, ts, ch1, ch2) for n traces, or forever if n is None.
+        # timestamp is the time.time() at which the trigger was seen.
+        # The next acquisition is armed as soon as both channels have been received, before they are decoded,
+        # so the device records trace N+1 while the host decodes trace N and the caller processes it.
+        # A trigger wait that times out counts as a dropped trigger and the trigger is armed again.
+        # Frames, dropped triggers, elapsed time and frame rate are kept up to date in self.stream_stats
+        axis = self.get_time_axis()
+        fill_time = axis.duration
+        ts = axis.array
+        self.stream_stats = {'frames': 0, 'dropped': 0, 'elapsed': 0.0, 'fps': 0.0}
+        start = time.perf_counter()
+        with self.rp.batch():
+            self.start_acq()
+            self.rp.tx_txt(self.trig_cache)
+        t_arm = time.perf_counter()
+        try:
+            while n is None or self.stream_stats['frames'] < n:
+                # the device has been recording since t_arm, only the rest of the fill time is left to wait
+                remaining = max(0, fill_time - (time.perf_counter() - t_arm))
+                if not self.wait_trigger(remaining, timeout, holdoff, max_holdoff):
+                    self.stream_stats['dropped'] += 1
+                    self.rp.tx_txt(self.trig_cache)
+                    t_arm = time.perf_counter()
+                    continue
+                timestamp = time.time()
+                with self.rp.lock:
+                    with self.rp.batch():
+                        self.stop_acq()
+                        self.rp.tx_txt('ACQ:SOUR1:DATA?')
+                        self.rp.tx_txt('ACQ:SOUR2:DATA?')
+                    raw1 = self.rx_data_raw()
+                    raw2 = self.rx_data_raw()
+                # re-arm, then decode while the device is recording
+                with self.rp.batch():
+                    self.start_acq()
+                    self.rp.tx_txt(self.trig_cache)
+                t_arm = time.perf_counter()
+                err_flag, ch1 = self.decode_data(*raw1)
+                err_flag, ch2 = self.decode_data(*raw2)
+                elapsed = time.perf_counter() - start
+                self.stream_stats['frames'] += 1
+                self.stream_stats['elapsed'] = elapsed
+                self.stream_stats['fps'] = self.stream_stats['frames'] / elapsed
+                yield timestamp, ts, ch1, ch2
+        finally:
+            self.stop_acq()
+
+    @annotated('wait_trigger')
+    def wait_trigger(self, fill_time=0, timeout=60, holdoff=0.005, max_holdoff=0.05):
+        # Wait for ACQ:TRIG:STAT? to report TD, for at most timeout seconds. Returns whether the trigger happened.
+        # The first query is sent after fill_time, the expected time for the acquisition to complete.
+        # Then the holdoff between queries doubles at each poll, up to max_holdoff.
+        # Statistics of the wait are stored in self.wait_stats:
+        # number of polls, total wait time and dead time, the time waited past fill_time.
+        start = time.perf_counter()
+        time.sleep(min(fill_time, timeout))
+        polls = 0
+        triggered = False
+        while True:
             err_flag, stat = self.get_trig_status()
+            polls += 1
+            elapsed = time.perf_counter() - start
             if stat == 'TD':
-                self.stop_acq()
+                triggered = True
                 break
-            time.sleep(holdoff) # holdoff before asking again
-            cur_time = time.time()
-        # get time points, at the moment t = 0 is the beginning of buffer which may not be the trigger location!
-        ts = self.get_time_points()
-
-        err_flag, ch1 = self.read_all_samples(1)
-        err_flag, ch2 = self.read_all_samples(2)
+            if elapsed >= timeout:
+                break
+            time.sleep(min(holdoff, timeout - elapsed)) # holdoff before asking again
+            holdoff = min(max(2 * holdoff, 1e-3), max_holdoff)
+        self.wait_stats = self._wait_stats(triggered, polls, time.perf_counter() - start, fill_time)
+        return triggered
 
-        return ts, ch1, ch2
+    def _wait_stats(self, triggered, polls, wait, fill_time):
+        return {'triggered': triggered, 'polls': polls, 'wait': wait,
+                'fill_time': fill_time, 'dead_time': max(0.0, wait - fill_time)}
 
     ## Lower Level API
     # Acquisition related commands
@@ -98,29 +217,33 @@ class Scope:
 
     def reset_acq(self):
         self.rp.tx_txt('ACQ:RST')
+        self.data_format = 'ASCII'
+        self.data_units = 'VOLTS'
+        self.state.clear()
         return
 
     # Decimation related commands
     def get_dec(self):
-        self.rp.tx_txt('ACQ:DEC?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, int(val)
+        return utils.query_cached(self.rp, self.state, 'dec', 'ACQ:DEC?', int)
 
     def set_dec(self, val):
         # Returns ERR! on error
         # Therefore, I will not error check and rely on a good caller or for the caller to check
-        self.rp.tx_txt('ACQ:DEC ' + str(int(val)))
+        # The device may not take every value, so the cache is cleared and get_dec reads back what it took.
+        # The trigger delay in ns depends on the decimation, it is read back too.
+        if self.state.get('dec') != int(val):
+            self.rp.tx_txt('ACQ:DEC ' + str(int(val)))
+            self.state.invalidate('dec', 'trig_delay_ns')
         return
 
     def get_avg(self):
         # Returns whether we are averaging over the time interval for decimation > 1
-        self.rp.tx_txt('ACQ:AVG?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, val
+        return utils.query_cached(self.rp, self.state, 'avg', 'ACQ:AVG?')
 
     def set_avg(self, val):
         # Set whether we are averaging over the time interval or not for decimation. Can use either ON or OFF.
-        self.rp.tx_txt('ACQ:AVG ' + str(val))
+        if self.state.changed('avg', str(val)):
+            self.rp.tx_txt('ACQ:AVG ' + str(val))
         return
 
     # Trigger related commands
@@ -156,125 +279,133 @@ class Scope:
         return ret_string
 
     def get_trig_status(self):
-        self.rp.tx_txt('ACQ:TRIG:STAT?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
+        err_flag, val = utils.rm_err(self.rp.txrx_txt('ACQ:TRIG:STAT?'))
         return err_flag, val
 
     def get_trig_delay(self):
         # Get trig delay in samples
-        self.rp.tx_txt('ACQ:TRIG:DLY?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, int(val)
+        return utils.query_cached(self.rp, self.state, 'trig_delay', 'ACQ:TRIG:DLY?', int)
 
     def set_trig_delay(self, val):
         # Set trig delay in samples
-        self.rp.tx_txt('ACQ:TRIG:DLY ' + str(int(val)))
+        if self.state.changed('trig_delay', int(val)):
+            self.state.invalidate('trig_delay_ns')
+            self.rp.tx_txt('ACQ:TRIG:DLY ' + str(int(val)))
         return
 
     def get_trig_delay_ns(self):
         # Get trig delay in ns
-        self.rp.tx_txt('ACQ:TRIG:DLY:NS?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, int(val)
+        return utils.query_cached(self.rp, self.state, 'trig_delay_ns', 'ACQ:TRIG:DLY:NS?', int)
 
     def set_trig_delay_ns(self, val):
         # Set trig delay in ns
-        self.rp.tx_txt('ACQ:TRIG:DLY:NS ' + str(int(val)))
+        if self.state.changed('trig_delay_ns', int(val)):
+            self.state.invalidate('trig_delay')
+            self.rp.tx_txt('ACQ:TRIG:DLY:NS ' + str(int(val)))
         return
 
     def get_trig_hyst(self):
         # Get trigger hysteresis value in volts
-        self.rp.tx_txt('ACQ:TRIG:HYST?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, float(val)
+        return utils.query_cached(self.rp, self.state, 'trig_hyst', 'ACQ:TRIG:HYST?', float)
 
     def set_trig_hyst(self, val):
         # Set trigger hysteresis value in volts
-        self.rp.tx_txt('ACQ:TRIG:HYST ' + str(val))
+        if self.state.changed('trig_hyst', float(val)):
+            self.rp.tx_txt('ACQ:TRIG:HYST ' + str(val))
         return
 
     def get_trig_lev(self):
         # Get trigger level in volts
-        self.rp.tx_txt('ACQ:TRIG:LEV?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, float(val)
+        return utils.query_cached(self.rp, self.state, 'trig_lev', 'ACQ:TRIG:LEV?', float)
 
     def set_trig_lev(self, val):
         # Set trigger level in volts
-        self.rp.tx_txt('ACQ:TRIG:LEV ' + str(val))
+        if self.state.changed('trig_lev', float(val)):
+            self.rp.tx_txt('ACQ:TRIG:LEV ' + str(val))
         return
 
     # Data acquisition commands
     def get_data_units(self):
         # Get units in which data is returned
-        self.rp.tx_txt('ACQ:DATA:UNITS?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
+        err_flag, val = utils.rm_err(self.rp.txrx_txt('ACQ:DATA:UNITS?'))
         return err_flag, val
 
     def set_data_units(self, val):
         # Set units in which data is returned. Choose either RAW or VOLTS
         self.rp.tx_txt('ACQ:DATA:UNITS ' + str(val))
+        self.data_units = str(val).upper()
         return
 
     def set_data_format(self, val):
         # Set format of data. Choose either BIN or ASCII.
+        # In BIN format the read functions return numpy arrays viewing the received bytes directly,
+        # int16 for RAW units and float32 for VOLTS units.
         self.rp.tx_txt('ACQ:DATA:FORMAT ' + str(val))
+        self.data_format = str(val).upper()
         return
 
     def read_samples_start_end(self, source, start, end):
         # Read samples from source, from start to end pos
-        self.rp.tx_txt('ACQ:SOUR' + str(int(source)) + ':DATA:STA:END? ' + str(int(start)) + ',' + str(int(end)))
-        datastr = self.rp.rx_txt()
-        datastr = datastr.strip('{}\n\r').replace("  ", "").split(',')
-        data = list(map(float, datastr))
+        err_flag, data = self.read_data('ACQ:SOUR' + str(int(source)) + ':DATA:STA:END? ' + str(int(start)) + ',' + str(int(end)))
         return data
 
     def read_samples_from(self, source, start, nsamples):
         # Read samples from source, nsamples starting from start
-        self.rp.tx_txt('ACQ:SOUR' + str(int(source)) + ':DATA:STA:N? ' + str(int(start)) + ',' + str(int(nsamples)))
-        err_flag, datastr = utils.rm_err(self.rp.rx_txt())
-        datastr = datastr.strip('{}\n\r').replace("  ", "").split(',')
-        data = list(map(float, datastr))
-        return err_flag, data
+        return self.read_data('ACQ:SOUR' + str(int(source)) + ':DATA:STA:N? ' + str(int(start)) + ',' + str(int(nsamples)))
 
     def read_all_samples(self, source):
         # Read full buffer
-        self.rp.tx_txt('ACQ:SOUR' + str(int(source)) + ':DATA?')
-        err_flag, datastr = utils.rm_err(self.rp.rx_txt())
-        datastr = datastr.strip('{}\n\r').replace("  ", "").split(',')
-        data = list(map(float, datastr))
-        return err_flag, data
+        return self.read_data('ACQ:SOUR' + str(int(source)) + ':DATA?')
 
     def read_samples_from_trig(self, source, nsamples):
         # Read nsamples from trigger delay
-        self.rp.tx_txt('ACQ:SOUR' + str(int(source)) + ':DATA:OLD:N? ' + str(int(nsamples)))
-        err_flag, datastr = utils.rm_err(self.rp.rx_txt())
-        datastr = datastr.strip('{}\n\r').replace("  ", "").split(',')
-        data = list(map(float, datastr))
-        return err_flag, data
+        return self.read_data('ACQ:SOUR' + str(int(source)) + ':DATA:OLD:N? ' + str(int(nsamples)))
 
     def read_samples_before_trig(self, source, nsamples):
         # Read nsamples before trigger delay
-        self.rp.tx_txt('ACQ:SOUR' + str(int(source)) + ':DATA:LAT:N? ' + str(int(nsamples)))
-        err_flag, datastr = utils.rm_err(self.rp.rx_txt())
-        datastr = datastr.strip('{}\n\r').replace("  ", "").split(',')
-        data = list(map(float, datastr))
-        return err_flag, data
+        return self.read_data('ACQ:SOUR' + str(int(source)) + ':DATA:LAT:N? ' + str(int(nsamples)))
+
+    def read_data(self, cmd):
+        # Send a data query and decode the reply based on the cached data format and units
+        with self.rp.lock:
+            self.rp.tx_txt(cmd)
+            return self.rx_data()
+
+    def rx_data(self):
+        # Receive a data reply and decode it based on the cached data format and units
+        # Separate from read_data so that data queries can be pipelined
+        return self.decode_data(*self.rx_data_raw())
+
+    def rx_data_raw(self):
+        # Receive a data reply without decoding it. Returns err_flag and the binary block or the reply text
+        if self.data_format == 'BIN':
+            buf = self.rp.rx_arb()
+            return int(buf is False), buf
+        return utils.rm_err(self.rp.rx_txt())
+
+    def decode_data(self, err_flag, raw):
+        # Decode a reply from rx_data_raw into a numpy array
+        if self.data_format == 'BIN':
+            # Binary block, sent big endian by the red pitaya. np.frombuffer does not copy the data.
+            dtype = '>i2' if self.data_units == 'RAW' else '>f4'
+            if err_flag:
+                return err_flag, np.empty(0, dtype=dtype)
+            return err_flag, np.frombuffer(raw, dtype=dtype)
+        if err_flag:
+            return err_flag, np.empty(0, dtype=self.ascii_dtype)
+        return err_flag, utils.parse_data(raw, self.ascii_dtype)
 
     def get_buf_size(self):
         # Get size of buffer
-        self.rp.tx_txt('ACQ:BUF:SIZE?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, int(val)
+        return utils.query_cached(self.rp, self.state, 'buf_size', 'ACQ:BUF:SIZE?', int)
 
     # Others
     def get_source_gain(self, source):
         # Get source gain, either LV or HV corresponding to jumper on red pitaya
-        self.rp.tx_txt('ACQ:SOUR' + str(int(source)) + ':GAIN?')
-        err_flag, val = utils.rm_err(self.rp.rx_txt())
-        return err_flag, val
+        return utils.query_cached(self.rp, self.state, ('gain', int(source)), 'ACQ:SOUR' + str(int(source)) + ':GAIN?')
 
     def set_source_gain(self, source, val):
         # Set source gain, either LV or HV corresponding to jumper on red pitaya
-        self.rp.tx_txt('ACQ:SOUR' + str(int(source)) + ':GAIN ' + str(val))
+        if self.state.changed(('gain', int(source)), str(val)):
+            self.rp.tx_txt('ACQ:SOUR' + str(int(source)) + ':GAIN ' + str(val))
         return
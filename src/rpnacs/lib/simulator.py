@@ -0,0 +1,420 @@
+import argparse
+import re
+import socket
+import threading
+import time
+import numpy as np
+
+# Simulated Red Pitaya SCPI server, for running the library and benchmarks without hardware:
+#
+#   with SimServer(latency=0.5e-3) as sim:
+#       rp = scpi(sim.host, port=sim.port)
+#
+# or from a shell: python -m rpnacs.lib.simulator --port 5000
+#
+# It implements the subset of commands used by Scope, FuncGenerator and DIOController.
+# The generator outputs are looped back to the inputs: IN1 sees OUT1 and IN2 sees OUT2, plus gaussian noise.
+# Outputs are off after a reset, so the inputs see only noise until a channel is enabled.
+
+sampling_rate = 125e6
+awg_size = 16384
+
+class SimDevice:
+    def __init__(self, noise=0.005, trigger_delay=0.0, buf_size=16384, seed=None):
+        # State of the simulated device, shared by all connections.
+        # noise: standard deviation in volts of the noise added to the inputs
+        # trigger_delay: seconds from arming an edge trigger (ACQ:TRIG CH1_PE, ...) until it fires,
+        #   float('inf') for a trigger that never fires. ACQ:TRIG NOW fires right away.
+        self.noise = noise
+        self.trigger_delay = trigger_delay
+        self.buf_size = buf_size
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.errors = 0
+        self.epoch = time.perf_counter()
+        self.reset()
+
+    def reset(self):
+        self.reset_acq()
+        self.reset_gen()
+        self.reset_dig()
+
+    def reset_acq(self):
+        self.acq = {'DEC': '1', 'AVG': 'ON', 'TRIG:DLY': '0', 'TRIG:HYST': '0.005', 'TRIG:LEV': '0',
+                    'DATA:UNITS': 'VOLTS', 'DATA:FORMAT': 'ASCII', 'SOUR1:GAIN': 'LV', 'SOUR2:GAIN': 'LV'}
+        self.start_time = None # time of ACQ:START, None when stopped
+        self.trig_source = 'DISABLED'
+        self.trig_time = None # time at which the armed trigger fires
+        self.frame = None # (2, buf_size) volts captured at the last trigger
+
+    def reset_gen(self):
+        self.gen = {}
+        for ch in '12':
+            self.gen[ch] = {'FUNC': 'SINE', 'FREQ:FIX': '1000', 'VOLT': '1', 'VOLT:OFFS': '0', 'PHAS': '0',
+                            'DCYC': '0.5', 'BURS:STAT': 'CONTINUOUS', 'BURS:NCYC': '1', 'BURS:NOR': '1',
+                            'BURS:INT:PER': '1', 'TRIG:SOUR': 'INT'}
+        self.outputs = {'1': '0', '2': '0'}
+        self.awg = {'1': np.zeros(awg_size), '2': np.zeros(awg_size)}
+
+    def reset_dig(self):
+        self.pins = {}
+        for i in range(9):
+            self.pins['LED' + str(i)] = ['OUT', 0]
+        for i in range(8):
+            for pin_type in 'PN':
+                self.pins['DIO' + str(i) + '_' + pin_type] = ['IN', 0]
+        # levels seen on the pins configured as inputs, set with set_input
+        self.inputs = {name: 0 for name in self.pins}
+
+    def set_input(self, identifier, state):
+        # Drive an input pin from outside, e.g. to test code watching the digital inputs
+        with self.lock:
+            self.inputs[identifier] = int(state)
+
+    def now(self):
+        return time.perf_counter() - self.epoch
+
+    def handle(self, cmd):
+        # Execute one command, returns the reply as bytes for queries and None for commands without reply.
+        # Unknown commands and bad arguments count as errors, queries then reply ERR!
+        cmd = cmd.strip().lstrip(':')
+        if not cmd:
+            return None
+        header, _, arg = cmd.partition(' ')
+        header = header.upper()
+        query = header.endswith('?')
+        try:
+            reply = self._dispatch(header.rstrip('?'), arg.strip(), query)
+        except (KeyError, ValueError, IndexError):
+            self.errors += 1
+            return b'ERR!' if query else None
+        if not query:
+            return None
+        return reply if isinstance(reply, bytes) else str(reply).encode()
+
+    def _dispatch(self, header, arg, query):
+        if header == '*IDN':
+            return 'REDPITAYA,INSTR2020,00,SIM'
+        if header == '*RST':
+            return self.reset()
+        if header == 'SYST:ERR:COUN':
+            return self.errors
+        if header == 'SYST:ERR:NEXT':
+            return '0,"No error"'
+        if header.startswith('ACQ:'):
+            return self._acq(header[4:], arg, query)
+        if header.startswith('DIG:'):
+            return self._dig(header[4:], arg, query)
+        if header == 'GEN:RST':
+            return self.reset_gen()
+        if header == 'PHAS:ALIGN':
+            return None
+        m = re.match(r'(SOUR|OUTPUT)([12]?):(.+)$', header)
+        if m:
+            return self._gen(m.group(1), m.group(2), m.group(3), arg, query)
+        raise KeyError(header)
+
+    ## ACQ:*
+    def _acq(self, key, arg, query):
+        if key == 'START':
+            self.start_time = self.now()
+            self.trig_source = 'DISABLED'
+            self.trig_time = None
+            return None
+        if key == 'STOP':
+            self.start_time = None
+            return None
+        if key == 'RST':
+            return self.reset_acq()
+        if key == 'TRIG' and not query:
+            return self._arm(arg.upper())
+        if key == 'TRIG:STAT':
+            return 'TD' if self._triggered() else 'WAIT'
+        if key == 'BUF:SIZE':
+            return self.buf_size
+        if key == 'TRIG:DLY:NS':
+            # the delay is kept in samples, 8 ns each at decimation 1
+            ns_per_sample = 1e9 / sampling_rate * int(self.acq['DEC'])
+            if query:
+                return int(int(self.acq['TRIG:DLY']) * ns_per_sample)
+            self.acq['TRIG:DLY'] = str(int(round(int(arg) / ns_per_sample)))
+            return None
+        m = re.match(r'SOUR([12]):DATA(.*)$', key)
+        if m and query:
+            return self._data(int(m.group(1)) - 1, m.group(2), arg)
+        if query:
+            return self.acq[key]
+        if key not in self.acq:
+            raise KeyError(key)
+        if key == 'DEC' and not 1 <= int(arg) <= 65536:
+            # out of range, the device keeps its decimation
+            raise ValueError(arg)
+        self.acq[key] = arg.upper() if key == 'DATA:FORMAT' or key == 'DATA:UNITS' else arg
+        return None
+
+    def _fill_time(self):
+        return self.buf_size * int(self.acq['DEC']) / sampling_rate
+
+    def _arm(self, source):
+        self.trig_source = source
+        if source == 'DISABLED' or self.start_time is None:
+            self.trig_time = None
+            return None
+        # the pre trigger half of the buffer has to be written before the trigger is accepted
+        earliest = self.start_time + self._fill_time() / 2
+        delay = 0.0 if source == 'NOW' else self.trigger_delay
+        self.trig_time = max(self.now() + delay, earliest)
+        return None
+
+    def _triggered(self):
+        if self.trig_time is None or self.now() < self.trig_time:
+            return False
+        if self.frame is None or self.frame[0] != self.trig_time:
+            self.frame = (self.trig_time, self._capture())
+        return True
+
+    def _capture(self):
+        # Volts seen on both inputs around the trigger, trigger at index buf_size // 2 - trigger delay
+        dec = int(self.acq['DEC'])
+        idx = np.arange(self.buf_size) - (self.buf_size // 2 - int(self.acq['TRIG:DLY']))
+        t = idx * (dec / sampling_rate)
+        frame = np.empty((2, self.buf_size))
+        for i, ch in enumerate('12'):
+            # edge triggers on a channel start its period at the trigger, otherwise the phase runs freely
+            edge = self.trig_source.startswith('CH' + ch) or self.trig_source.startswith('AWG')
+            t0 = 0.0 if edge else self.trig_time
+            if self.trig_source.endswith('_NE') and edge:
+                t0 = 0.5 / max(float(self.gen[ch]['FREQ:FIX']), 1e-9)
+            frame[i] = self._output(ch, t + t0)
+            full_scale = 20.0 if self.acq['SOUR' + ch + ':GAIN'] == 'HV' else 1.0
+            frame[i] += self.rng.normal(0, self.noise, self.buf_size)
+            np.clip(frame[i], -full_scale, full_scale, out=frame[i])
+        return frame
+
+    def _output(self, ch, t):
+        # Generator output of channel ch at times t
+        if self.outputs[ch] != '1':
+            return np.zeros(len(t))
+        gen = self.gen[ch]
+        freq = float(gen['FREQ:FIX'])
+        amp = float(gen['VOLT'])
+        offset = float(gen['VOLT:OFFS'])
+        cycles = t * freq + float(gen['PHAS']) / 360
+        frac = cycles % 1.0
+        func = gen['FUNC'].upper()
+        if func == 'SINE':
+            wave = np.sin(2 * np.pi * cycles)
+        elif func == 'SQUARE':
+            wave = np.where(frac < 0.5, 1.0, -1.0)
+        elif func == 'TRIANGLE':
+            wave = 1 - 4 * np.abs(frac - 0.5)
+        elif func == 'SAWU':
+            wave = 2 * frac - 1
+        elif func == 'SAWD':
+            wave = 1 - 2 * frac
+        elif func == 'PWM':
+            wave = np.where(frac < float(gen['DCYC']), 1.0, -1.0)
+        elif func == 'ARBITRARY':
+            wave = self.awg[ch][(frac * awg_size).astype(int) % awg_size]
+        elif func == 'DC':
+            wave = np.ones(len(t))
+        elif func == 'DC_NEG':
+            wave = -np.ones(len(t))
+        else:
+            wave = np.zeros(len(t))
+        return amp * wave + offset
+
+    def _data(self, chn, kind, arg):
+        self._triggered()
+        if self.frame is None:
+            frame = np.zeros(self.buf_size)
+        else:
+            frame = self.frame[1][chn]
+        args = [int(x) for x in arg.split(',')] if arg else []
+        if kind == '':
+            data = frame
+        elif kind == ':STA:END':
+            start, end = args
+            data = np.take(frame, np.arange(start, end + 1), mode='wrap')
+        elif kind == ':STA:N':
+            start, n = args
+            data = np.take(frame, np.arange(start, start + n), mode='wrap')
+        elif kind == ':OLD:N':
+            data = frame[:args[0]]
+        elif kind == ':LAT:N':
+            data = frame[self.buf_size - args[0]:]
+        else:
+            raise KeyError(kind)
+        return self._format(data, chn)
+
+    def _format(self, volts, chn):
+        # Encode samples in the current data format and units
+        raw = self.acq['DATA:UNITS'] == 'RAW'
+        if raw:
+            full_scale = 20.0 if self.acq['SOUR' + str(chn + 1) + ':GAIN'] == 'HV' else 1.0
+            data = np.clip(np.round(volts / full_scale * 8192), -8192, 8191).astype('>i2')
+        else:
+            data = volts.astype('>f4')
+        if self.acq['DATA:FORMAT'] == 'BIN':
+            payload = data.tobytes()
+            size = str(len(payload)).encode()
+            return b'#' + str(len(size)).encode() + size + payload
+        fmt = '{:d}' if raw else '{:.6f}'
+        return '{' + ','.join(map(fmt.format, data.tolist())) + '}'
+
+    ## SOUR*, OUTPUT*
+    def _gen(self, kind, ch, key, arg, query):
+        chs = [ch] if ch else ['1', '2']
+        if kind == 'OUTPUT':
+            if key != 'STATE':
+                raise KeyError(key)
+            if query:
+                return self.outputs[chs[0]]
+            for c in chs:
+                self.outputs[c] = '1' if arg.upper() in ('ON', '1') else '0'
+            return None
+        if key == 'TRIG:INT':
+            return None
+        if key == 'TRAC:DATA:DATA':
+            if query:
+                return ','.join(map('{:g}'.format, self.awg[chs[0]].tolist()))
+            data = np.array([float(x) for x in arg.split(',')])
+            if len(data) > awg_size:
+                raise ValueError(arg)
+            # shorter uploads are stretched over the whole buffer
+            self.awg[chs[0]] = np.interp(np.linspace(0, len(data), awg_size, endpoint=False),
+                                         np.arange(len(data)), data)
+            return None
+        gen = self.gen[chs[0]]
+        if key not in gen:
+            raise KeyError(key)
+        if query:
+            return gen[key]
+        if key != 'FUNC' and key != 'BURS:STAT' and key != 'TRIG:SOUR':
+            float(arg)
+        gen[key] = arg.upper() if key == 'FUNC' else arg
+        return None
+
+    ## DIG:*
+    def _dig(self, key, arg, query):
+        if key == 'RST':
+            return self.reset_dig()
+        if key == 'PIN:DIR':
+            if query:
+                return self.pins[arg.upper()][0]
+            direction, identifier = [x.strip().upper() for x in arg.split(',')]
+            if direction != 'IN' and direction != 'OUT':
+                raise ValueError(direction)
+            self.pins[identifier][0] = direction
+            return None
+        if key == 'PIN':
+            if query:
+                identifier = arg.upper()
+                direction, state = self.pins[identifier]
+                return state if direction == 'OUT' else self.inputs[identifier]
+            identifier, state = [x.strip().upper() for x in arg.split(',')]
+            self.pins[identifier][1] = int(state)
+            return None
+        raise KeyError(key)
+
+class SimServer:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, bandwidth=None, **kwargs):
+        # Serve a SimDevice on host:port, port 0 picks a free port, see self.port.
+        # latency: seconds added before the replies to each chunk of commands received, like a network round trip.
+        #   Queries sent together share it, as on a real network.
+        # bandwidth: bytes per second the replies are limited to, None for no limit
+        # Other keyword arguments go to SimDevice.
+        self.device = SimDevice(**kwargs)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(8)
+        self.host, self.port = self.sock.getsockname()[:2]
+        self._conns = []
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR) # wakes up the accept thread
+        except OSError:
+            pass
+        self.sock.close()
+        self._thread.join()
+        for conn in self._conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._conns.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        buf = b''
+        while True:
+            try:
+                chunk = conn.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            buf += chunk
+            lines = buf.split(b'\r\n')
+            buf = lines.pop()
+            replies = []
+            with self.device.lock:
+                for line in lines:
+                    for cmd in line.decode().split(';'):
+                        reply = self.device.handle(cmd)
+                        if reply is not None:
+                            replies.append(reply + b'\r\n')
+            if not replies:
+                continue
+            out = b''.join(replies)
+            delay = self.latency
+            if self.bandwidth:
+                delay += len(out) / self.bandwidth
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                conn.sendall(out)
+            except OSError:
+                return
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated Red Pitaya SCPI server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each round trip')
+    parser.add_argument('--bandwidth', type=float, default=None, help='reply bandwidth in bytes/s')
+    parser.add_argument('--noise', type=float, default=0.005, help='input noise in volts')
+    parser.add_argument('--trigger-delay', type=float, default=0.0, help='seconds until an edge trigger fires')
+    args = parser.parse_args()
+    server = SimServer(args.host, args.port, args.latency, args.bandwidth,
+                       noise=args.noise, trigger_delay=args.trigger_delay)
+    print('Simulated Red Pitaya listening on {}:{}'.format(server.host, server.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.close()
+
+if __name__ == '__main__':
+    main()
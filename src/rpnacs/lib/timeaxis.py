@@ -0,0 +1,54 @@
+import numpy as np
+
+class TimeAxis:
+    def __init__(self, start, step, length):
+        # Sample times start + i * step for i in range(length), in seconds.
+        # The array is built the first time it is asked for and then kept. It is read-only since the same
+        # array is handed out with every trace.
+        self.start = start
+        self.step = step
+        self.length = length
+        self._array = None
+
+    @classmethod
+    def from_acquisition(cls, buf_size, dec, trig_delay=0, sampling_rate=125e6):
+        # Time axis of an acquisition with t = 0 at the trigger.
+        # With no delay the trigger is in the middle of the buffer. A delay of trig_delay samples moves it
+        # that many samples earlier in the buffer, so more of the trace is after the trigger.
+        step = dec / sampling_rate
+        return cls(-(buf_size // 2 - trig_delay) * step, step, buf_size)
+
+    def __len__(self):
+        return self.length
+
+    def __array__(self, dtype=None, copy=None):
+        return self.array if dtype is None else self.array.astype(dtype)
+
+    def __getitem__(self, idx):
+        return self.array[idx]
+
+    def __repr__(self):
+        return 'TimeAxis(start={!r}, step={!r}, length={!r})'.format(self.start, self.step, self.length)
+
+    @property
+    def stop(self):
+        # time of the last sample
+        return self.start + (self.length - 1) * self.step
+
+    @property
+    def duration(self):
+        # time to record all samples
+        return self.length * self.step
+
+    @property
+    def trigger_index(self):
+        # index of the sample at t = 0, may be outside the buffer for long delays
+        return int(round(-self.start / self.step))
+
+    @property
+    def array(self):
+        if self._array is None:
+            arr = self.start + np.arange(self.length) * self.step
+            arr.flags.writeable = False
+            self._array = arr
+        return self._array
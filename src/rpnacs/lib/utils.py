@@ -1,4 +1,102 @@
+import numpy as np
+
 def rm_err(text):
     if text.startswith('ERR!'):
         return 1, text[4:len(text)]
     return 0, text
+
+def parse_reply(text, conv=str):
+    # rm_err and convert the value with conv (int, float, ...) if there was no error
+    err_flag, val = rm_err(text)
+    if err_flag:
+        return err_flag, val
+    return err_flag, conv(val)
+
+def query_many(rp, queries):
+    # Pipelined queries. queries is a list of (cmd, conv) pairs where conv converts the reply, e.g. int or float.
+    # All queries are sent in one write and the replies are read back in order, so this costs a single round trip.
+    # Returns a list of (err_flag, val) like the single getters do.
+    replies = rp.txrx_many([cmd for cmd, conv in queries])
+    return [parse_reply(reply, conv) for reply, (cmd, conv) in zip(replies, queries)]
+
+def parse_data(text, dtype=np.float64):
+    # Parse a {v1,v2,...} data reply (str or bytes) into a numpy array of dtype.
+    # The numbers are converted in a single pass by numpy, no python float is created per sample.
+    # Whitespace around the values is allowed.
+    if isinstance(text, str):
+        text = text.strip('{}\n\r ')
+    else:
+        text = bytes(text).strip(b'{}\n\r ')
+    return np.fromstring(text, dtype=dtype, sep=',')
+
+def envelope(t, y, nbins):
+    # Min/max decimation of traces for plotting, about 2 points per horizontal pixel with nbins the plot width.
+    # t is the time axis and y one trace or a (channels, n) array of traces sharing it.
+    # Each bin of samples is replaced by its min and max, so peaks and glitches narrower than a pixel stay visible.
+    # Returns (t, y) of 2 * nbins points, with the min at the start and the max at the end time of each bin,
+    # or t and y unchanged if they are short enough already.
+    t = np.asarray(t)
+    y = np.asarray(y)
+    n = y.shape[-1]
+    nbins = int(nbins)
+    if nbins < 1 or n <= 2 * nbins:
+        return t, y
+    starts = np.linspace(0, n, nbins + 1).astype(np.intp)
+    out = np.empty(y.shape[:-1] + (2 * nbins,), dtype=y.dtype)
+    out[..., 0::2] = np.minimum.reduceat(y, starts[:-1], axis=-1)
+    out[..., 1::2] = np.maximum.reduceat(y, starts[:-1], axis=-1)
+    t_out = np.empty(2 * nbins, dtype=t.dtype)
+    t_out[0::2] = t[starts[:-1]]
+    t_out[1::2] = t[starts[1:] - 1]
+    return t_out, out
+
+def query_cached(rp, state, key, cmd, conv=str):
+    # Query cmd, unless the value of key is in the StateCache state. The value read is cached.
+    val = state.get(key)
+    if val is not None:
+        return 0, val
+    err_flag, val = parse_reply(rp.txrx_txt(cmd), conv)
+    if not err_flag:
+        state.set(key, val)
+    return err_flag, val
+
+def register_cache(rp, state):
+    # Have the connection rp clear the StateCache state when it resets the device with *RST, returns state
+    caches = getattr(rp, 'caches', None)
+    if caches is not None:
+        caches.add(state)
+    return state
+
+class StateCache:
+    # Client side copy of instrument settings, keyed by parameter, e.g. 'dec' or ('freq', 1).
+    # Setters call changed() with the value they are about to send and skip the command if it returns False,
+    # i.e. if the device already has that value. Getters return get() if it is not None, and set() what they read.
+    # Anything that resets settings on the device must clear() or invalidate() the affected keys.
+    # Instruments register their cache with register_cache, so that rp.rst() clears it.
+    # With enabled = False every call goes to the device, the cache is still kept up to date.
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.vals = {}
+
+    def get(self, key):
+        # Cached value of key, None if unknown
+        if not self.enabled:
+            return None
+        return self.vals.get(key)
+
+    def set(self, key, val):
+        self.vals[key] = val
+
+    def changed(self, key, val):
+        # Record val for key, returns whether it differs from the cached value
+        if self.enabled and key in self.vals and self.vals[key] == val:
+            return False
+        self.vals[key] = val
+        return True
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.vals.pop(key, None)
+
+    def clear(self):
+        self.vals.clear()
@@ -0,0 +1,115 @@
+import functools
+import numpy as np
+
+# Synthesis of arbitrary generator buffers.
+# Every waveform is a buffer of awg_size samples in [-1, 1] spanning one period of the generator,
+# so frequencies are in cycles per buffer and times in fractions of the buffer.
+# Results are cached by their parameters and returned read-only, since the same array is handed out again.
+# The batch functions take arrays of parameters and return one buffer per row.
+
+awg_size = 16384
+cache_size = 128
+# A family can hold hundreds of buffers (128 kB each), so far fewer of them are kept
+family_cache_size = 8
+
+def _readonly(arr):
+    arr.flags.writeable = False
+    return arr
+
+def _time(n):
+    return np.arange(n) / n
+
+def _column(vals):
+    # parameters as a column, to broadcast against the time axis
+    return np.asarray(vals, dtype=np.float64).reshape(-1, 1)
+
+@functools.lru_cache(maxsize=cache_size)
+def sine(cycles=1, phase=0, n=awg_size):
+    # cycles periods of a sine starting at phase degrees
+    return _readonly(_sines(_column(cycles), _column(phase), n)[0])
+
+@functools.lru_cache(maxsize=cache_size)
+def chirp(f0, f1, n=awg_size):
+    # Linear frequency sweep from f0 to f1 cycles per buffer
+    return _readonly(_chirps(_column(f0), _column(f1), n)[0])
+
+@functools.lru_cache(maxsize=cache_size)
+def _multitone(freqs, amps, phases, n):
+    t = _time(n)
+    wave = np.zeros(n)
+    for freq, amp, phase in zip(freqs, amps, phases):
+        wave += amp * np.sin(2 * np.pi * freq * t + np.deg2rad(phase))
+    # normalized to a peak of 1
+    peak = np.abs(wave).max()
+    return _readonly(wave / peak if peak > 0 else wave)
+
+def multitone(freqs, amps=None, phases=None, n=awg_size):
+    # Sum of sines at freqs cycles per buffer with relative amplitudes amps and phases in degrees,
+    # scaled to a peak of 1
+    freqs = tuple(float(f) for f in freqs)
+    amps = (1.0,) * len(freqs) if amps is None else tuple(float(a) for a in amps)
+    phases = (0.0,) * len(freqs) if phases is None else tuple(float(p) for p in phases)
+    return _multitone(freqs, amps, phases, n)
+
+@functools.lru_cache(maxsize=cache_size)
+def gaussian_pulse(center=0.5, width=0.05, n=awg_size):
+    # Gaussian pulse of height 1 at center with standard deviation width, both as fractions of the buffer.
+    # The baseline is 0.
+    return _readonly(_gaussian_pulses(_column(center), _column(width), n)[0])
+
+@functools.lru_cache(maxsize=cache_size)
+def ramp(start=-1, stop=1, n=awg_size):
+    # Linear ramp from start to stop over the buffer
+    return _readonly(np.linspace(start, stop, n))
+
+def _sines(cycles, phase, n):
+    return np.sin(2 * np.pi * cycles * _time(n) + np.deg2rad(phase))
+
+def _chirps(f0, f1, n):
+    t = _time(n)
+    return np.sin(2 * np.pi * (f0 * t + (f1 - f0) * t**2 / 2))
+
+def _gaussian_pulses(center, width, n):
+    return np.exp(-0.5 * ((_time(n) - center) / width)**2)
+
+@functools.lru_cache(maxsize=family_cache_size)
+def _family(kind, params, n):
+    columns = [_column(p) for p in params]
+    if kind == 'sine':
+        rows = _sines(*columns, n)
+    elif kind == 'chirp':
+        rows = _chirps(*columns, n)
+    elif kind == 'gaussian_pulse':
+        rows = _gaussian_pulses(*columns, n)
+    else:
+        raise ValueError('unknown waveform family ' + kind)
+    return _readonly(np.ascontiguousarray(rows))
+
+def _as_params(*params):
+    # broadcast the parameters against each other, as hashable tuples
+    return tuple(tuple(p.tolist()) for p in np.broadcast_arrays(*[np.atleast_1d(np.asarray(p, dtype=np.float64))
+                                                                 for p in params]))
+
+def sines(cycles, phase=0, n=awg_size):
+    # One sine per value of cycles and phase (broadcast against each other), as a (k, n) array
+    return _family('sine', _as_params(cycles, phase), n)
+
+def chirps(f0, f1, n=awg_size):
+    # One chirp per value of f0 and f1 (broadcast against each other), as a (k, n) array,
+    # e.g. chirps(0, np.linspace(10, 1000, 200)) for a sweep of 200 chirp rates
+    return _family('chirp', _as_params(f0, f1), n)
+
+def gaussian_pulses(center, width, n=awg_size):
+    # One pulse per value of center and width (broadcast against each other), as a (k, n) array
+    return _family('gaussian_pulse', _as_params(center, width), n)
+
+generators = {'sine': sine, 'chirp': chirp, 'multitone': multitone, 'gaussian_pulse': gaussian_pulse, 'ramp': ramp}
+
+def generate(name, **params):
+    # Waveform name with params, e.g. generate('chirp', f0=1, f1=100)
+    return generators[name](**params)
+
+def cache_clear():
+    # Drop all cached waveforms
+    for fn in [sine, chirp, _multitone, gaussian_pulse, ramp, _family]:
+        fn.cache_clear()
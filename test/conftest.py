@@ -0,0 +1,30 @@
+import pytest
+from rpnacs.lib import redpitaya_scpi as scpi
+from rpnacs.lib.simulator import SimServer
+
+# These scripts drive a real Red Pitaya (test_gui*.py are the locking GUIs), they are not pytest tests.
+# All other tests run against the simulator or without a connection.
+collect_ignore = ['test_DIOController.py', 'test_blink.py', 'test_fgen.py', 'test_funcgen.py',
+                  'test_gui.py', 'test_gui2.py', 'test_scope.py', 'test_scope_class.py']
+
+@pytest.fixture
+def sim():
+    # Simulated Red Pitaya without input noise, so traces can be compared with the generator settings
+    with SimServer(noise=0.0, seed=0) as server:
+        yield server
+
+@pytest.fixture
+def rp(sim):
+    # scpi connection to sim, recording a transcript of the commands sent
+    conn = scpi.scpi(sim.host, port=sim.port)
+    conn.enable_trace()
+    yield conn
+    conn.close()
+
+def sent(rp):
+    # Messages sent on rp since the transcript was enabled or cleared, in order
+    return [msg for event in rp._tracer.events if event[0] == 'tx' for msg in event[6]]
+
+def writes(rp):
+    # Number of socket writes on rp since the transcript was enabled or cleared
+    return sum(1 for event in rp._tracer.events if event[0] == 'tx')
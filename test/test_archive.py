@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from rpnacs.lib.archive import TraceArchive, TraceArchiveWriter
+
+def write(path, n, start=0, **kwargs):
+    # Append records start..start+n to the archive at path, record i is filled with i
+    with TraceArchiveWriter(path, 8, chunk_size=4, **kwargs) as writer:
+        for i in range(start, start + n):
+            writer.append(np.full((2, 8), i), timestamp=float(i), dec=8, trig_source='CH1_PE')
+
+def test_append_and_read(tmp_path):
+    write(tmp_path, 3)
+    archive = TraceArchive(tmp_path)
+    assert len(archive) == 3
+    assert archive[1].shape == (2, 8)
+    assert archive[1].dtype == np.float32
+    assert np.all(archive[-1] == 2)
+    meta = archive.meta(0)
+    assert meta['dec'] == 8
+    assert meta['trig_source'] == b'CH1_PE'
+    with pytest.raises(IndexError):
+        archive[3]
+
+def test_reopen(tmp_path):
+    # an existing archive is appended to, reload() sees the new records
+    write(tmp_path, 3)
+    archive = TraceArchive(tmp_path)
+    write(tmp_path, 6, start=3)
+    assert len(archive) == 3
+    archive.reload()
+    assert len(archive) == 9
+    assert archive.timestamps.tolist() == list(range(9))
+    with pytest.raises(ValueError):
+        TraceArchiveWriter(tmp_path, 16)
+
+def test_slices(tmp_path):
+    write(tmp_path, 10)
+    archive = TraceArchive(tmp_path)
+    # within one chunk a view of the memory map, across chunks a copy
+    assert isinstance(archive[4:7], np.memmap)
+    assert archive[2:9][:, 0, 0].tolist() == list(range(2, 9))
+    assert archive[::3][:, 0, 0].tolist() == [0, 3, 6, 9]
+    assert archive[8:1:-2][:, 0, 0].tolist() == [8, 6, 4, 2]
+    assert archive.meta(slice(1, None, 4))['timestamp'].tolist() == [1.0, 5.0, 9.0]
+
+def test_empty_archive(tmp_path):
+    with TraceArchiveWriter(tmp_path, 8, chunk_size=4):
+        pass
+    archive = TraceArchive(tmp_path)
+    assert len(archive) == 0
+    assert archive[:].shape == (0, 2, 8)
+    assert archive[::2].dtype == np.float32
+    assert len(archive.timestamps) == 0
+
+def test_empty_slice(tmp_path):
+    write(tmp_path, 5)
+    archive = TraceArchive(tmp_path)
+    assert archive[3:3].shape == (0, 2, 8)
+    assert archive[7:9].shape == (0, 2, 8)
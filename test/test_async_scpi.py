@@ -0,0 +1,116 @@
+import asyncio
+import numpy as np
+import pytest
+from rpnacs.lib.async_scpi import AsyncScpi, AsyncScope, AsyncFuncGenerator, AsyncDIOController
+
+def run(sim, test):
+    # Run the coroutine function test(arp) on an AsyncScpi connection to sim
+    async def main():
+        async with await AsyncScpi.connect(sim.host, port=sim.port) as arp:
+            return await test(arp)
+    return asyncio.run(main())
+
+def test_txrx(sim):
+    async def test(arp):
+        return await arp.idn_q(), await arp.txrx_many(['ACQ:BUF:SIZE?', 'BAD:CMD?', 'ACQ:DEC?'])
+    idn, replies = run(sim, test)
+    assert idn.startswith('REDPITAYA')
+    assert replies == ['16384', 'ERR!', '1']
+
+def test_batch(sim):
+    async def test(arp):
+        with arp.batch(join=True):
+            arp.tx_txt('ACQ:DEC 8')
+            arp.tx_txt('ACQ:DEC?')
+            arp.tx_txt('ACQ:AVG OFF')
+        return await arp.rx_txt(), await arp.txrx_txt('ACQ:AVG?')
+    assert run(sim, test) == ('8', 'OFF')
+    assert sim.device.errors == 0
+
+def test_rx_arb_short_reply(sim):
+    # replies that are not a block are dropped, including one character replies
+    async def test(arp):
+        arp.tx_txt('DIG:PIN? LED1')
+        short = await arp.rx_arb()
+        arp.tx_txt('BAD:CMD?')
+        err = await arp.rx_arb()
+        return short, err, await arp.idn_q()
+    short, err, idn = run(sim, test)
+    assert short is False and err is False
+    assert idn.startswith('REDPITAYA')
+
+def test_concurrent_tasks(sim):
+    # tasks sharing a connection each get their own replies
+    async def test(arp):
+        async def worker():
+            return [await arp.txrx_many(['ACQ:BUF:SIZE?'] * 3) for i in range(20)]
+        return await asyncio.gather(*[worker() for i in range(4)])
+    for replies in run(sim, test):
+        assert replies == [['16384'] * 3] * 20
+
+def test_scope_acquire_and_stream(sim):
+    async def test(arp):
+        sc = AsyncScope(arp)
+        sc.reset_acq()
+        sc.set_data_format('BIN')
+        ts, ch1, ch2 = await sc.acquire_trace(5)
+        frames = [frame async for frame in sc.stream(2, timeout=5)]
+        return ts, ch1, frames, await sc.get_dec(), sc.stream_stats
+    ts, ch1, frames, dec, stats = run(sim, test)
+    assert len(ts) == len(ch1) == 16384
+    assert ch1.dtype == np.dtype('>f4')
+    assert len(frames) == 2
+    assert stats['frames'] == 2 and stats['dropped'] == 0
+    assert dec == (0, 1)
+
+def test_scope_read_error(sim):
+    async def test(arp):
+        sc = AsyncScope(arp)
+        sc.set_data_format('BIN')
+        return await sc.read_data('ACQ:SOUR3:DATA?'), await sc.get_buf_size()
+    (err_flag, data), buf_size = run(sim, test)
+    assert err_flag == 1
+    assert buf_size == (0, 16384)
+
+def test_funcgen(sim):
+    data = np.linspace(-1, 1, 16384)
+    async def test(arp):
+        fgen = AsyncFuncGenerator(arp)
+        fgen.set_output(1, 'SINE', 2500, 0.5)
+        settings = await fgen.get_settings(1)
+        fgen.import_awg_data(2, data)
+        return settings, await fgen.get_awg_data(2), await fgen.verify_awg_data(2)
+    settings, (err_flag, awg), verified = run(sim, test)
+    assert settings['waveform'] == (0, 'SINE')
+    assert settings['freq'] == (0, 2500)
+    assert settings['amp'] == (0, 0.5)
+    assert err_flag == 0
+    assert np.allclose(awg, data, atol=1e-4)
+    assert verified[0] == 0
+
+def test_dio(sim):
+    sim.device.set_input('DIO2_P', 1)
+    async def test(arp):
+        dio = AsyncDIOController(arp)
+        dio.set_led(3, 1)
+        return await dio.get_leds(), await dio.get_pins(), await dio.get_led(3)
+    leds, pins, led3 = run(sim, test)
+    assert leds == (0, 0b1000)
+    assert pins == (0, 0b100)
+    assert led3 == (0, 1)
+
+def test_scope_stream_overlap(sim):
+    # only the rest of the fill time is waited for after the caller processed a frame
+    async def test(arp):
+        sc = AsyncScope(arp)
+        sc.set_data_format('BIN')
+        sc.set_dec(1024)
+        fill_times = []
+        async for frame in sc.stream(3, timeout=5):
+            fill_times.append(sc.wait_stats['fill_time'])
+            await asyncio.sleep(0.1)
+        return fill_times
+    fill_times = run(sim, test)
+    fill_time = 16384 * 1024 / 125e6
+    assert fill_times[0] == pytest.approx(fill_time, abs=0.01)
+    assert max(fill_times[1:]) < fill_time - 0.09
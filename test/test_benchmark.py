@@ -0,0 +1,23 @@
+import json
+from rpnacs.lib import benchmark
+
+def check(res):
+    # every leaf of the results is a timing with a median and a min
+    if 'median' in res:
+        assert 0 < res['min'] <= res['median']
+        return
+    for val in res.values():
+        check(val)
+
+def test_offline_benchmarks():
+    results = {'parse': benchmark.bench_parse(1024, 2), 'rx': benchmark.bench_rx([16, 1024], 2)}
+    check(results)
+    json.dumps(results)
+
+def test_sim_benchmarks(rp):
+    results = {'roundtrip': benchmark.bench_roundtrip(rp, 10), 'acquire_trace': benchmark.bench_acquire(rp, 1),
+               'import_awg_data': benchmark.bench_awg(rp, 1, 1024), 'dio_bulk_set': benchmark.bench_dio(rp, 2)}
+    check(results)
+    json.dumps(results)
+    # the connection is left in sync
+    assert rp.idn_q().startswith('REDPITAYA')
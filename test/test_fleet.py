@@ -0,0 +1,47 @@
+import socket
+import numpy as np
+import pytest
+from rpnacs.lib import redpitaya_scpi as scpi
+from rpnacs.lib.fleet import Fleet
+from rpnacs.lib.simulator import SimServer
+
+@pytest.fixture
+def servers():
+    sims = [SimServer(noise=0.0, seed=i) for i in range(3)]
+    yield sims
+    for sim in sims:
+        sim.close()
+
+def free_port():
+    # A port nothing listens on, connecting to it is refused
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def test_configure_and_acquire(servers):
+    hosts = {'rp' + str(i): (sim.host, sim.port) for i, sim in enumerate(servers)}
+    with Fleet(hosts, timeout=5) as fleet:
+        assert len(fleet) == 3
+        decs = fleet.configure_all(lambda dev, dec: dev.scope.set_dec(dec) or dev.scope.get_dec(), 8)
+        assert decs == {name: (0, 8) for name in hosts}
+        traces = fleet.acquire_all(timeout=5)
+    assert set(traces) == set(hosts)
+    for trace in traces.values():
+        assert trace['data'].shape == (2, 16384)
+        assert np.array_equal(trace['ts'], traces['rp0']['ts'])
+    assert [sim.device.acq['DEC'] for sim in servers] == ['8'] * 3
+
+def test_unreachable_host(servers, monkeypatch):
+    # the connections that were opened are closed before the error is raised
+    closed = []
+    close = scpi.scpi.close
+    def record_close(rp):
+        closed.append(rp.port)
+        close(rp)
+    monkeypatch.setattr(scpi.scpi, 'close', record_close)
+    hosts = [(sim.host, sim.port) for sim in servers] + [('127.0.0.1', free_port())]
+    with pytest.raises(ConnectionRefusedError):
+        Fleet(hosts, timeout=5)
+    assert sorted(closed) == sorted(sim.port for sim in servers)
@@ -6,7 +6,7 @@ from PyQt5.QtCore import QMutex, QObject, QThread, pyqtSignal
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
-from rpnacs.lib import scope, FuncGenerator, DIOController
+from rpnacs.lib import scope, FuncGenerator, DIOController, utils
 from rpnacs.lib import redpitaya_scpi as scpi
 import time
 import random
@@ -28,9 +28,35 @@ class ScopeWorkerCmds(Enum):
     SetScopeTime = 1
     SetTrigger = 2
     SetTimeout = 3
+    Start = 4
+    Stop = 5
+
+class FrameSlot:
+    # Holds the latest frame only. put() replaces a frame that was not taken yet, so the UI always draws the newest
+    # trace and never works through a backlog of stale ones.
+    def __init__(self):
+        self.mutex = MutexManager(QMutex())
+        self.frame = None
+        self.dropped = 0
+
+    def put(self, frame):
+        # Returns whether the slot was empty, i.e. whether the consumer needs to be told about the new frame
+        with self.mutex:
+            was_empty = self.frame is None
+            if not was_empty:
+                self.dropped += 1
+            self.frame = frame
+        return was_empty
+
+    def take(self):
+        # Returns the latest frame and empties the slot, None if there is no new frame
+        with self.mutex:
+            frame = self.frame
+            self.frame = None
+        return frame
 
 class ScopeWorker(QThread):
-    # signal when trace is acquired
+    # signal when a trace is put in the frame slot
     trace_acquired = pyqtSignal()
     # signal for when a cmd is acknowledged
     cmd_acknowledged = pyqtSignal(int)
@@ -39,67 +65,60 @@ class ScopeWorker(QThread):
     # trigger_timeout
     trigger_timeout = 1;
 
-    def __init__(self, sc, shared_list, cmd_queue, cmd_mutex,  data, data_mutex):
+    def __init__(self, sc, cmd_queue, frames):
         # sc is a two element list. First element is a Scope object (or None). Second element is a mutex
-        # shared_list is how the outside communicates with the worker. It is read-only for the worker. Communicate out of worker using signals.
-        # The first element determines whether traces should be acquired
-        # cmd_queue is a queue of commands
-
-        # data is a list of lists to share the times, and channels acquired by the scope
-        # data_mutex controls access to ts, chn1, chn2
+        # cmd_queue is a queue of commands, the only way the outside communicates with the worker.
+        # Communicate out of worker using signals and the frames slot.
+        # frames is a FrameSlot receiving (ts, ch1, ch2) of each trace acquired
         self.sc = sc
-        self.shared_list = shared_list
         self.cmd_queue = cmd_queue
-        self.cmd_mutex = cmd_mutex
-        self.data = data
-        self.data_mutex = data_mutex
+        self.frames = frames
+        self.running = False
         super().__init__()
 
     def run(self):
-        # list of cmd_queue commands
-        # 0: stop and kill worker thread
-        # 1: set time scale
-        # 2: set trigger
-        # 3: set timeout
+        # While stopped the worker sleeps until a command comes in.
+        # While running it acquires back to back, and pending commands are processed before each acquisition.
         while True:
+            acquiring = self.running and self.sc[0] is not None
             try:
-                with self.cmd_mutex:
-                    cmd = self.cmd_queue.get(False) # non-blocking retrieval
+                cmd = self.cmd_queue.get(block=not acquiring)
             except queue.Empty:
                 cmd = None
-            if self.sc[0] is not None:
-                # process cmds first and then acquire trace
-                if cmd is None:
-                    # No commands mean acquire traces if allowed.
-                    if self.shared_list[0] == 1:
-                        with self.sc[1]:
-                            ts, ch1, ch2 = self.sc[0].acquire_trace(self.trigger_timeout,0)
-                        with self.data_mutex:
-                            self.data[0] = ts
-                            self.data[1] = ch1
-                            self.data[2] = ch2
-                        self.trace_acquired.emit()
-                else:
-                    cmd_type = cmd[0]
-                    # here process commands
-                    if cmd_type == ScopeWorkerCmds.Kill:
-                        break
-                    elif cmd_type == ScopeWorkerCmds.SetScopeTime:
-                        # set time command
-                        with self.sc[1]:
-                            self.sc[0].set_time_total(cmd[1])
-                        self.cmd_acknowledged.emit(1)
-                    elif cmd_type == ScopeWorkerCmds.SetTrigger:
-                        with self.sc[1]:
-                            self.sc[0].set_trigger(cmd[1], cmd[2], cmd[3])
-                        self.cmd_acknowledged.emit(2)
-                    elif cmd_type == ScopeWorkerCmds.SetTimeout:
-                        self.trigger_timeout = cmd[1];
-                        self.cmd_acknowledged.emit(3)
-            # This sleep here prevents this thread from taking all the runtime.
-            time.sleep(0.5)
+            if cmd is not None:
+                if not self.process_cmd(cmd):
+                    break
+                continue
+            with self.sc[1]:
+                ts, ch1, ch2 = self.sc[0].acquire_trace(self.trigger_timeout, 0)
+            if self.frames.put((ts, ch1, ch2)):
+                self.trace_acquired.emit()
         self.finished.emit()
 
+    def process_cmd(self, cmd):
+        # Returns False if the worker should exit
+        cmd_type = cmd[0]
+        if cmd_type == ScopeWorkerCmds.Kill:
+            return False
+        elif cmd_type == ScopeWorkerCmds.Start:
+            self.running = True
+        elif cmd_type == ScopeWorkerCmds.Stop:
+            self.running = False
+        elif cmd_type == ScopeWorkerCmds.SetTimeout:
+            self.trigger_timeout = cmd[1];
+        elif self.sc[0] is None:
+            # scope commands need a connection
+            return True
+        elif cmd_type == ScopeWorkerCmds.SetScopeTime:
+            # set time command
+            with self.sc[1]:
+                self.sc[0].set_time_total(cmd[1])
+        elif cmd_type == ScopeWorkerCmds.SetTrigger:
+            with self.sc[1]:
+                self.sc[0].set_trigger(cmd[1], cmd[2], cmd[3])
+        self.cmd_acknowledged.emit(cmd_type.value)
+        return True
+
 class PlotWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -121,12 +140,9 @@ class PlotWindow(QMainWindow):
 
         # Create Scope related objects
         self.sc = [None, self.rp_mutex]
-        self.sc_data = [[], [], []]
-        self.sc_data_mutex = MutexManager(QMutex())
-        self.sc_shared_list = [0]
+        self.sc_frames = FrameSlot()
         self.sc_cmd_queue = queue.Queue()
-        self.sc_cmd_mutex = MutexManager(QMutex())
-        self.scope_worker = ScopeWorker(self.sc, self.sc_shared_list, self.sc_cmd_queue, self.sc_cmd_mutex, self.sc_data, self.sc_data_mutex)
+        self.scope_worker = ScopeWorker(self.sc, self.sc_cmd_queue, self.sc_frames)
         self.scope_worker.trace_acquired.connect(self.update_plot)
         self.scope_worker.cmd_acknowledged.connect(self.sc_cmd_acknowledged)
         self.scope_worker.start()
@@ -137,6 +153,16 @@ class PlotWindow(QMainWindow):
         self.ax = self.figure.add_subplot(111)
         self.line1, = self.ax.plot([0, 1], [0,0], label='Line 1')
         self.line2, = self.ax.plot([0, 1], [0,0], label ='Line 2')
+        # Fast rendering: the axes are drawn only when the limits change and cached as a background,
+        # each trace restores it and blits the lines. The limits follow the data with plot_margin (fraction of the
+        # data range) of headroom, and change only when the data leaves them or shrinks to a small part of them.
+        # Set fast_render = False for the plain relim/autoscale/draw path.
+        self.fast_render = True
+        self.plot_margin = 0.1
+        self.plot_background = None
+        self.canvas.mpl_connect('draw_event', self.on_canvas_draw)
+        self.fps_frames = 0
+        self.fps_t0 = time.perf_counter()
 
         # Create buttons
         self.start_button = QPushButton("Start", self)
@@ -378,8 +404,7 @@ class PlotWindow(QMainWindow):
             except ValueError as err:
                 self.status_label.setText("ERROR: Enter a number for the time!")
                 return
-            with self.sc_cmd_mutex:
-                self.sc_cmd_queue.put([ScopeWorkerCmds.SetScopeTime, val])
+            self.sc_cmd_queue.put([ScopeWorkerCmds.SetScopeTime, val])
 
     def set_sc_trigger(self):
         if self.rp is not None:
@@ -390,8 +415,7 @@ class PlotWindow(QMainWindow):
             except ValueError as err:
                 self.status_label.setText("ERROR: Enter a number for the trigger level!")
                 return
-            with self.sc_cmd_mutex:
-                self.sc_cmd_queue.put([ScopeWorkerCmds.SetTrigger, chn, edge, lev])
+            self.sc_cmd_queue.put([ScopeWorkerCmds.SetTrigger, chn, edge, lev])
 
     def set_sc_trig_timeout(self):
         if self.rp is not None:
@@ -400,27 +424,28 @@ class PlotWindow(QMainWindow):
             except ValueError as err:
                 self.status_label.setText("ERROR: Enter a number for the timeout!")
                 return
-            with self.sc_cmd_mutex:
-                self.sc_cmd_queue.put([ScopeWorkerCmds.SetTimeout, val])
+            self.sc_cmd_queue.put([ScopeWorkerCmds.SetTimeout, val])
 
     def sc_cmd_acknowledged(self, cmd_type):
-        if cmd_type == ScopeWorkerCmds.SetScopeTime:
+        if cmd_type == ScopeWorkerCmds.SetScopeTime.value:
             self.status_label.setText("Time scale of scope set!")
-        elif cmd_type == ScopeWorkerCmds.SetTrigger:
+        elif cmd_type == ScopeWorkerCmds.SetTrigger.value:
             self.status_label.setText("Trigger setting set!")
-        elif cmd_type == ScopeWorkerCmds.SetTimeout:
+        elif cmd_type == ScopeWorkerCmds.SetTimeout.value:
             self.status_label.setText("Trigger timeout set!")
 
     def start_plot(self):
         if self.rp is not None:
-            self.sc_shared_list[0] = 1
+            self.sc_cmd_queue.put([ScopeWorkerCmds.Start])
+            self.fps_frames = 0
+            self.fps_t0 = time.perf_counter()
             self.start_button.setEnabled(False)
             self.stop_button.setEnabled(True)
             self.status_label.setText("Scope plot started!")
 
     def stop_plot(self):
         if self.rp is not None:
-            self.sc_shared_list[0] = 0
+            self.sc_cmd_queue.put([ScopeWorkerCmds.Stop])
             self.stop_button.setEnabled(False)
             self.start_button.setEnabled(True)
             self.status_label.setText("Scope plot stopped!")
@@ -429,29 +454,85 @@ class PlotWindow(QMainWindow):
         return
 
     def update_plot(self):
-        with self.sc_data_mutex:
-            ts = self.sc_data[0]
-            ch1 = self.sc_data[1]
-            ch2 = self.sc_data[2]
+        frame = self.sc_frames.take()
+        if frame is None:
+            return
+        ts, ch1, ch2 = frame
+        # no more than about 2 points per pixel of the plot are drawn
+        ts, (ch1, ch2) = utils.envelope(ts, np.stack((ch1, ch2)), self.canvas.width())
         self.line1.set_data(ts, ch1)
         self.line2.set_data(ts, ch2)
-        self.ax.relim()
-        self.ax.autoscale_view()
-
-        # Redraw the canvas
-        self.canvas.draw_idle()
+        if self.line1.get_animated() != self.fast_render:
+            # mode changed, normal draws skip animated lines
+            self.line1.set_animated(self.fast_render)
+            self.line2.set_animated(self.fast_render)
+            self.plot_background = None
+        if not self.fast_render:
+            self.ax.relim()
+            self.ax.autoscale_view()
+            # Redraw the canvas
+            self.canvas.draw_idle()
+        elif self.rescale_plot(ts, ch1, ch2) or self.plot_background is None:
+            # full redraw, on_canvas_draw caches the new background
+            self.canvas.draw_idle()
+        else:
+            self.canvas.restore_region(self.plot_background)
+            self.ax.draw_artist(self.line1)
+            self.ax.draw_artist(self.line2)
+            self.canvas.blit(self.figure.bbox)
+        self.count_fps()
+
+    def on_canvas_draw(self, event):
+        # After each full draw (new limits, resize, ...) cache the background and draw the lines on top.
+        # Follows the lines rather than fast_render, which update_plot applies to them.
+        if self.line1.get_animated():
+            self.plot_background = self.canvas.copy_from_bbox(self.figure.bbox)
+            self.ax.draw_artist(self.line1)
+            self.ax.draw_artist(self.line2)
+
+    def rescale_plot(self, ts, ch1, ch2):
+        # Update the limits if the data left them, or uses less than a quarter of the y range.
+        # Returns whether they changed.
+        changed = False
+        if tuple(self.ax.get_xlim()) != (ts[0], ts[-1]):
+            self.ax.set_xlim(ts[0], ts[-1])
+            changed = True
+        lo = min(ch1.min(), ch2.min())
+        hi = max(ch1.max(), ch2.max())
+        ylo, yhi = self.ax.get_ylim()
+        if lo < ylo or hi > yhi or (hi - lo) < 0.25 * (yhi - ylo):
+            margin = self.plot_margin * max(hi - lo, 1e-3)
+            self.ax.set_ylim(lo - margin, hi + margin)
+            changed = True
+        return changed
+
+    def count_fps(self):
+        # Show the plot rate in the status label once per second
+        self.fps_frames += 1
+        now = time.perf_counter()
+        if now - self.fps_t0 >= 1:
+            self.status_label.setText("Scope plot: {:.1f} FPS".format(self.fps_frames / (now - self.fps_t0)))
+            self.fps_frames = 0
+            self.fps_t0 = now
+
+    def closeEvent(self, event):
+        # stop the scope worker before the window goes away
+        self.sc_cmd_queue.put([ScopeWorkerCmds.Kill])
+        self.scope_worker.wait()
+        super().closeEvent(event)
 
     # Function Generator functions
     def refresh_fg_settings(self, idx):
         if self.rp is not None:
             # This is zero indexed
             with self.rp_mutex:
-                freq_err, freq = self.fg.get_freq(idx + 1)
-                amp_err, amp = self.fg.get_amp(idx + 1)
-                offset_err, offset = self.fg.get_offset(idx + 1)
-                phase_err, phase = self.fg.get_phase(idx + 1)
-                wform_err, wform = self.fg.get_waveform(idx + 1)
-                enable_err, enable = self.fg.get_state(idx + 1)
+                settings = self.fg.get_settings(idx + 1)
+            freq_err, freq = settings['freq']
+            amp_err, amp = settings['amp']
+            offset_err, offset = settings['offset']
+            phase_err, phase = settings['phase']
+            wform_err, wform = settings['waveform']
+            enable_err, enable = settings['state']
             unit = self.fg_freq_units.currentIndex()
             freq = freq / 10**(unit * 3)
             self.fg_freq.setText(str(freq))
@@ -520,7 +601,7 @@ class PlotWindow(QMainWindow):
 
     def set_fg_phase(self):
         if self.rp is not None:
-            val = int(self.fg_phase.text())
+            val = int(float(self.fg_phase.text()))
             if val >= -360 and val <= 360:
                 chn_num = self.fg_chn.currentIndex() + 1
                 with self.rp_mutex:
@@ -566,8 +647,9 @@ class PlotWindow(QMainWindow):
     def select_ttl(self, idx):
         if self.rp is not None:
             with self.rp_mutex:
-                err, state = self.dio.get_pin_state(idx, 'N')
-                err_dir, direction = self.dio.get_pin_direction(idx, 'N')
+                pin = self.dio.get_pin(idx, 'N')
+            err, state = pin['state']
+            err_dir, direction = pin['direction']
             self.lock_ttl_id.setText('DIO' + str(idx) + '_N')
             self.lock_ttl_value.setCurrentIndex(state)
             if direction == "OUT":
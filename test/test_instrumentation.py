@@ -0,0 +1,100 @@
+import json
+import pytest
+from rpnacs.lib import instrumentation, scope
+
+## Statistics
+def test_command_type():
+    assert instrumentation.command_type('ACQ:SOUR2:DATA?') == 'ACQ:SOURn:DATA?'
+    assert instrumentation.command_type(':dig:pin LED3,1') == 'DIG:PIN'
+
+def test_histogram():
+    hist = instrumentation.Histogram([1, 2, 5])
+    for val in [0.5, 1, 1.5, 3, 10]:
+        hist.observe(val)
+    assert hist.counts == [2, 1, 1, 1]
+    assert hist.quantile(0.4) == 1
+    assert hist.quantile(0.7) == 5
+    assert hist.quantile(1.0) == float('inf')
+    snap = hist.snapshot()
+    assert snap['count'] == 5
+    assert snap['mean'] == pytest.approx(3.2)
+    assert snap['buckets'] == {'1': 2, '2': 1, '5': 1, '+Inf': 1}
+
+def test_stats_bytes_per_command(rp):
+    stats = rp.enable_stats()
+    with rp.batch():
+        rp.tx_txt('ACQ:DEC 8')
+        rp.tx_txt('DIG:PIN LED1,1')
+    rp.idn_q()
+    commands = stats.snapshot()['commands']
+    assert commands['ACQ:DEC']['bytes_sent'] == len('ACQ:DEC 8\r\n')
+    assert commands['DIG:PIN']['bytes_sent'] == len('DIG:PIN LED1,1\r\n')
+    assert commands['*IDN?']['replies'] == 1
+
+def test_stats_replies(rp):
+    # replies are matched to the queries in order, errors are counted
+    stats = rp.enable_stats()
+    rp.txrx_many(['ACQ:DEC?', 'BAD:CMD?', 'ACQ:SOUR1:DATA:STA:N? 0,10'])
+    snap = stats.snapshot()
+    assert snap['commands']['ACQ:DEC?']['bytes_received'] == len('1\r\n')
+    assert snap['commands']['BAD:CMD?']['errors'] == 1
+    assert snap['commands']['ACQ:SOURn:DATA:STA:N?']['replies'] == 1
+    assert snap['totals']['replies'] == 3
+    assert snap['commands']['ACQ:DEC?']['first_byte']['count'] == 1
+    stats.reset()
+    assert stats.snapshot()['totals']['sent'] == 0
+
+def test_stats_operations(rp):
+    # instrument methods are timed as operations
+    stats = rp.enable_stats()
+    sc = scope.Scope(rp)
+    sc.acquire_trace(5)
+    with rp.annotate('custom'):
+        rp.idn_q()
+    assert stats.snapshot()['operations']['acquire_trace']['count'] == 1
+    assert stats.snapshot()['operations']['custom']['count'] == 1
+
+def test_prometheus(rp):
+    stats = rp.enable_stats()
+    rp.idn_q()
+    text = stats.prometheus()
+    host = rp.host
+    assert '# TYPE rpnacs_scpi_commands_total counter' in text
+    assert 'rpnacs_scpi_commands_total{host="%s",command="*IDN?"} 1' % host in text
+    assert 'rpnacs_scpi_first_byte_seconds_count{host="%s",command="*IDN?"} 1' % host in text
+    assert 'rpnacs_scpi_first_byte_seconds_bucket{host="%s",command="*IDN?",le="+Inf"} 1' % host in text
+    assert text.endswith('\n')
+
+def test_label_value():
+    assert instrumentation._label_value('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+
+## Transcript
+def test_trace_events(rp):
+    rp._tracer.clear()
+    rp.txrx_many(['ACQ:DEC?', 'ACQ:AVG?'])
+    kinds = [(event[0], event[1]) for event in rp._tracer.events]
+    assert kinds == [('tx', 'ACQ:DEC? (+1)'), ('rx_txt', 'ACQ:DEC?'), ('rx_txt', 'ACQ:AVG?')]
+
+def test_chrome_trace(rp, tmp_path):
+    tracer = rp.enable_trace()
+    sc = scope.Scope(rp)
+    sc.set_data_format('BIN')
+    sc.acquire_trace(5)
+    trace = tracer.chrome_trace()
+    events = trace['traceEvents']
+    assert events[0]['args']['name'] == 'scpi ' + rp.host
+    assert any(event['ph'] == 'M' and event['name'] == 'thread_name' for event in events)
+    spans = [event for event in events if event['ph'] == 'X']
+    assert all(event['dur'] >= 0 and event['ts'] >= 0 for event in spans)
+    names = [event['name'] for event in spans]
+    assert 'acquire_trace' in names
+    assert 'rx_arb ACQ:SOUR1:DATA?' in names
+    path = tmp_path / 'trace.json'
+    tracer.save(str(path))
+    assert json.loads(path.read_text()) == json.loads(json.dumps(trace))
+
+def test_trace_maxlen(rp):
+    tracer = rp.enable_trace(maxlen=4)
+    for i in range(5):
+        rp.idn_q()
+    assert len(tracer.events) == 4
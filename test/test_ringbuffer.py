@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from rpnacs.lib import scope
+from rpnacs.lib.ringbuffer import TraceRingBuffer
+
+def fill(buf, n, seed=0):
+    # Append n random traces to buf, returns them
+    rng = np.random.default_rng(seed)
+    traces = rng.normal(size=(n,) + buf.data.shape[1:])
+    for i, trace in enumerate(traces):
+        buf.append(trace, timestamp=float(i))
+    return traces
+
+def test_append():
+    buf = TraceRingBuffer(4, 8)
+    traces = fill(buf, 3)
+    assert len(buf) == 3
+    assert np.array_equal(buf.last(3), traces)
+    assert buf.last_timestamps(3).tolist() == [0.0, 1.0, 2.0]
+
+def test_wrap():
+    # the oldest traces are overwritten once the buffer is full
+    buf = TraceRingBuffer(4, 8)
+    traces = fill(buf, 6)
+    assert len(buf) == 4
+    assert np.array_equal(buf.last(4), traces[2:])
+    assert buf.last_timestamps(4).tolist() == [2.0, 3.0, 4.0, 5.0]
+    assert np.array_equal(buf.last(), traces[5:])
+
+def test_last_view():
+    # contiguous traces are a view of the buffer, wrapped ones a copy
+    buf = TraceRingBuffer(4, 8)
+    fill(buf, 5)
+    assert np.shares_memory(buf.last(1), buf.data)
+    assert not np.shares_memory(buf.last(3), buf.data)
+    assert len(buf.last(10)) == 4
+
+@pytest.mark.parametrize('n', [1, 3, 4, 7, 9])
+def test_mean_var(n):
+    buf = TraceRingBuffer(4, 16)
+    traces = fill(buf, n)[-4:]
+    assert np.allclose(buf.mean(), traces.mean(axis=0))
+    assert np.allclose(buf.var(), traces.var(axis=0))
+    assert np.allclose(buf.std(), traces.std(axis=0))
+
+def test_recompute_sums():
+    # after many turns of the buffer the running sums still match the traces in it
+    buf = TraceRingBuffer(3, 16)
+    traces = fill(buf, 100)[-3:]
+    assert np.allclose(buf._sum, traces.sum(axis=0), rtol=0, atol=1e-12)
+    assert np.allclose(buf._sumsq, np.square(traces).sum(axis=0), rtol=0, atol=1e-12)
+
+def test_next_slot_commit():
+    # next_slot is filled in place, asking again before commit gives the same slot
+    buf = TraceRingBuffer(2, 4, channels=1)
+    fill(buf, 2)
+    slot = buf.next_slot()
+    assert np.shares_memory(buf.next_slot(), slot)
+    assert len(buf) == 1 # the oldest trace already left
+    slot[...] = 7.0
+    buf.commit(timestamp=10.0)
+    assert len(buf) == 2
+    assert buf.last().tolist() == [[[7.0] * 4]]
+    assert buf.last_timestamps().tolist() == [10.0]
+
+def test_clear():
+    buf = TraceRingBuffer(4, 8)
+    fill(buf, 5)
+    buf.clear()
+    assert len(buf) == 0
+    assert np.all(buf.mean() == 0)
+    traces = fill(buf, 2)
+    assert np.allclose(buf.mean(), traces.mean(axis=0))
+
+def test_acquire(rp):
+    sc = scope.Scope(rp)
+    sc.reset_acq()
+    buf = TraceRingBuffer(2, 16384)
+    ts = buf.acquire(sc, timeout=5)
+    assert len(ts) == 16384
+    assert len(buf) == 1
@@ -0,0 +1,131 @@
+import queue
+import time
+import pytest
+from rpnacs.lib import DIOController
+from rpnacs.lib.diowatcher import DIOWatcher
+from conftest import sent, writes
+
+@pytest.fixture
+def dio(rp):
+    dio = DIOController.DIOController(rp)
+    dio.reset()
+    rp.idn_q() # the reset is done once this is answered
+    rp._tracer.clear()
+    return dio
+
+## State cache
+def test_output_state_cached(dio, rp):
+    dio.set_led(2, 1)
+    dio.set_led(2, 1)
+    assert dio.get_led(2) == (0, 1)
+    assert sent(rp) == ['DIG:PIN LED2,1']
+
+def test_input_state_read(dio, rp, sim):
+    # inputs change on their own, they are read every time
+    sim.device.set_input('DIO3_N', 1)
+    assert dio.get_pin_state(3, 'N') == (0, 1)
+    sim.device.set_input('DIO3_N', 0)
+    assert dio.get_pin_state(3, 'N') == (0, 0)
+    assert sent(rp).count('DIG:PIN? DIO3_N') == 2
+
+def test_direction_change_invalidates_state(dio, sim):
+    dio.set_pin_direction(1, 'OUT', 'N')
+    dio.set_pin_state(1, 1, 'N')
+    assert dio.get_pin_state(1, 'N') == (0, 1)
+    dio.set_pin_direction(1, 'IN', 'N')
+    sim.device.set_input('DIO1_N', 0)
+    assert dio.get_pin_state(1, 'N') == (0, 0)
+
+def test_reset_invalidates(dio):
+    dio.set_led(0, 1)
+    dio.reset()
+    assert dio.get_led(0) == (0, 0)
+
+def test_rst_invalidates(dio, rp):
+    dio.set_led(0, 1)
+    rp.rst()
+    assert dio.get_led(0) == (0, 0)
+
+## Bitmasks
+def test_leds(dio, rp, sim):
+    dio.set_leds(0b100000101)
+    assert writes(rp) == 1
+    # LEDs are outputs, read back from the cache
+    assert dio.get_leds() == (0, 0b100000101)
+    assert writes(rp) == 1
+    rp.idn_q()
+    assert [sim.device.pins['LED' + str(i)][1] for i in range(9)] == [1, 0, 1, 0, 0, 0, 0, 0, 1]
+
+def test_leds_only_changes_sent(dio, rp):
+    dio.set_leds(0b11)
+    rp._tracer.clear()
+    dio.set_leds(0b110)
+    assert sent(rp) == ['DIG:PIN LED0,0', 'DIG:PIN LED2,1']
+
+def test_pins(dio, rp, sim):
+    dio.set_directions(0b11111111, 'P')
+    dio.set_pins(0b10111, 'P')
+    rp.idn_q()
+    # bit 0 is EXT_TRIG and left alone
+    assert sim.device.pins['DIO0_P'] == ['IN', 0]
+    assert [sim.device.pins['DIO' + str(i) + '_P'][1] for i in range(1, 8)] == [1, 1, 0, 1, 0, 0, 0]
+    assert dio.get_pins('P') == (0, 0b10110)
+
+def test_inputs_read_in_one_round_trip(dio, rp, sim):
+    sim.device.set_input('DIO2_N', 1)
+    sim.device.set_input('DIO7_N', 1)
+    rp._tracer.clear()
+    assert dio.get_pins('N') == (0, 0b10000100)
+    assert writes(rp) == 1
+    # inputs are read again every time
+    sim.device.set_input('DIO7_N', 0)
+    assert dio.get_pins('N') == (0, 0b100)
+
+def test_mixed_directions(dio, rp, sim):
+    # outputs come from the cache, inputs from the device
+    dio.set_directions(0b1, 'N')
+    dio.set_pins(0b1, 'N')
+    sim.device.set_input('DIO4_N', 1)
+    rp._tracer.clear()
+    assert dio.get_pins('N') == (0, 0b10001)
+    assert 'DIG:PIN? DIO0_N' not in sent(rp)
+
+## Watcher
+def test_watcher_edges(dio, sim):
+    events = queue.Queue()
+    with DIOWatcher(dio, ['DIO3_N', (4, 'N')], rate=500, debounce=2, queue=events) as watcher:
+        time.sleep(0.05)
+        sim.device.set_input('DIO3_N', 1)
+        event = events.get(timeout=2)
+        assert (event['pin'], event['state'], event['edge']) == ('DIO3_N', 1, 'rising')
+        sim.device.set_input('DIO4_N', 1)
+        sim.device.set_input('DIO3_N', 0)
+        got = {events.get(timeout=2)['pin'] for i in range(2)}
+        assert got == {'DIO3_N', 'DIO4_N'}
+    assert not watcher.running
+    assert watcher.error is None
+    assert watcher.edges == 3
+    assert watcher.latency.count == 3
+
+def test_watcher_debounce(dio, sim):
+    # a level seen for a single sample is not an edge
+    events = []
+    watcher = DIOWatcher(dio, ['DIO5_N'], debounce=3, callback=events.append)
+    watcher._update({'DIO5_N': 0}, 0.0, 0.0)
+    watcher._update({'DIO5_N': 1}, 0.1, 0.1)
+    watcher._update({'DIO5_N': 0}, 0.2, 0.2)
+    assert events == []
+    for i in range(3):
+        watcher._update({'DIO5_N': 1}, 0.3 + i, 0.3 + i)
+    assert [event['edge'] for event in events] == ['rising']
+
+def test_watcher_shares_connection(dio, rp, sim):
+    # the watcher and other users of the connection each get their own replies
+    events = queue.Queue()
+    with DIOWatcher(dio, ['DIO6_N'], rate=1000, debounce=1, queue=events) as watcher:
+        for i in range(50):
+            assert rp.txrx_many(['ACQ:BUF:SIZE?', 'ACQ:DEC?']) == ['16384', '1']
+            dio.set_leds(i % 2)
+        sim.device.set_input('DIO6_N', 1)
+        assert events.get(timeout=2)['edge'] == 'rising'
+    assert watcher.error is None
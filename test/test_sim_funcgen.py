@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from rpnacs.lib import FuncGenerator, waveforms
+from conftest import sent
+
+@pytest.fixture
+def fgen(rp):
+    fgen = FuncGenerator.FuncGenerator(rp)
+    fgen.reset()
+    rp._tracer.clear()
+    return fgen
+
+def uploads(rp):
+    return [msg for msg in sent(rp) if ':TRAC:DATA:DATA ' in msg]
+
+def test_settings(fgen, rp):
+    fgen.set_output(1, 'SQUARE', 2000, 0.4, 0.1)
+    settings = fgen.get_settings(1)
+    assert settings['waveform'] == (0, 'SQUARE')
+    assert settings['freq'] == (0, 2000.0)
+    assert settings['amp'] == (0, 0.4)
+
+## AWG upload
+def test_awg_upload(fgen, rp, sim):
+    data = np.sin(np.linspace(0, 2 * np.pi, 16384, endpoint=False))
+    fgen.import_awg_data(1, data)
+    rp.idn_q()
+    assert np.allclose(sim.device.awg['1'], data, atol=1e-5)
+    assert len(uploads(rp)) == 1
+
+def test_awg_upload_unchanged(fgen, rp):
+    # the channel already holds the data, only the other channel needs it
+    data = np.linspace(-1, 1, 16384)
+    fgen.import_awg_data(1, data)
+    fgen.import_awg_data(1, data.copy())
+    fgen.import_awg_data(2, data)
+    assert [msg.split(':')[0] for msg in uploads(rp)] == ['SOUR1', 'SOUR2']
+
+def test_awg_upload_precision(fgen, rp):
+    # the same samples at another precision are sent again
+    data = np.linspace(-1, 1, 16384)
+    fgen.import_awg_data(1, data)
+    fgen.import_awg_data(1, data, precision=3)
+    payloads = [msg.split(' ', 1)[1].split(',') for msg in uploads(rp)]
+    assert len(payloads) == 2
+    assert payloads[1][1] == '%.3g' % data[1]
+
+def test_awg_payload_cache(fgen, rp):
+    # switching between a few waveforms reuses their formatted payloads
+    a = np.linspace(-1, 1, 16384)
+    b = -a
+    for data in [a, b, a, b]:
+        fgen.import_awg_data(1, data)
+    assert len(uploads(rp)) == 4
+    assert len(fgen._awg_payloads) == 2
+    fgen.awg_payload_cache_size = 1
+    fgen.import_awg_data(1, a * 0.5)
+    assert len(fgen._awg_payloads) == 1
+
+def test_awg_reset_uploads_again(fgen, rp):
+    data = np.linspace(0, 1, 16384)
+    fgen.import_awg_data(1, data)
+    fgen.reset()
+    fgen.import_awg_data(1, data)
+    assert len(uploads(rp)) == 2
+
+def test_load_waveform(fgen, rp, sim):
+    fgen.load_waveform(1, 'multitone', freqs=[1, 5], amps=[1, 0.5])
+    rp.idn_q()
+    assert np.abs(sim.device.awg['1']).max() == pytest.approx(1, abs=1e-5)
+    # the cached waveform is recognised as already uploaded
+    fgen.load_waveform(1, 'multitone', freqs=[1, 5], amps=[1, 0.5])
+    assert len(uploads(rp)) == 1
+
+## AWG readback
+def test_awg_readback(fgen, sim):
+    data = waveforms.gaussian_pulse(0.3, 0.02)
+    fgen.import_awg_data(2, data)
+    err_flag, readback = fgen.get_awg_data(2)
+    assert err_flag == 0
+    assert readback.shape == (16384,)
+    assert np.allclose(readback, data, atol=1e-5)
+
+def test_awg_verify(fgen, rp, sim):
+    data = waveforms.sine(3)
+    fgen.import_awg_data(1, data)
+    err_flag, ok, bad = fgen.verify_awg_data(1)
+    assert (err_flag, ok, len(bad)) == (0, True, 0)
+
+    # corrupted on the device: reported, and the next upload is not skipped
+    sim.device.awg['1'][[5, 700]] = 0.9
+    err_flag, ok, bad = fgen.verify_awg_data(1)
+    assert (err_flag, ok) == (0, False)
+    assert bad.tolist() == [5, 700]
+    fgen.import_awg_data(1, data)
+    assert len(uploads(rp)) == 2
+    assert fgen.verify_awg_data(1)[1]
+
+def test_awg_verify_tolerance(fgen, sim):
+    data = waveforms.ramp()
+    fgen.import_awg_data(1, data)
+    fgen.rp.idn_q() # the upload is done once this is answered
+    sim.device.awg['1'][10] += 1e-3
+    assert not fgen.verify_awg_data(1)[1]
+    assert fgen.verify_awg_data(1, tol=2e-3)[1]
+
+def test_awg_verify_nothing_uploaded(fgen):
+    err_flag, ok, bad = fgen.verify_awg_data(2)
+    assert (err_flag, ok) == (1, False)
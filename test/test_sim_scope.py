@@ -0,0 +1,229 @@
+import threading
+import time
+import numpy as np
+import pytest
+from rpnacs.lib import scope, FuncGenerator
+from conftest import sent
+
+formats = [('ASCII', 'VOLTS', np.float64), ('BIN', 'VOLTS', np.dtype('>f4')), ('BIN', 'RAW', np.dtype('>i2'))]
+
+@pytest.fixture
+def sc(rp):
+    sc = scope.Scope(rp)
+    sc.reset_acq()
+    rp._tracer.clear()
+    return sc
+
+def sine_on_ch1(rp, freq=1e4, amp=0.5):
+    fgen = FuncGenerator.FuncGenerator(rp)
+    fgen.set_output(1, 'SINE', freq, amp)
+    fgen.enable_output(1)
+
+def dc_on_ch1(rp, volts=0.3):
+    fgen = FuncGenerator.FuncGenerator(rp)
+    fgen.set_output(1, 'DC', 0, volts)
+    fgen.enable_output(1)
+
+## State cache
+def test_getter_cached(sc, rp):
+    assert sc.get_dec() == (0, 1)
+    assert sc.get_dec() == (0, 1)
+    assert sent(rp).count('ACQ:DEC?') == 1
+
+def test_setter_skips_known_value(sc, rp):
+    sc.set_dec(8)
+    assert sc.get_dec() == (0, 8)
+    sc.set_dec(8)
+    assert sent(rp).count('ACQ:DEC 8') == 1
+
+def test_set_dec_reads_back(sc, rp, sim):
+    # the decimation the device took is read back, not the value requested
+    assert sc.set_time_res(1.0) == 2**16 / sc.sampling_rate
+    assert sim.device.acq['DEC'] == '65536'
+    sc.set_dec(100000) # out of range, refused by the device
+    assert sc.get_dec() == (0, 65536)
+
+def test_set_dec_trig_delay_ns(sc):
+    # the trigger delay in ns depends on the decimation
+    sc.set_trig_delay(100)
+    assert sc.get_trig_delay_ns() == (0, 800)
+    sc.set_dec(8)
+    assert sc.get_trig_delay_ns() == (0, 6400)
+    assert sc.get_trig_delay() == (0, 100)
+
+def test_set_time_total(sc, sim):
+    total = sc.set_time_total(1e-3)
+    assert total >= 1e-3
+    assert sim.device.acq['DEC'] == '8'
+
+def test_reset_invalidates(sc, rp):
+    sc.set_dec(8)
+    sc.set_trig_lev(0.2)
+    assert sc.get_dec() == (0, 8)
+    sc.reset_acq()
+    rp._tracer.clear()
+    assert sc.get_dec() == (0, 1)
+    assert sc.get_trig_lev() == (0, 0.0)
+    assert sent(rp) == ['ACQ:DEC?', 'ACQ:TRIG:LEV?']
+
+def test_rst_invalidates(sc, rp):
+    # *RST resets every instrument, the caches of all of them are cleared
+    fgen = FuncGenerator.FuncGenerator(rp)
+    sc.set_dec(8)
+    fgen.set_freq(1, 2500)
+    assert sc.get_dec() == (0, 8)
+    assert fgen.get_freq(1) == (0, 2500)
+    rp.rst()
+    assert sc.get_dec() == (0, 1)
+    assert fgen.get_freq(1) == (0, 1000)
+    sc.set_dec(8)
+    assert sc.get_dec() == (0, 8)
+
+def test_cache_disabled(sc, rp):
+    sc.state.enabled = False
+    sc.get_dec()
+    sc.get_dec()
+    assert sent(rp).count('ACQ:DEC?') == 2
+
+## Data formats
+@pytest.mark.parametrize('fmt, units, dtype', formats)
+def test_acquire_trace(sc, rp, fmt, units, dtype):
+    dc_on_ch1(rp)
+    sc.set_data_format(fmt)
+    sc.set_data_units(units)
+    ts, ch1, ch2 = sc.acquire_trace(5)
+    assert len(ts) == len(ch1) == len(ch2) == 16384
+    assert ch1.dtype == dtype
+    volts = ch1 / 8192 if units == 'RAW' else ch1
+    assert np.allclose(volts, 0.3, atol=1e-3)
+    assert np.all(ch2 == 0)
+
+@pytest.mark.parametrize('fmt, units, dtype', formats)
+def test_read_samples(sc, rp, fmt, units, dtype):
+    sc.set_data_format(fmt)
+    sc.set_data_units(units)
+    sc.acquire_trace(5)
+    err_flag, data = sc.read_samples_from(1, 100, 50)
+    assert err_flag == 0
+    assert len(data) == 50
+    assert data.dtype == dtype
+
+def test_decode_bin_no_copy():
+    sc = scope.Scope(None)
+    sc.data_format = 'BIN'
+    raw = bytearray(np.arange(8, dtype='>f4').tobytes())
+    err_flag, data = sc.decode_data(0, raw)
+    assert data.tolist() == list(range(8))
+    assert np.shares_memory(data, np.frombuffer(raw, dtype=np.uint8))
+    sc.data_units = 'RAW'
+    err_flag, data = sc.decode_data(0, bytearray(np.array([-8192, 8191], dtype='>i2').tobytes()))
+    assert data.tolist() == [-8192, 8191]
+
+@pytest.mark.parametrize('fmt', ['ASCII', 'BIN'])
+def test_read_error(sc, fmt):
+    # a failed read gives err_flag 1 and an empty array, the connection stays in sync
+    sc.set_data_format(fmt)
+    err_flag, data = sc.read_data('ACQ:SOUR3:DATA?')
+    assert err_flag == 1
+    assert len(data) == 0
+    assert sc.get_buf_size() == (0, 16384)
+
+## Waiting for the trigger
+def test_wait_trigger(sc, rp):
+    # the first poll is sent once the buffer should be full, a forced trigger is done by then or soon after
+    sc.start_acq()
+    rp.tx_txt('ACQ:TRIG NOW')
+    assert sc.wait_trigger(16384 / sc.sampling_rate, timeout=5)
+    assert sc.wait_stats['triggered']
+    assert sc.wait_stats['polls'] <= 2
+    assert sc.wait_stats['fill_time'] == 16384 / sc.sampling_rate
+
+def test_wait_trigger_backoff(sc, sim):
+    # the holdoff doubles up to max_holdoff, a late trigger takes few polls
+    sim.device.trigger_delay = 0.2
+    sc.set_trigger(1, 'PE', 0.0)
+    sc.start_acq()
+    sc.rp.tx_txt(sc.trig_cache)
+    assert sc.wait_trigger(0, timeout=5, holdoff=0.005, max_holdoff=0.05)
+    assert 3 <= sc.wait_stats['polls'] <= 10
+    assert sc.wait_stats['dead_time'] >= 0.2
+
+def test_trigger_timeout(sc, sim):
+    sim.device.trigger_delay = float('inf')
+    sc.set_trigger(1, 'PE', 0.0)
+    ts, ch1, ch2 = sc.acquire_trace(0.1)
+    assert not sc.wait_stats['triggered']
+    assert 0.1 <= sc.wait_stats['wait'] < 0.3
+    # the trace recorded so far is still read
+    assert len(ch1) == 16384
+
+## Streaming
+@pytest.mark.parametrize('fmt, units, dtype', formats)
+def test_stream(sc, fmt, units, dtype):
+    sc.set_data_format(fmt)
+    sc.set_data_units(units)
+    frames = list(sc.stream(3, timeout=5))
+    assert len(frames) == 3
+    for timestamp, ts, ch1, ch2 in frames:
+        assert len(ch1) == len(ch2) == 16384
+        assert ch1.dtype == dtype
+    assert sc.stream_stats['frames'] == 3
+    assert sc.stream_stats['dropped'] == 0
+
+def test_stream_dropped(sc, sim):
+    # a trigger that doesn't come in time is counted as dropped and armed again
+    sim.device.trigger_delay = float('inf')
+    sc.set_trigger(1, 'PE', 0.0)
+    stream = sc.stream(1, timeout=0.05)
+    timer = threading.Timer(0.12, setattr, [sim.device, 'trigger_delay', 0.0])
+    timer.start()
+    frames = list(stream)
+    timer.join()
+    assert len(frames) == 1
+    assert sc.stream_stats['dropped'] >= 1
+
+def test_stream_overlap(sc):
+    # the device records the next trace while the caller processes the last one,
+    # so the wait for the next trigger only covers the rest of the fill time
+    sc.set_data_format('BIN')
+    sc.set_dec(1024)
+    fill_time = 16384 * 1024 / sc.sampling_rate
+    process = 0.1
+    fill_times = []
+    for frame in sc.stream(4, timeout=5):
+        fill_times.append(sc.wait_stats['fill_time'])
+        time.sleep(process)
+    assert fill_times[0] == pytest.approx(fill_time, abs=0.01)
+    assert max(fill_times[1:]) < fill_time - 0.9 * process
+    assert sc.stream_stats['elapsed'] / 4 < 0.9 * (fill_time + process)
+
+## Time axis
+@pytest.mark.parametrize('fmt, units, dtype', formats)
+def test_time_axis_trigger(sc, rp, fmt, units, dtype):
+    # with an edge trigger on ch1 the sine crosses the trigger level at t = 0
+    sine_on_ch1(rp)
+    sc.set_dec(8)
+    sc.set_trigger(1, 'PE', 0.0, delay=2000)
+    sc.set_data_format(fmt)
+    sc.set_data_units(units)
+    ts, ch1, ch2 = sc.acquire_trace(5)
+    volts = ch1 / 8192 if units == 'RAW' else ch1
+    idx = sc.get_time_axis().trigger_index
+    assert idx == 16384 // 2 - 2000
+    assert ts[idx] == pytest.approx(0, abs=1e-15)
+    assert ts[1] - ts[0] == pytest.approx(8 / sc.sampling_rate)
+    assert volts[idx] == pytest.approx(0, abs=0.01)
+    assert volts[idx + 10] > volts[idx - 10]
+    assert np.abs(volts).max() == pytest.approx(0.5, abs=0.01)
+
+def test_time_axis_cached(sc, rp):
+    ts1, ch1, ch2 = sc.acquire_trace(5)
+    rp._tracer.clear()
+    ts2, ch1, ch2 = sc.acquire_trace(5)
+    assert ts2 is ts1
+    assert not ts2.flags.writeable
+    assert not [msg for msg in sent(rp) if msg in ['ACQ:DEC?', 'ACQ:BUF:SIZE?', 'ACQ:TRIG:DLY?']]
+    sc.set_dec(4)
+    ts3, ch1, ch2 = sc.acquire_trace(5)
+    assert ts3[1] - ts3[0] == pytest.approx(4 / sc.sampling_rate)
+    assert sc.get_time_points() is ts3
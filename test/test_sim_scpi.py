@@ -0,0 +1,207 @@
+import socket
+import threading
+import pytest
+from rpnacs.lib import redpitaya_scpi as scpi
+from rpnacs.lib import utils, DIOController, FuncGenerator
+from conftest import sent, writes
+
+@pytest.fixture
+def raw():
+    # scpi connected to a bare socket, the test writes the server side bytes itself
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    rp = scpi.scpi('127.0.0.1', port=server.getsockname()[1], bufsize=64)
+    conn, addr = server.accept()
+    yield rp, conn
+    rp.close()
+    conn.close()
+    server.close()
+
+def send_later(conn, data, delay=0.05):
+    # Send data after delay, while the client waits for it
+    timer = threading.Timer(delay, conn.sendall, [data])
+    timer.start()
+    return timer
+
+## Receive engine
+def test_rx_txt_split_reply(raw):
+    rp, conn = raw
+    conn.sendall(b'hel')
+    send_later(conn, b'lo\r\n')
+    assert rp.rx_txt() == 'hello'
+
+def test_rx_txt_split_delimiter(raw):
+    rp, conn = raw
+    conn.sendall(b'a\r')
+    send_later(conn, b'\nb\r\n')
+    assert rp.rx_txt() == 'a'
+    assert rp.rx_txt() == 'b'
+
+def test_rx_txt_extra_bytes(raw):
+    rp, conn = raw
+    conn.sendall(b'one\r\ntwo\r\nthr')
+    assert rp.rx_txt() == 'one'
+    assert rp.rx_txt() == 'two'
+    send_later(conn, b'ee\r\n')
+    assert rp.rx_txt() == 'three'
+
+def test_rx_txt_bare_newline(raw):
+    # a '\n' without '\r' is part of the reply
+    rp, conn = raw
+    conn.sendall(b'a\nb\r\n')
+    assert rp.rx_txt() == 'a\nb'
+
+def test_rx_txt_longer_than_buffer(raw):
+    rp, conn = raw
+    reply = ','.join(str(i) for i in range(20000))
+    conn.sendall(reply.encode() + b'\r\n')
+    assert rp.rx_txt() == reply
+
+def test_rx_arb(raw):
+    # the block may contain the delimiter, and is followed by the next reply
+    rp, conn = raw
+    conn.sendall(b'#15a\r\nbc\r\nnext\r\n')
+    assert rp.rx_arb() == b'a\r\nbc'
+    assert rp.rx_txt() == 'next'
+
+def test_rx_arb_split(raw):
+    rp, conn = raw
+    payload = bytes(range(256)) * 1000
+    conn.sendall(b'#6256000' + payload[:1000])
+    send_later(conn, payload[1000:] + b'\r\nnext\r\n')
+    assert rp.rx_arb() == payload
+    assert rp.rx_txt() == 'next'
+
+def test_rx_arb_split_header(raw):
+    rp, conn = raw
+    conn.sendall(b'#')
+    send_later(conn, b'13abc\r\n')
+    assert rp.rx_arb() == b'abc'
+
+def test_rx_arb_error_reply(raw):
+    # ERR! and other replies that are not a block are dropped and return False, the next reply is intact
+    rp, conn = raw
+    conn.sendall(b'ERR!\r\n0\r\n#12ok\r\n')
+    assert rp.rx_arb() is False
+    assert rp.rx_arb() is False
+    assert rp.rx_arb() == b'ok'
+
+def test_rx_txt_error_reply(raw):
+    rp, conn = raw
+    conn.sendall(b'ERR!\r\n')
+    assert utils.rm_err(rp.rx_txt()) == (1, '')
+
+def test_connection_closed(raw):
+    rp, conn = raw
+    conn.sendall(b'partial')
+    conn.close()
+    with pytest.raises(ConnectionError):
+        rp.rx_txt()
+
+def test_rx_buffer_reused(raw):
+    # replies that fit are received into the same buffer
+    rp, conn = raw
+    buf = rp._rx_buf
+    for i in range(100):
+        conn.sendall(b'%d\r\n' % i)
+        assert rp.rx_txt() == str(i)
+    assert rp._rx_buf is buf
+
+## Batches
+def test_batch_single_write(rp, sim):
+    with rp.batch():
+        rp.tx_txt('ACQ:DEC 8')
+        rp.tx_txt('ACQ:AVG OFF')
+        rp.tx_txt('DIG:PIN LED1,1')
+    assert writes(rp) == 1
+    assert rp.txrx_txt('ACQ:DEC?') == '8'
+    assert sim.device.acq['AVG'] == 'OFF'
+    assert sim.device.pins['LED1'][1] == 1
+
+def test_batch_nested(rp):
+    with rp.batch():
+        rp.tx_txt('ACQ:DEC 8')
+        with rp.batch():
+            rp.tx_txt('ACQ:DEC 16')
+        assert writes(rp) == 0
+    assert writes(rp) == 1
+    assert sent(rp) == ['ACQ:DEC 8', 'ACQ:DEC 16']
+
+def test_batch_join(rp, sim):
+    # compound lines: one reply per query, commands before a query share its line
+    with rp.batch(join=True):
+        rp.tx_txt('ACQ:DEC 8')
+        rp.tx_txt('ACQ:DEC?')
+        rp.tx_txt('ACQ:AVG OFF')
+        rp.tx_txt('ACQ:AVG?')
+        rp.tx_txt('DIG:PIN LED2,1')
+    assert rp.rx_txt() == '8'
+    assert rp.rx_txt() == 'OFF'
+    assert rp.txrx_txt('DIG:PIN? LED2') == '1'
+    assert sim.device.errors == 0
+
+def test_batch_receive_flushes(rp):
+    # receiving inside a batch sends the queued query first
+    with rp.batch():
+        rp.tx_txt('ACQ:DEC 4')
+        rp.tx_txt('ACQ:DEC?')
+        assert rp.rx_txt() == '4'
+
+def test_batch_instrument_setters(rp, sim):
+    # setters grouped by the instrument classes go out in one write
+    dio = DIOController.DIOController(rp)
+    dio.set_all_led([1, 0] * 4 + [1])
+    assert writes(rp) == 1
+    assert rp.txrx_txt('DIG:PIN? LED8') == '1'
+
+def test_batch_holds_lock(rp, sim):
+    # a message from another thread is not queued in this thread's batch, it waits for the batch to be sent
+    thread = threading.Thread(target=rp.tx_txt, args=('DIG:PIN LED3,1',))
+    with rp.batch():
+        rp.tx_txt('ACQ:DEC 8')
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+        assert rp._tx_pending == ['ACQ:DEC 8']
+    thread.join()
+    assert sent(rp) == ['ACQ:DEC 8', 'DIG:PIN LED3,1']
+    assert rp.txrx_txt('DIG:PIN? LED3') == '1'
+
+## Pipelined queries
+def test_txrx_many(rp):
+    rp.tx_txt('ACQ:DEC 32')
+    rp._tracer.clear()
+    replies = rp.txrx_many(['ACQ:DEC?', 'ACQ:BUF:SIZE?', 'BAD:CMD?', '*IDN?'])
+    assert replies[:3] == ['32', '16384', 'ERR!']
+    assert replies[3].startswith('REDPITAYA')
+    assert writes(rp) == 1
+
+def test_txrx_many_threads(rp):
+    # concurrent pipelined exchanges each get their own replies
+    errors = []
+    def worker():
+        for i in range(50):
+            replies = rp.txrx_many(['ACQ:BUF:SIZE?'] * 3)
+            if replies != ['16384'] * 3:
+                errors.append(replies)
+    threads = [threading.Thread(target=worker) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+def test_query_many(rp):
+    vals = utils.query_many(rp, [('ACQ:DEC?', int), ('ACQ:TRIG:LEV?', float), ('NOPE?', int)])
+    assert vals[0] == (0, 1)
+    assert vals[1] == (0, 0.0)
+    assert vals[2][0] == 1
+
+def test_get_settings_one_round_trip(rp):
+    fgen = FuncGenerator.FuncGenerator(rp)
+    rp._tracer.clear()
+    settings = fgen.get_settings(1)
+    assert writes(rp) == 1
+    assert settings['waveform'] == (0, 'SINE')
+    assert settings['freq'] == (0, 1000)
@@ -0,0 +1,83 @@
+import time
+import numpy as np
+from rpnacs.lib import redpitaya_scpi as scpi
+from rpnacs.lib.simulator import SimDevice, SimServer
+
+def test_idn(rp):
+    assert rp.idn_q().startswith('REDPITAYA')
+
+def test_errors(rp, sim):
+    # unknown commands and bad arguments are counted, queries reply ERR!
+    rp.tx_txt('NOT:A:COMMAND 1')
+    assert rp.txrx_txt('NOT:A:QUERY?') == 'ERR!'
+    assert rp.txrx_txt('ACQ:DEC?') == '1'
+    rp.tx_txt('DIG:PIN:DIR SIDEWAYS,DIO1_P')
+    assert rp.txrx_txt('SYST:ERR:COUN?') == '3'
+
+def test_compound_lines(rp):
+    rp.tx_txt('ACQ:DEC 8;:ACQ:AVG OFF;:ACQ:DEC?')
+    assert rp.rx_txt() == '8'
+    assert rp.txrx_txt('ACQ:AVG?') == 'OFF'
+
+def test_settings_round_trip(rp):
+    rp.tx_txt('SOUR2:FREQ:FIX 2500')
+    rp.tx_txt('ACQ:TRIG:LEV 0.25')
+    assert rp.txrx_txt('SOUR2:FREQ:FIX?') == '2500'
+    assert rp.txrx_txt('ACQ:TRIG:LEV?') == '0.25'
+
+def test_reset(rp):
+    rp.tx_txt('ACQ:DEC 64')
+    rp.tx_txt('DIG:PIN LED1,1')
+    rp.tx_txt('*RST')
+    assert rp.txrx_many(['ACQ:DEC?', 'DIG:PIN? LED1']) == ['1', '0']
+
+def test_inputs(rp, sim):
+    sim.device.set_input('DIO3_N', 1)
+    assert rp.txrx_txt('DIG:PIN? DIO3_N') == '1'
+    # outputs report the level set, not the input
+    rp.tx_txt('DIG:PIN:DIR OUT,DIO3_N')
+    assert rp.txrx_txt('DIG:PIN? DIO3_N') == '0'
+
+def test_trigger_and_data(rp):
+    rp.tx_txt('ACQ:START')
+    rp.tx_txt('ACQ:TRIG NOW')
+    deadline = time.time() + 5
+    while rp.txrx_txt('ACQ:TRIG:STAT?') != 'TD':
+        assert time.time() < deadline
+    rp.tx_txt('ACQ:DATA:FORMAT BIN')
+    rp.tx_txt('ACQ:SOUR1:DATA?')
+    data = rp.rx_arb()
+    assert len(data) == 16384 * 4
+
+def test_trigger_delay():
+    # an edge trigger fires trigger_delay after arming, never if it is inf
+    device = SimDevice(trigger_delay=float('inf'))
+    device.handle('ACQ:START')
+    device.handle('ACQ:TRIG CH1_PE')
+    assert device.handle('ACQ:TRIG:STAT?') == b'WAIT'
+    device.handle('ACQ:TRIG NOW')
+    time.sleep(device.buf_size / 125e6)
+    assert device.handle('ACQ:TRIG:STAT?') == b'TD'
+
+def test_latency():
+    with SimServer(latency=0.05) as server:
+        rp = scpi.scpi(server.host, port=server.port)
+        t0 = time.perf_counter()
+        # queries sent together share the latency
+        rp.txrx_many(['*IDN?'] * 5)
+        dt = time.perf_counter() - t0
+        rp.close()
+    assert 0.05 <= dt < 0.25
+
+def test_several_connections(sim):
+    conns = [scpi.scpi(sim.host, port=sim.port) for i in range(3)]
+    conns[0].tx_txt('ACQ:DEC 16')
+    assert [conn.txrx_txt('ACQ:DEC?') for conn in conns] == ['16'] * 3
+    for conn in conns:
+        conn.close()
+
+def test_awg_data(rp, sim):
+    data = np.linspace(-1, 1, 16384)
+    rp.tx_txt('SOUR1:TRAC:DATA:DATA ' + ','.join('%.6g' % x for x in data))
+    reply = rp.txrx_txt('SOUR1:TRAC:DATA:DATA?')
+    assert np.allclose(np.array(reply.split(','), dtype=float), data, atol=1e-5)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from rpnacs.lib.timeaxis import TimeAxis
+
+def test_from_acquisition():
+    # without a delay the trigger is in the middle of the buffer
+    axis = TimeAxis.from_acquisition(16384, 8)
+    assert len(axis) == 16384
+    assert axis.step == 8 / 125e6
+    assert axis.trigger_index == 8192
+    assert axis[8192] == 0
+    assert axis.duration == pytest.approx(16384 * 8 / 125e6)
+    assert axis.stop == axis[-1]
+
+def test_trigger_delay():
+    # a delay moves the trigger earlier in the buffer, possibly out of it
+    assert TimeAxis.from_acquisition(16384, 1, 2000).trigger_index == 8192 - 2000
+    axis = TimeAxis.from_acquisition(16384, 1, 10000)
+    assert axis.trigger_index == -1808
+    assert axis.start > 0
+
+def test_array():
+    axis = TimeAxis(-1.0, 0.5, 5)
+    assert axis.array.tolist() == [-1.0, -0.5, 0.0, 0.5, 1.0]
+    assert axis.array is axis.array
+    assert not axis.array.flags.writeable
+    assert np.asarray(axis) is axis.array
+    assert np.asarray(axis, dtype=np.float32).dtype == np.float32
+    assert axis[1:3].tolist() == [-0.5, 0.0]
+
+def test_repr():
+    assert repr(TimeAxis(0.0, 1.0, 3)) == 'TimeAxis(start=0.0, step=1.0, length=3)'
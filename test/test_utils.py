@@ -0,0 +1,54 @@
+import numpy as np
+from rpnacs.lib import utils
+
+## ASCII trace parser
+def test_parse_data():
+    data = utils.parse_data('{1.5,-2,3e-3}')
+    assert data.dtype == np.float64
+    assert data.tolist() == [1.5, -2, 3e-3]
+
+def test_parse_data_bytes_and_whitespace():
+    assert utils.parse_data(b'{ 1.0, 2.0 ,3.0}\r\n').tolist() == [1, 2, 3]
+
+def test_parse_data_dtype():
+    data = utils.parse_data('{0.25,0.5}', np.float32)
+    assert data.dtype == np.float32
+    assert data.tolist() == [0.25, 0.5]
+
+def test_parse_data_full_trace():
+    volts = np.random.default_rng(0).uniform(-1, 1, 16384)
+    text = '{' + ','.join('%.6f' % v for v in volts) + '}'
+    assert np.allclose(utils.parse_data(text), volts, atol=1e-6)
+
+## Envelope decimation
+def test_envelope():
+    t = np.arange(12.0)
+    y = np.array([0, 5, 1, 2, -3, 2, 1, 1, 1, 0, 9, 0.0])
+    t_out, y_out = utils.envelope(t, y, 3)
+    assert y_out.tolist() == [0, 5, -3, 2, 0, 9]
+    assert t_out.tolist() == [0, 3, 4, 7, 8, 11]
+
+def test_envelope_keeps_glitch():
+    # a single sample spike survives decimation to a few bins
+    y = np.zeros(16384)
+    y[1234] = 1
+    t_out, y_out = utils.envelope(np.arange(16384), y, 100)
+    assert len(t_out) == len(y_out) == 200
+    assert y_out.max() == 1
+
+def test_envelope_channels():
+    y = np.random.default_rng(0).normal(size=(2, 16384)).astype(np.float32)
+    t = np.arange(16384) / 125e6
+    t_out, y_out = utils.envelope(t, y, 500)
+    assert y_out.shape == (2, 1000)
+    assert y_out.dtype == np.float32
+    assert np.array_equal(y_out.max(axis=-1), y.max(axis=-1))
+    assert np.array_equal(y_out.min(axis=-1), y.min(axis=-1))
+    assert np.all(np.diff(t_out) >= 0)
+
+def test_envelope_short():
+    # traces short enough are returned as they are
+    t = np.arange(10)
+    y = np.arange(10.0)
+    assert utils.envelope(t, y, 5)[1] is y
+    assert utils.envelope(t, y, 0)[1] is y
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from rpnacs.lib import waveforms
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    waveforms.cache_clear()
+
+def test_cached_readonly():
+    # the same parameters give the same read-only array
+    wave = waveforms.sine(3)
+    assert waveforms.sine(3) is wave
+    assert not wave.flags.writeable
+    with pytest.raises(ValueError):
+        wave[0] = 1
+
+def test_values():
+    t = np.arange(16384) / 16384
+    assert np.allclose(waveforms.sine(2, 90), np.cos(4 * np.pi * t))
+    assert np.allclose(waveforms.chirp(5, 5), np.sin(10 * np.pi * t))
+    assert waveforms.gaussian_pulse(0.5, 0.05)[8192] == 1
+    assert waveforms.ramp()[[0, -1]].tolist() == [-1, 1]
+    assert len(waveforms.sine(n=100)) == 100
+
+def test_multitone():
+    wave = waveforms.multitone([1, 5], amps=[1, 0.5])
+    assert np.abs(wave).max() == pytest.approx(1)
+    assert waveforms.multitone(np.array([1, 5]), amps=(1, 0.5)) is wave
+
+def test_families():
+    # one row per parameter, the same as the single waveforms
+    rates = np.linspace(10, 100, 5)
+    rows = waveforms.chirps(0, rates)
+    assert rows.shape == (5, 16384)
+    assert not rows.flags.writeable
+    for row, f1 in zip(rows, rates):
+        assert np.allclose(row, waveforms.chirp(0, f1))
+    assert np.allclose(waveforms.sines([1, 2], [0, 90])[1], waveforms.sine(2, 90))
+    assert np.allclose(waveforms.gaussian_pulses(0.5, [0.1, 0.2])[1], waveforms.gaussian_pulse(0.5, 0.2))
+    assert waveforms.chirps(0, rates) is rows
+
+def test_family_cache_size():
+    # families are large, only a few are kept
+    for i in range(waveforms.family_cache_size + 4):
+        waveforms.sines(np.arange(i + 1))
+    assert waveforms._family.cache_info().currsize == waveforms.family_cache_size
+    assert waveforms.sine.cache_info().maxsize == waveforms.cache_size
+
+def test_unknown_family():
+    with pytest.raises(ValueError):
+        waveforms._family('square', ((1.0,),), 16)
+
+def test_generate():
+    assert np.array_equal(waveforms.generate('chirp', f0=1, f1=100), waveforms.chirp(1, 100))
+    with pytest.raises(KeyError):
+        waveforms.generate('noise')
+
+def test_cache_clear():
+    wave = waveforms.ramp()
+    waveforms.cache_clear()
+    assert waveforms.ramp() is not wave